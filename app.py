@@ -1,26 +1,83 @@
+import hashlib
+import json
 import os
-from datetime import date, datetime
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify
+import uuid
+from datetime import date
+from flask import (Flask, render_template, redirect, url_for, flash, request, jsonify,
+                   Response, abort, stream_with_context)
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from sqlalchemy import func
-from models import db, User, Wine, TastingNote
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, load_only, with_expression
+from sqlalchemy.orm.exc import StaleDataError
+from models import db, User, Wine, TastingNote, Job, as_of_year
 from flask_wtf.csrf import generate_csrf
-from forms import LoginForm, RegisterForm, WineForm, TastingNoteForm, SearchForm
+from forms import LoginForm, RegisterForm, WineForm, EditWineForm, TastingNoteForm, SearchForm, TastingFilterForm
+from pagination import PAGE_SIZE, paginate
+import search_index
+from cellar_stats import cellar_stats, top_rated
+import cellar_summary
+import wine_varietals
+import wine_versions
+import drinking_windows
+import inventory
+import csv_import
+import jobs
+import apply_transactions
+import migrations
+import sqlite_tuning
+import profiling
+from facets import wine_facets
+from cellar_export import csv_chunks, gzip_chunks
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'wine-cellar-dev-secret-key-2026')
 
-# Use /tmp for writable DB on Render (ephemeral), or local instance/ for dev
-if os.environ.get('RENDER'):
-    db_path = '/tmp/winecellar.db'
+# Pool settings for a shared PostgreSQL server: drop connections the
+# server closed while idle instead of failing the next request
+POSTGRES_ENGINE_OPTIONS = {
+    'pool_size': 4,
+    'max_overflow': 4,
+    'pool_timeout': 10,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+}
+
+database_url = os.environ.get('DATABASE_URL')
+if database_url:
+    # PostgreSQL shared by every web node; hosts often hand out postgres://,
+    # which SQLAlchemy no longer accepts, and a URL without a driver gets
+    # psycopg 3 on SQLAlchemy 2.1 rather than the psycopg2 we install
+    for scheme in ('postgres://', 'postgresql://'):
+        if database_url.startswith(scheme):
+            database_url = 'postgresql+psycopg2://' + database_url[len(scheme):]
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(POSTGRES_ENGINE_OPTIONS)
+    data_dir = app.instance_path
 else:
-    db_path = os.path.join(app.instance_path, 'winecellar.db')
-    os.makedirs(app.instance_path, exist_ok=True)
+    # Use /tmp for writable DB on Render (ephemeral), or local instance/ for dev;
+    # DATABASE_PATH overrides both (the build writes the seed snapshot that way)
+    if os.environ.get('DATABASE_PATH'):
+        db_path = os.path.abspath(os.environ['DATABASE_PATH'])
+    elif os.environ.get('RENDER'):
+        db_path = '/tmp/winecellar.db'
+    else:
+        db_path = os.path.join(app.instance_path, 'winecellar.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(sqlite_tuning.ENGINE_OPTIONS)
+    data_dir = os.path.dirname(db_path)
+os.makedirs(data_dir, exist_ok=True)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Uploaded files wait here for their background import job
+app.config['UPLOAD_FOLDER'] = os.path.join(data_dir, 'uploads')
+# Held by migrations.upgrade() so concurrent starts on an SQLite database
+# migrate only once (PostgreSQL uses an advisory lock instead)
+app.config['MIGRATION_LOCK'] = os.path.join(data_dir, 'migrate.lock')
 
 db.init_app(app)
+sqlite_tuning.init_app(app)
+profiling.init_app(app)
 
 @app.context_processor
 def inject_csrf_token():
@@ -45,11 +102,9 @@ def home():
     wine_count = 0
     latest_transactions = []
     if current_user.is_authenticated:
-        cellar_wines = current_user.wines.filter_by(status='cellar').filter(
-            db.or_(Wine.on_order == False, Wine.on_order.is_(None))
-        ).all()
-        bottle_count = sum(w.quantity for w in cellar_wines)
-        wine_count = len(cellar_wines)
+        summary = cellar_summary.cellar_summary(current_user.id)
+        bottle_count = summary.bottles
+        wine_count = summary.wines
         latest_transactions = current_user.wines.order_by(Wine.date_added.desc()).limit(5).all()
     return render_template('home.html', recent_wines=recent_wines,
                            bottle_count=bottle_count, wine_count=wine_count,
@@ -121,122 +176,119 @@ def logout():
 
 # ─── Cellar Routes ────────────────────────────────────────────────
 
-@app.route('/cellar')
-@login_required
-def cellar():
-    status = request.args.get('status', 'cellar')
-    search_form = SearchForm(request.args)
+_SORT_COLUMNS = {
+    'name': func.lower(Wine.name),
+    'vintage': Wine.vintage,
+    'producer': func.lower(Wine.producer),
+    'appellation': func.lower(Wine.appellation),
+    'varietal': func.lower(Wine.varietal1),
+    'wine_type': Wine.wine_type,
+    'rating': Wine.rating,
+    'price': Wine.price,
+    'date_added': Wine.date_added,
+}
 
+
+def _sort_column(sort_by):
+    """The ORDER BY expression for a sort_by value from _sort_options()."""
+    if sort_by == 'maturity':
+        return Wine.maturity_rank_at(as_of_year())
+    return _SORT_COLUMNS[sort_by]
+
+
+def _with_maturity(query):
+    """Have the query compute each wine's maturity, so the list renders
+    it without working out every row's window in Python."""
+    return query.options(with_expression(Wine.maturity, Wine.maturity_at(as_of_year())))
+
+
+def _status_query(status):
+    """The current user's wines for one cellar tab."""
     # For on_order view, show cellar wines where on_order=True
     # For cellar view, exclude on_order wines (matching original site behavior)
     if status == 'on_order':
-        query = current_user.wines.filter_by(status='cellar', on_order=True)
-    elif status == 'cellar':
-        query = current_user.wines.filter_by(status='cellar').filter(
+        return current_user.wines.filter_by(status='cellar', on_order=True)
+    if status == 'cellar':
+        return current_user.wines.filter_by(status='cellar').filter(
             db.or_(Wine.on_order == False, Wine.on_order.is_(None))
         )
-    else:
-        query = current_user.wines.filter_by(status=status)
+    if status == 'consumed':
+        # Fully consumed wines, and cellar wines with bottles drunk
+        return current_user.wines.filter(or_(Wine.status == 'consumed', inventory.has_consumed()))
+    return current_user.wines.filter_by(status=status)
 
-    # Apply search filters (ignore placeholder text "Wine Finder")
+
+def _apply_search_filters(query, search_form):
+    """Narrow a Wine query by the fields of a SearchForm."""
+    # Ignore placeholder text "Wine Finder"
     search_query = search_form.query.data
     if search_query and search_query.strip().lower() == 'wine finder':
         search_query = None
     if search_query:
-        search_term = f"%{search_query}%"
-        or_conditions = [
-            Wine.name.ilike(search_term),
-            Wine.producer.ilike(search_term),
-            Wine.varietal1.ilike(search_term),
-            Wine.varietal2.ilike(search_term),
-            Wine.varietal3.ilike(search_term),
-            Wine.varietal4.ilike(search_term),
-            Wine.appellation.ilike(search_term),
-            Wine.acq_from.ilike(search_term),
-        ]
-        try:
-            year = int(search_query.strip())
-            if 1900 <= year <= 2100:
-                or_conditions.append(Wine.vintage == year)
-        except ValueError:
-            pass
-        query = query.filter(db.or_(*or_conditions))
+        query = search_index.filter_wines(query, search_query)
     if search_form.wine_type.data:
         query = query.filter_by(wine_type=search_form.wine_type.data)
     if search_form.appellation.data:
         query = query.filter(Wine.appellation.ilike(f"%{search_form.appellation.data}%"))
     if search_form.varietal.data:
-        vterm = f"%{search_form.varietal.data}%"
-        query = query.filter(
-            db.or_(
-                Wine.varietal1.ilike(vterm),
-                Wine.varietal2.ilike(vterm),
-                Wine.varietal3.ilike(vterm),
-                Wine.varietal4.ilike(vterm)
-            )
-        )
+        query = query.filter(wine_varietals.has_varietal(search_form.varietal.data))
     if search_form.min_vintage.data:
         query = query.filter(Wine.vintage >= search_form.min_vintage.data)
     if search_form.max_vintage.data:
         query = query.filter(Wine.vintage <= search_form.max_vintage.data)
+    if search_form.maturity.data:
+        query = query.filter(Wine.maturity_at(as_of_year()) == search_form.maturity.data)
+    return query
 
-    # Sorting - default by name, case-insensitive to match original site
+
+def _sort_options(search_form):
+    """(sort_by, sort_order) from a SearchForm, defaulting to name ascending."""
     sort_by = search_form.sort_by.data or 'name'
-    sort_order = search_form.sort_order.data or 'asc'
-    sort_col_map = {
-        'name': func.lower(Wine.name),
-        'vintage': Wine.vintage,
-        'producer': func.lower(Wine.producer),
-        'appellation': func.lower(Wine.appellation),
-        'varietal': func.lower(Wine.varietal1),
-        'wine_type': Wine.wine_type,
-        'rating': Wine.rating,
-        'price': Wine.price,
-        'date_added': Wine.date_added,
-    }
-    sort_col = sort_col_map.get(sort_by, func.lower(Wine.name))
-    if sort_order == 'desc':
-        query = query.order_by(sort_col.desc())
-    else:
-        query = query.order_by(sort_col.asc())
+    if sort_by not in _SORT_COLUMNS and sort_by != 'maturity':
+        sort_by = 'name'
+    sort_order = 'desc' if search_form.sort_order.data == 'desc' else 'asc'
+    return sort_by, sort_order
+
+
+@app.route('/cellar')
+@login_required
+def cellar():
+    status = request.args.get('status', 'cellar')
+    search_form = SearchForm(request.args)
+    query = _apply_search_filters(_status_query(status), search_form)
 
-    # Get all wines first, then paginate in Python (simpler, avoids double query)
-    all_wines = query.all()
-    total_wines = len(all_wines)
-    total_bottles = sum(w.quantity for w in all_wines)
+    # Sorting - default by name, case-insensitive to match original site
+    sort_by, sort_order = _sort_options(search_form)
+    sort_col = _sort_column(sort_by)
+
+    # Totals come from one aggregate query; only the visible page is loaded
+    total_wines, total_bottles = query.with_entities(
+        func.count(Wine.id), func.coalesce(func.sum(Wine.quantity), 0)
+    ).order_by(None).one()
+    if status == 'consumed':
+        # Bottles drunk, from the inventory ledger, rather than those left
+        total_bottles = sum(inventory.consumed_from(query.with_entities(Wine.id).order_by(None)).values())
 
     # Pagination: 50 per page (matching original), "All" shows everything
     submit_action = request.args.get('submitAction', '')
     page = int(request.args.get('page', 1))
-    limit = 50
     show_all = (submit_action == 'All' or request.args.get('show_all') == '1')
 
+    # Next/Previous seek from the cursor of the page being left
+    after = before = None
     if submit_action == 'Next':
         page = page + 1
+        after = request.args.get('after')
     elif submit_action == 'Previous':
         page = max(1, page - 1)
+        before = request.args.get('before')
     elif submit_action == 'Search':
         page = 1  # Reset to page 1 on new search
 
-    total_pages = max(1, (total_wines + limit - 1) // limit)
-    if page > total_pages:
-        page = total_pages
-    if page < 1:
-        page = 1
-
-    if show_all:
-        wines = all_wines
-    else:
-        start = (page - 1) * limit
-        wines = all_wines[start:start + limit]
-
-    # Build varietal list from user's wines for the filter dropdown
-    varietal_set = set()
-    for w in current_user.wines.all():
-        for v in [w.varietal1, w.varietal2, w.varietal3, w.varietal4]:
-            if v:
-                varietal_set.add(v)
-    varietals = sorted(varietal_set)
+    result = paginate(_with_maturity(query), sort_col, Wine.id, total_wines, page=page,
+                      sort_key=f'{sort_by}:{sort_order}', descending=(sort_order == 'desc'),
+                      after=after, before=before, show_all=show_all)
+    wines = result.items
 
     status_labels = {
         'cellar': f"Wines in {current_user.username}'s Cellar",
@@ -250,10 +302,12 @@ def cellar():
                            status=status,
                            status_label=status_labels.get(status, 'Wines in Cellar'),
                            search_form=search_form,
-                           varietals=varietals,
-                           current_year=date.today().year,
-                           page=page,
-                           total_pages=total_pages,
+                           facets=wine_facets(current_user.id),
+                           current_year=as_of_year(),
+                           page=result.page,
+                           total_pages=result.total_pages,
+                           next_cursor=result.next_cursor,
+                           prev_cursor=result.prev_cursor,
                            total_wines=total_wines,
                            total_bottles=total_bottles,
                            show_all=show_all)
@@ -262,40 +316,32 @@ def cellar():
 @app.route('/cellar/ready')
 @login_required
 def ready_to_drink():
-    current_year = date.today().year
-    all_wines = current_user.wines.filter_by(status='cellar').filter(
-        Wine.drink_from <= current_year,
-        db.or_(Wine.drink_to >= current_year, Wine.drink_to.is_(None))
-    ).order_by(func.lower(Wine.name).asc()).all()
+    current_year = as_of_year()
+    query = current_user.wines.filter_by(status='cellar').filter(Wine.is_ready_at(current_year))
+    total_wines, total_bottles = query.with_entities(
+        func.count(Wine.id), func.coalesce(func.sum(Wine.quantity), 0)
+    ).one()
 
-    total_wines = len(all_wines)
-    total_bottles = sum(w.quantity for w in all_wines)
-
-    # Pagination
+    # Pagination, with the same cursors as the cellar list
     submit_action = request.args.get('submitAction', '')
     page = int(request.args.get('page', 1))
-    limit = 50
     show_all = (submit_action == 'All' or request.args.get('show_all') == '1')
 
+    after = before = None
     if submit_action == 'Next':
         page = page + 1
+        after = request.args.get('after')
     elif submit_action == 'Previous':
         page = max(1, page - 1)
+        before = request.args.get('before')
 
-    total_pages = max(1, (total_wines + limit - 1) // limit)
-    if page > total_pages:
-        page = total_pages
-    if page < 1:
-        page = 1
+    result = paginate(_with_maturity(query), func.lower(Wine.name), Wine.id, total_wines,
+                      page=page, sort_key='name:asc', after=after, before=before,
+                      show_all=show_all)
 
-    if show_all:
-        wines = all_wines
-    else:
-        start = (page - 1) * limit
-        wines = all_wines[start:start + limit]
-
-    return render_template('ready.html', wines=wines, current_year=current_year,
-                           page=page, total_pages=total_pages,
+    return render_template('ready.html', wines=result.items, current_year=current_year,
+                           page=result.page, total_pages=result.total_pages,
+                           next_cursor=result.next_cursor, prev_cursor=result.prev_cursor,
                            total_wines=total_wines, total_bottles=total_bottles,
                            show_all=show_all)
 
@@ -359,8 +405,13 @@ def add_to_cellar(wine_id):
         except ValueError:
             pass
 
-    # Update the wine record: add bottles to existing quantity
-    wine.quantity += qty
+    # A wish list quantity is not bottles held
+    if wine.status == 'wishlist':
+        wine.quantity = 0
+    # Record the acquisition, which adds the bottles to the quantity
+    inventory.record(wine, inventory.ACQUIRE, qty, on=acq_date,
+                     price=price if price and price > 0 else None,
+                     party=from_name or None, location=stored or None)
     wine.acq_date = acq_date
     if price and price > 0:
         wine.price = price
@@ -394,6 +445,7 @@ def add_wine():
         wine = Wine(user_id=current_user.id)
         form.populate_obj(wine)
         db.session.add(wine)
+        inventory.open_balance(wine)
         db.session.commit()
         flash(f'"{wine.name}" added to your cellar!', 'success')
         return redirect(url_for('cellar', status=wine.status))
@@ -407,35 +459,12 @@ def wine_detail(wine_id):
     if wine.user_id != current_user.id:
         flash('Access denied.', 'danger')
         return redirect(url_for('cellar'))
-    tasting_notes = wine.tasting_notes.order_by(TastingNote.tasting_date.desc()).all()
-
-    # Get consumption records linked to this wine
-    consumed_copies = []
-    total_acquired = wine.original_quantity or wine.quantity
-    total_consumed = 0
-    parent = None
-
-    if wine.status == 'cellar':
-        consumed_copies = wine.consumed_copies.order_by(Wine.date_consumed.asc()).all()
-        total_consumed = sum(c.quantity for c in consumed_copies)
-    elif wine.status == 'consumed' and wine.parent_wine_id:
-        # This is a consumed wine - show the parent's transaction data
-        parent = Wine.query.get(wine.parent_wine_id)
-        if parent:
-            total_acquired = parent.original_quantity or parent.quantity
-            consumed_copies = parent.consumed_copies.order_by(Wine.date_consumed.asc()).all()
-            total_consumed = sum(c.quantity for c in consumed_copies)
-    elif wine.status == 'consumed':
-        # Standalone consumed wine (fully consumed, no cellar entry)
-        total_acquired = wine.quantity
-        total_consumed = wine.quantity
-
-    actual_in_cellar = total_acquired - total_consumed if wine.status == 'cellar' else (
-        (parent.quantity if parent else 0) if wine.status == 'consumed' and wine.parent_wine_id else 0
-    )
-
-    # The "acquisition wine" is the cellar parent (or the wine itself if cellar)
-    acq_wine = parent if parent else wine
+
+    # Personal transactions come from the inventory ledger
+    total_acquired, total_consumed, actual_in_cellar = wine.inventory_totals()
+    events = inventory.history(wine.id)
+    tasting_notes = wine.tasting_notes \
+        .order_by(TastingNote.tasting_date.desc().nulls_last(), TastingNote.id.desc()).all()
 
     # Find related wines: other wines by same producer in user's cellar
     related_wines = Wine.query.filter(
@@ -445,28 +474,13 @@ def wine_detail(wine_id):
         Wine.status == 'cellar'
     ).limit(5).all()
 
-    # Gather tasting notes from both the wine and its consumed copies (deduplicated)
-    seen_note_ids = set()
-    all_tasting_notes = []
-    for note in tasting_notes:
-        if note.id not in seen_note_ids:
-            all_tasting_notes.append(note)
-            seen_note_ids.add(note.id)
-    for cc in consumed_copies:
-        for note in cc.tasting_notes.all():
-            if note.id not in seen_note_ids:
-                all_tasting_notes.append(note)
-                seen_note_ids.add(note.id)
-    # Sort by date desc
-    all_tasting_notes.sort(key=lambda n: n.tasting_date or datetime.min, reverse=True)
-
-    return render_template('wine_detail.html', wine=wine, tasting_notes=all_tasting_notes,
-                           consumed_copies=consumed_copies,
+    return render_template('wine_detail.html', wine=wine, tasting_notes=tasting_notes,
+                           acquisitions=[e for e in events if e.kind == inventory.ACQUIRE],
+                           consumptions=[e for e in events if e.kind == inventory.CONSUME],
+                           adjustments=[e for e in events if e.kind == inventory.ADJUST],
                            total_acquired=total_acquired,
                            total_consumed=total_consumed,
                            actual_in_cellar=actual_in_cellar,
-                           parent_wine=parent,
-                           acq_wine=acq_wine,
                            related_wines=related_wines)
 
 
@@ -477,13 +491,37 @@ def edit_wine(wine_id):
     if wine.user_id != current_user.id:
         flash('Access denied.', 'danger')
         return redirect(url_for('cellar'))
-    form = WineForm(obj=wine)
+    form = EditWineForm(obj=wine)
     if form.validate_on_submit():
+        # The version the form was opened at; a consumption or another edit
+        # since then must not be overwritten with the form's values
+        if request.form.get('version_id', type=int) not in (None, wine.version_id):
+            return _edit_conflict(form, wine)
+        # A changed quantity is recorded as an adjustment
+        quantity = wine.quantity
         form.populate_obj(wine)
-        db.session.commit()
+        new_quantity, wine.quantity = wine.quantity, quantity
+        try:
+            inventory.adjust_to(wine, new_quantity)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return _edit_conflict(form, wine)
         flash(f'"{wine.name}" updated.', 'success')
         return redirect(url_for('wine_detail', wine_id=wine.id))
-    return render_template('wine_form.html', form=form, title='Edit Wine', wine=wine)
+    # Re-shown after a validation error: still the version the form was opened at
+    return render_template('wine_form.html', form=form, title='Edit Wine', wine=wine,
+                           version_id=request.form.get('version_id', wine.version_id))
+
+
+def _edit_conflict(form, wine):
+    """Show the edit form again, keeping the user's changes but with the
+    current quantity and version, after the wine changed underneath it."""
+    form.quantity.data, form.quantity.raw_data = wine.quantity, None
+    flash(f'"{wine.name}" was changed while you were editing it; the quantity now shows '
+          'the bottles in the cellar. Check your changes and save again.', 'warning')
+    return render_template('wine_form.html', form=form, title='Edit Wine', wine=wine,
+                           version_id=wine.version_id)
 
 
 @app.route('/wine/<int:wine_id>/delete', methods=['POST'])
@@ -494,8 +532,18 @@ def delete_wine(wine_id):
         flash('Access denied.', 'danger')
         return redirect(url_for('cellar'))
     name = wine.name
+    # Wines linked to it stay, unlinked; its tasting notes, inventory
+    # events and varietal rows go with it (ORM and ON DELETE cascades)
+    for child in wine.consumed_copies:
+        child.parent_wine_id = None
     db.session.delete(wine)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except (StaleDataError, IntegrityError):
+        # Changed, or newly referenced, since it was loaded
+        db.session.rollback()
+        flash(f'"{name}" was changed while it was being removed; please try again.', 'warning')
+        return redirect(url_for('wine_detail', wine_id=wine_id))
     flash(f'"{name}" removed.', 'success')
     return redirect(url_for('cellar'))
 
@@ -531,7 +579,10 @@ def consume_wine(wine_id):
         qty = int(request.form.get('quantity', 1))
     except (ValueError, TypeError):
         qty = 1
-    qty = min(qty, wine.quantity)  # Can't consume more than available
+    qty = min(qty, inventory.held(wine))  # Can't consume more than available
+    if qty < 1:
+        flash(f'There are no bottles of {wine.name} left to consume.', 'warning')
+        return redirect(url_for('wine_detail', wine_id=wine.id))
 
     # Build tasting note description from form fields
     note_parts = []
@@ -611,46 +662,24 @@ def consume_wine(wine_id):
     to_year = request.form.get('toYear', '').strip()
     drink_now = request.form.get('drinkNow', '')
 
-    # Create consumed wine copy / update original
-    if wine.quantity > qty:
-        wine.quantity -= qty
-        # Create a consumed copy
-        consumed = Wine(
-            user_id=current_user.id,
-            name=wine.name, producer=wine.producer, vintage=wine.vintage,
-            wine_type=wine.wine_type, appellation=wine.appellation,
-            varietal1=wine.varietal1, varietal2=wine.varietal2,
-            varietal3=wine.varietal3, varietal4=wine.varietal4,
-            size_ml=wine.size_ml, alcohol_pct=wine.alcohol_pct,
-            description=wine.description,
-            price=wine.price, quantity=qty,
-            acq_from=wine.acq_from, stored=wine.stored,
-            status='consumed', rating=score if score else wine.rating,
-            date_consumed=consume_date,
-            drink_from=int(from_year) if from_year else wine.drink_from,
-            drink_to=int(to_year) if to_year else wine.drink_to,
-            parent_wine_id=wine.id
-        )
-        db.session.add(consumed)
-        db.session.flush()
-        consumed_wine_id = consumed.id
-    else:
-        wine.status = 'consumed'
-        wine.date_consumed = consume_date
-        wine.quantity = qty
-        if score:
-            wine.rating = score
-        if from_year:
-            wine.drink_from = int(from_year)
-        if to_year:
-            wine.drink_to = int(to_year)
-        consumed_wine_id = wine.id
+    # Record the consumption on the wine itself; the last bottle marks it
+    # consumed.  Another request may have taken bottles since wine was read.
+    if inventory.record(wine, inventory.CONSUME, qty, on=consume_date, party=participants or None) is None:
+        db.session.rollback()
+        flash(f'Only {wine.quantity or 0} bottle(s) of {wine.name} left; nothing was removed.', 'warning')
+        return redirect(url_for('wine_detail', wine_id=wine.id))
+    if score:
+        wine.rating = score
+    if from_year:
+        wine.drink_from = int(from_year)
+    if to_year:
+        wine.drink_to = int(to_year)
 
     # Create tasting note if any tasting data was provided
     overall_text = '; '.join(filter(None, [overall_impression] + note_parts))
     if any([appearance, nose_text, palate_text, overall_text, score]):
         note = TastingNote(
-            wine_id=consumed_wine_id,
+            wine_id=wine.id,
             user_id=current_user.id,
             tasting_date=consume_date,
             appearance=appearance or None,
@@ -691,9 +720,42 @@ def add_tasting_note(wine_id):
 @app.route('/tastings')
 @login_required
 def tasting_list():
-    notes = TastingNote.query.filter_by(user_id=current_user.id)\
-        .order_by(TastingNote.tasting_date.desc()).all()
-    return render_template('tastings.html', notes=notes)
+    filter_form = TastingFilterForm(request.args)
+
+    # Join each note's wine in the same query instead of one lazy load per note
+    query = TastingNote.query.join(TastingNote.wine)\
+        .options(contains_eager(TastingNote.wine))\
+        .filter(TastingNote.user_id == current_user.id)
+    if filter_form.from_date.data:
+        query = query.filter(TastingNote.tasting_date >= filter_form.from_date.data)
+    if filter_form.to_date.data:
+        query = query.filter(TastingNote.tasting_date <= filter_form.to_date.data)
+    if filter_form.min_score.data:
+        query = query.filter(TastingNote.score >= filter_form.min_score.data)
+    if filter_form.max_score.data:
+        query = query.filter(TastingNote.score <= filter_form.max_score.data)
+
+    total_notes = query.with_entities(func.count(TastingNote.id)).order_by(None).scalar()
+
+    submit_action = request.args.get('submitAction', '')
+    page = int(request.args.get('page', 1))
+    after = before = None
+    if submit_action == 'Next':
+        page = page + 1
+        after = request.args.get('after')
+    elif submit_action == 'Previous':
+        page = max(1, page - 1)
+        before = request.args.get('before')
+    elif submit_action == 'Filter':
+        page = 1
+
+    result = paginate(query, TastingNote.tasting_date, TastingNote.id, total_notes, page=page,
+                      sort_key='tasting_date:desc', descending=True, id_descending=True,
+                      after=after, before=before)
+    return render_template('tastings.html', notes=result.items, filter_form=filter_form,
+                           page=result.page, total_pages=result.total_pages,
+                           next_cursor=result.next_cursor, prev_cursor=result.prev_cursor,
+                           total_notes=total_notes)
 
 
 # ─── Statistics ───────────────────────────────────────────────────
@@ -701,54 +763,10 @@ def tasting_list():
 @app.route('/stats')
 @login_required
 def stats():
-    cellar_wines = current_user.wines.filter_by(status='cellar').filter(
-        db.or_(Wine.on_order == False, Wine.on_order.is_(None))
-    ).all()
-    consumed_wines = current_user.wines.filter_by(status='consumed').all()
-
-    total_bottles = sum(w.quantity for w in cellar_wines)
-    total_value = sum((w.price or 0) * w.quantity for w in cellar_wines)
-    avg_price = total_value / total_bottles if total_bottles > 0 else 0
-
-    # By type
-    type_breakdown = {}
-    for w in cellar_wines:
-        type_breakdown[w.wine_type] = type_breakdown.get(w.wine_type, 0) + w.quantity
-
-    # By appellation
-    appellation_breakdown = {}
-    for w in cellar_wines:
-        key = w.appellation or 'Unknown'
-        appellation_breakdown[key] = appellation_breakdown.get(key, 0) + w.quantity
-
-    # By varietal (use varietal1 as primary)
-    varietal_breakdown = {}
-    for w in cellar_wines:
-        key = w.varietal1 or 'Unknown'
-        varietal_breakdown[key] = varietal_breakdown.get(key, 0) + w.quantity
-
-    # Top rated
-    top_rated = sorted([w for w in cellar_wines if w.rating], key=lambda w: w.rating, reverse=True)[:10]
-
-    # Ready to drink count
-    current_year = date.today().year
-    ready_count = sum(1 for w in cellar_wines if w.is_ready_to_drink)
-
-    # Sort breakdowns by count
-    type_breakdown = dict(sorted(type_breakdown.items(), key=lambda x: x[1], reverse=True))
-    appellation_breakdown = dict(sorted(appellation_breakdown.items(), key=lambda x: x[1], reverse=True))
-    varietal_breakdown = dict(sorted(varietal_breakdown.items(), key=lambda x: x[1], reverse=True))
-
+    figures = cellar_stats(current_user.id)
     return render_template('stats.html',
-                           total_bottles=total_bottles,
-                           total_value=total_value,
-                           avg_price=avg_price,
-                           consumed_count=len(consumed_wines),
-                           type_breakdown=type_breakdown,
-                           appellation_breakdown=appellation_breakdown,
-                           varietal_breakdown=varietal_breakdown,
-                           top_rated=top_rated,
-                           ready_count=ready_count)
+                           top_rated=top_rated(current_user.id),
+                           **figures)
 
 
 # ─── Search ───────────────────────────────────────────────────────
@@ -760,33 +778,22 @@ def search():
     wines = []
     if any([form.query.data, form.wine_type.data, form.appellation.data, form.varietal.data]):
         query = current_user.wines
-        if form.query.data:
-            search_term = f"%{form.query.data}%"
-            query = query.filter(
-                db.or_(
-                    Wine.name.ilike(search_term),
-                    Wine.producer.ilike(search_term),
-                    Wine.varietal1.ilike(search_term),
-                    Wine.varietal2.ilike(search_term),
-                    Wine.appellation.ilike(search_term)
-                )
-            )
         if form.wine_type.data:
             query = query.filter_by(wine_type=form.wine_type.data)
         if form.appellation.data:
             query = query.filter(Wine.appellation.ilike(f"%{form.appellation.data}%"))
         if form.varietal.data:
-            vterm = f"%{form.varietal.data}%"
-            query = query.filter(
-                db.or_(
-                    Wine.varietal1.ilike(vterm),
-                    Wine.varietal2.ilike(vterm),
-                    Wine.varietal3.ilike(vterm),
-                    Wine.varietal4.ilike(vterm)
-                )
-            )
-        wines = query.order_by(Wine.name).all()
-    return render_template('search.html', form=form, wines=wines)
+            query = query.filter(wine_varietals.has_varietal(form.varietal.data))
+        if form.query.data:
+            query = search_index.rank_wines(query, form.query.data)
+        else:
+            query = query.order_by(Wine.name)
+        wines = _with_maturity(query).all()
+    # A consumed wine's Qty is the bottles drunk, from the inventory ledger
+    consumed_ids = [w.id for w in wines if w.status == 'consumed']
+    consumed = inventory.consumed_from(consumed_ids) if consumed_ids else {}
+    return render_template('search.html', form=form, wines=wines, consumed=consumed,
+                           facets=wine_facets(current_user.id))
 
 
 # ─── Quick Entry ──────────────────────────────────────────────────
@@ -816,6 +823,7 @@ def quick_entry():
                     status='cellar'
                 )
                 db.session.add(wine)
+                inventory.open_balance(wine)
                 count += 1
 
         db.session.commit()
@@ -830,254 +838,110 @@ def quick_entry():
 @login_required
 def cellar_import():
     if request.method == 'POST':
-        import csv
-        from io import StringIO, TextIOWrapper
-
         file = request.files.get('csv_file')
         if not file or not file.filename.endswith('.csv'):
             flash('Please upload a valid CSV file.', 'danger')
             return redirect(url_for('cellar_import'))
 
-        try:
-            content = file.stream.read().decode('utf-8-sig')
-            reader = csv.reader(StringIO(content))
-
-            # Find the header row
-            header = None
-            for row in reader:
-                cleaned = [c.strip() for c in row]
-                if 'Name' in cleaned and 'Producer' in cleaned:
-                    header = cleaned
-                    break
-
-            if not header:
-                flash('Could not find header row with Name and Producer columns.', 'danger')
-                return redirect(url_for('cellar_import'))
-
-            # Map column indices
-            col = {}
-            for i, h in enumerate(header):
-                col[h.lower()] = i
-
-            wine_count = 0
-            note_count = 0
-
-            # Track wines we create so we can attach tasting notes to consumed copies
-            wine_cache = {}  # key: (vintage, name, producer) -> wine_id
-
-            for row in reader:
-                if len(row) < len(header):
-                    row.extend([''] * (len(header) - len(row)))
-
-                name = row[col.get('name', 1)].strip() if col.get('name') is not None else ''
-                producer = row[col.get('producer', 2)].strip() if col.get('producer') is not None else ''
-                if not name or not producer:
-                    continue
-
-                vintage_str = row[col.get('vintage', 0)].strip() if col.get('vintage') is not None else ''
-                appellation = row[col.get('appellation', 3)].strip() if col.get('appellation') is not None else ''
-                varietal_str = row[col.get('varietal', 4)].strip() if col.get('varietal') is not None else ''
-                size_str = row[col.get('size', 5)].strip() if col.get('size') is not None else ''
-                qty_str = row[col.get('quantity', 6)].strip() if col.get('quantity') is not None else ''
-                price_str = row[col.get('price', 7)].strip() if col.get('price') is not None else ''
-                stored = row[col.get('stored', 8)].strip() if col.get('stored') is not None else ''
-                notes = row[col.get('notes', 9)].strip() if col.get('notes') is not None else ''
-
-                vintage = None
-                if vintage_str:
-                    try:
-                        vintage = int(vintage_str)
-                    except ValueError:
-                        pass
-
-                # Parse varietals (split by hyphen)
-                varietals = [v.strip() for v in varietal_str.split('-') if v.strip()] if varietal_str else []
-
-                size_ml = 750
-                if size_str:
-                    try:
-                        size_ml = int(size_str)
-                    except ValueError:
-                        pass
-
-                price = None
-                if price_str:
-                    try:
-                        price = float(price_str)
-                    except ValueError:
-                        pass
-
-                # Determine wine type from varietals
-                white_grapes = {'Chardonnay', 'Sauvignon Blanc', 'Pinot Grigio', 'Pinot Gris',
-                                'Riesling', 'Gewürztraminer', 'Viognier', 'Sémillon', 'Aligoté',
-                                'Pinot Blanc', 'Chenin Blanc', 'Muscat', 'Grenache Blanc',
-                                'Roussanne', 'Marsanne', 'Falanghina', 'Prosecco', 'Xarel-Lo',
-                                'Macabeo', 'Parellada', 'Grenache Gris', 'Vermentino'}
-                sparkling_keywords = {'Champagne', 'Brut', 'Sparkling', 'Prosecco', 'Franciacorta'}
-                dessert_keywords = {'Sauternes', 'Barsac'}
-
-                wine_type = 'Red'
-                if any(kw.lower() in name.lower() for kw in sparkling_keywords):
-                    wine_type = 'Sparkling'
-                elif any(kw.lower() in appellation.lower() for kw in dessert_keywords):
-                    wine_type = 'Dessert'
-                elif varietals and all(v in white_grapes for v in varietals):
-                    wine_type = 'White'
-                elif 'Rosé' in name or 'Rose' in name:
-                    wine_type = 'Rosé'
-
-                cache_key = (vintage, name, producer)
-
-                if qty_str:
-                    # This is a cellar entry
-                    quantity = int(qty_str) if qty_str else 1
-
-                    wine = Wine(
-                        user_id=current_user.id,
-                        name=name,
-                        producer=producer,
-                        vintage=vintage,
-                        appellation=appellation,
-                        wine_type=wine_type,
-                        varietal1=varietals[0] if len(varietals) > 0 else None,
-                        varietal2=varietals[1] if len(varietals) > 1 else None,
-                        varietal3=varietals[2] if len(varietals) > 2 else None,
-                        varietal4=varietals[3] if len(varietals) > 3 else None,
-                        size_ml=size_ml,
-                        quantity=quantity,
-                        price=price,
-                        stored=stored,
-                        description=notes if notes and 'Brad & Erica Sklar' not in notes else None,
-                        status='cellar'
-                    )
-                    db.session.add(wine)
-                    db.session.flush()
-                    wine_cache[cache_key] = wine.id
-                    wine_count += 1
-
-                    # If there are tasting notes in the notes field for cellar wines
-                    if notes and 'Brad & Erica Sklar' in notes:
-                        _create_tasting_note(wine.id, current_user.id, notes)
-                        note_count += 1
-
-                elif notes:
-                    # This is a consumed entry with tasting notes
-                    # Find or create a consumed wine entry
-                    wine_id = wine_cache.get(cache_key)
-                    if not wine_id:
-                        # Create consumed wine
-                        wine = Wine(
-                            user_id=current_user.id,
-                            name=name,
-                            producer=producer,
-                            vintage=vintage,
-                            appellation=appellation,
-                            wine_type=wine_type,
-                            varietal1=varietals[0] if len(varietals) > 0 else None,
-                            varietal2=varietals[1] if len(varietals) > 1 else None,
-                            varietal3=varietals[2] if len(varietals) > 2 else None,
-                            varietal4=varietals[3] if len(varietals) > 3 else None,
-                            size_ml=size_ml,
-                            price=price,
-                            stored=stored,
-                            quantity=1,
-                            status='consumed'
-                        )
-                        db.session.add(wine)
-                        db.session.flush()
-                        wine_cache[cache_key] = wine.id
-                        wine_id = wine.id
-                        wine_count += 1
-
-                    _create_tasting_note(wine_id, current_user.id, notes)
-                    note_count += 1
+        # The file is imported by a background job; uploading the same file
+        # again resumes an import that was interrupted
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        path = os.path.join(app.config['UPLOAD_FOLDER'], f'{uuid.uuid4().hex}.csv')
+        file.save(path)
+        with open(path, 'rb') as f:
+            fingerprint = csv_import.file_fingerprint(f)
+        job = jobs.enqueue('import', current_user.id, {
+            'path': path, 'filename': file.filename, 'fingerprint': fingerprint,
+        })
+        flash(f'Import of {file.filename} queued.', 'info')
+        return redirect(url_for('job_status', job_id=job.id))
 
-            db.session.commit()
-            flash(f'Import complete: {wine_count} wines and {note_count} tasting notes imported!', 'success')
-            return redirect(url_for('cellar'))
+    return render_template('cellar_import.html', can_replay=_can_replay(current_user))
 
-        except Exception as e:
-            db.session.rollback()
-            flash(f'Import error: {str(e)}', 'danger')
-            return redirect(url_for('cellar_import'))
 
-    return render_template('cellar_import.html')
+def _can_replay(user):
+    """wine_transactions.json is one account's scraped history; only that
+    account may replay it onto its wines."""
+    return user.username == apply_transactions.TXN_USER
 
 
-def _create_tasting_note(wine_id, user_id, notes_text):
-    """Parse tasting note text from ManageYourCellar CSV format and create a TastingNote."""
-    import re
+@app.route('/transactions/replay', methods=['POST'])
+@login_required
+def replay_transactions():
+    if not _can_replay(current_user):
+        abort(403)
+    if not os.path.exists(apply_transactions.TXN_PATH):
+        flash('No transaction history file to replay.', 'danger')
+        return redirect(url_for('cellar_import'))
+    job = jobs.enqueue('replay', current_user.id)
+    flash('Transaction replay queued.', 'info')
+    return redirect(url_for('job_status', job_id=job.id))
+
+
+# ─── Background Jobs ──────────────────────────────────────────────
+
+@app.before_request
+def _start_job_workers():
+    jobs.start(app)
+
+
+@jobs.handler('import')
+def _import_job(job, params):
+    run = csv_import.start_run(job.user_id, params['filename'], params['fingerprint'])
+    resumed_from = run.rows_done
+    with open(params['path'], encoding='utf-8-sig', newline='') as f:
+        total = csv_import.count_rows(f)
+        f.seek(0)
+        jobs.report(job, run.rows_done, total,
+                    f'Resuming after row {resumed_from}' if resumed_from else 'Starting')
+        csv_import.run_import(run, f, progress=lambda r: jobs.report(
+            job, r.rows_done, message=f'{r.wines} wines, {r.notes} tasting notes, {r.error_count} errors'))
+    # A failed import keeps its file so the job can be retried
+    os.remove(params['path'])
+    return {'wines': run.wines, 'notes': run.notes, 'resumed_from': resumed_from,
+            'error_count': run.error_count, 'errors': (run.errors or '').splitlines()[:20]}
+
+
+@jobs.handler('replay')
+def _replay_job(job, params):
+    txns = apply_transactions.load_transactions()
+    if txns is None:
+        raise FileNotFoundError('wine_transactions.json not found')
+    user = db.session.get(User, job.user_id)
+    if not _can_replay(user):
+        raise PermissionError(f'{user.username} may not replay {apply_transactions.TXN_USER}\'s transactions')
+    log = []
+    result = apply_transactions.replay_transactions(
+        user, txns, log=log.append,
+        progress=lambda step, steps, message: jobs.report(job, step, steps, message))
+    result['log'] = log
+    return result
+
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.user_id != current_user.id:
+        abort(404)
+    wants_json = request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json'
+    if wants_json or request.args.get('format') == 'json':
+        return jsonify(job.to_dict())
+    return render_template('job.html', job=job, info=job.to_dict())
 
-    # Parse "Brad & Erica Sklar: X stars  occasion description details"
-    # or "Brad & Erica Sklar: X points  description"
-    score = None
-    overall = notes_text
-
-    # Extract star rating
-    star_match = re.search(r'(\d+(?:\.\d+)?)\s*stars?', notes_text)
-    if star_match:
-        stars = float(star_match.group(1))
-        score = int(stars * 20)  # Convert 5-star to 100 scale
-
-    # Extract point rating
-    point_match = re.search(r'(\d+)\s*points?', notes_text)
-    if point_match:
-        score = int(point_match.group(1))
-
-    # Clean up the text - remove the author prefix
-    overall = re.sub(r'^\s*Brad\s*&\s*Erica\s*Sklar:\s*', '', overall)
-    overall = re.sub(r'^\d+(?:\.\d+)?\s*(?:stars?|points?)\s*', '', overall)
-    overall = overall.strip()
-
-    # Try to parse out tasting descriptors
-    appearance = None
-    nose = None
-    palate = None
-
-    # Look for common tasting words
-    descriptors = {
-        'pale': 'appearance', 'bright': 'appearance', 'deep': 'appearance',
-        'dark': 'appearance', 'evolved': 'appearance',
-        'fragrant': 'nose', 'floral': 'nose', 'complex': 'nose',
-        'intense': 'nose', 'discreet': 'nose', 'nutty': 'nose',
-        'supple': 'palate', 'crisp': 'palate', 'lively': 'palate',
-        'tannic': 'palate', 'flat': 'palate', 'woody': 'palate',
-        'light-bodied': 'palate', 'medium-bodied': 'palate',
-        'full-bodied': 'palate', 'alcoholic': 'palate',
-    }
 
-    appearance_words = []
-    nose_words = []
-    palate_words = []
-
-    for word in overall.lower().split():
-        word_clean = word.strip(',.;:')
-        if word_clean in descriptors:
-            cat = descriptors[word_clean]
-            if cat == 'appearance':
-                appearance_words.append(word_clean)
-            elif cat == 'nose':
-                nose_words.append(word_clean)
-            elif cat == 'palate':
-                palate_words.append(word_clean)
-
-    if appearance_words:
-        appearance = ', '.join(appearance_words)
-    if nose_words:
-        nose = ', '.join(nose_words)
-    if palate_words:
-        palate = ', '.join(palate_words)
-
-    note = TastingNote(
-        wine_id=wine_id,
-        user_id=user_id,
-        appearance=appearance,
-        nose=nose,
-        palate=palate,
-        overall=overall if overall else None,
-        score=score
-    )
-    db.session.add(note)
+@app.route('/jobs/<int:job_id>/retry', methods=['POST'])
+@login_required
+def retry_job(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.user_id != current_user.id or job.status != 'failed':
+        abort(404)
+    params = json.loads(job.params or '{}')
+    if job.kind == 'import' and not os.path.exists(params.get('path', '')):
+        flash('The uploaded file is gone; upload it again to resume.', 'danger')
+        return redirect(url_for('cellar_import'))
+    retry = jobs.enqueue(job.kind, current_user.id, params)
+    return redirect(url_for('job_status', job_id=retry.id))
 
 
 # ─── Export ───────────────────────────────────────────────────────
@@ -1085,40 +949,81 @@ def _create_tasting_note(wine_id, user_id, notes_text):
 @app.route('/export')
 @login_required
 def export_cellar():
-    import csv
-    from io import StringIO
-    from flask import Response
-
-    wines = current_user.wines.order_by(Wine.status, Wine.name).all()
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow(['Name', 'Vintage', 'Producer', 'Type', 'Appellation',
-                     'Varietal1', 'Varietal2', 'Varietal3', 'Varietal4',
-                     'Size (ml)', 'Alcohol %', 'Description',
-                     'Acq Date', 'Quantity', 'Price', 'From', 'On Order',
-                     'Stored', 'Acq Description', 'Status', 'Rating',
-                     'Drink From', 'Drink To'])
-    for w in wines:
-        writer.writerow([w.name, w.vintage, w.producer, w.wine_type, w.appellation,
-                         w.varietal1, w.varietal2, w.varietal3, w.varietal4,
-                         w.size_ml, w.alcohol_pct, w.description,
-                         w.acq_date, w.quantity, w.price, w.acq_from,
-                         'Yes' if w.on_order else 'No',
-                         w.stored, w.acq_description, w.status, w.rating,
-                         w.drink_from, w.drink_to])
-
-    output = si.getvalue()
-    return Response(output, mimetype='text/csv',
-                    headers={'Content-Disposition': 'attachment;filename=cellar_export.csv'})
+    """Stream the user's wines as CSV, optionally filtered by ?status= and
+    ?type=, gzip-compressed when the client accepts it."""
+    status = request.args.get('status') or None
+    if status not in (None, 'cellar', 'consumed', 'wishlist'):
+        status = None
+    wine_type = request.args.get('type') or None
+
+    chunks = csv_chunks(current_user.id, status=status, wine_type=wine_type)
+    headers = {'Content-Disposition': 'attachment;filename=cellar_export.csv',
+               'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype='text/csv', headers=headers)
 
 
 # ─── API Endpoints ────────────────────────────────────────────────
 
+# Fields a client can request with ?fields=: (columns to load, value getter)
+_API_FIELDS = {
+    'id': ((), lambda w: w.id),
+    'name': (('name',), lambda w: w.name),
+    'producer': (('producer',), lambda w: w.producer),
+    'vintage': (('vintage',), lambda w: w.vintage),
+    'type': (('wine_type',), lambda w: w.wine_type),
+    'varietal': (('varietal1', 'varietal2', 'varietal3', 'varietal4'), lambda w: w.varietals_display),
+    'appellation': (('appellation',), lambda w: w.appellation),
+    'size_ml': (('size_ml',), lambda w: w.size_ml),
+    'rating': (('rating',), lambda w: w.rating),
+    'price': (('price',), lambda w: w.price),
+    'quantity': (('quantity',), lambda w: w.quantity),
+    'status': (('status',), lambda w: w.status),
+    'on_order': (('on_order',), lambda w: bool(w.on_order)),
+    'drink_from': (('drink_from',), lambda w: w.drink_from),
+    'drink_to': (('drink_to',), lambda w: w.drink_to),
+    'maturity': (('drink_from', 'drink_to', 'maturity_override'), lambda w: w.maturity_display),
+}
+
+_API_DEFAULT_FIELDS = ['id', 'name', 'producer', 'vintage', 'type', 'varietal',
+                       'rating', 'price', 'quantity']
+
+_API_MAX_LIMIT = 200
+
+
+def _api_etag():
+    """Strong ETag for the current user's wines as seen through this URL."""
+    version = wine_versions.current(current_user.id)
+    args = '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True)))
+    # Maturity depends on the year as well as the wines
+    raw = f'{current_user.id}:{version}:{as_of_year()}:{request.path}?{args}'
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _conditional_json(etag, payload):
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @app.route('/api/wines')
 @login_required
 def api_wines():
+    etag = _api_etag()
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
     wines = current_user.wines.filter_by(status='cellar').all()
-    return jsonify([{
+    return _conditional_json(etag, [{
         'id': w.id, 'name': w.name, 'producer': w.producer,
         'vintage': w.vintage, 'type': w.wine_type,
         'varietal': w.varietals_display, 'rating': w.rating,
@@ -1126,54 +1031,88 @@ def api_wines():
     } for w in wines])
 
 
-# ─── Initialize ───────────────────────────────────────────────────
-
-def init_db():
-    with app.app_context():
-        db.create_all()
-        # Ensure new columns exist (for SQLite upgrades)
-        import sqlite3
-        db_uri = app.config['SQLALCHEMY_DATABASE_URI']
-        db_path = db_uri.replace('sqlite:///', '')
-        try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA table_info(wines)")
-            cols = [row[1] for row in cursor.fetchall()]
-            if 'parent_wine_id' not in cols:
-                cursor.execute("ALTER TABLE wines ADD COLUMN parent_wine_id INTEGER REFERENCES wines(id)")
-            if 'original_quantity' not in cols:
-                cursor.execute("ALTER TABLE wines ADD COLUMN original_quantity INTEGER")
-            if 'producer_url' not in cols:
-                cursor.execute("ALTER TABLE wines ADD COLUMN producer_url VARCHAR(300)")
-            if 'maturity_override' not in cols:
-                cursor.execute("ALTER TABLE wines ADD COLUMN maturity_override VARCHAR(30)")
-            if 'acq_price' not in cols:
-                cursor.execute("ALTER TABLE wines ADD COLUMN acq_price FLOAT")
-            conn.commit()
-
-            # Tasting notes migration
-            cursor.execute("PRAGMA table_info(tasting_notes)")
-            tn_cols = [row[1] for row in cursor.fetchall()]
-            for col in ['description', 'participants', 'recommended_with']:
-                if col not in tn_cols:
-                    cursor.execute(f"ALTER TABLE tasting_notes ADD COLUMN {col} TEXT")
-            conn.commit()
-            conn.close()
-        except Exception:
-            pass
-        # Auto-seed if DB is empty (handles Render's ephemeral /tmp)
-        from models import User
-        if not User.query.first():
-            try:
-                from seed import seed_database
-                seed_database()
-            except Exception as e:
-                print(f"Seed error: {e}")
+@app.route('/api/v1/wines')
+@login_required
+def api_v1_wines():
+    """One page of the user's wines.
+
+    Takes the /cellar filters (status plus the SearchForm fields),
+    ``fields=`` (comma-separated, see _API_FIELDS), ``limit=`` and the
+    ``after``/``page`` pair from the previous response's ``next`` link.
+    Responses carry a strong ETag that changes only when the user's wines
+    do, and ``If-None-Match`` gets a 304 without touching the wines.
+    """
+    etag = _api_etag()
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+    unknown = [f for f in fields if f not in _API_FIELDS]
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(unknown)}",
+                        'fields': sorted(_API_FIELDS)}), 400
+    fields = fields or _API_DEFAULT_FIELDS
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), _API_MAX_LIMIT)
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        return jsonify({'error': 'limit and page must be integers'}), 400
 
+    status = request.args.get('status', 'cellar')
+    search_form = SearchForm(request.args)
+    query = _apply_search_filters(_status_query(status), search_form)
+    sort_by, sort_order = _sort_options(search_form)
+
+    total = query.with_entities(func.count(Wine.id)).order_by(None).scalar()
+    columns = [getattr(Wine, c) for f in fields for c in _API_FIELDS[f][0]]
+    query = query.options(load_only(*columns)) if columns else query.options(load_only(Wine.id))
+    result = paginate(query, _sort_column(sort_by), Wine.id, total, page=page,
+                      sort_key=f'{sort_by}:{sort_order}', descending=(sort_order == 'desc'),
+                      after=request.args.get('after'), per_page=limit)
+
+    next_url = None
+    if result.next_cursor:
+        args = request.args.to_dict()
+        args.update(after=result.next_cursor, page=result.page + 1)
+        next_url = url_for('api_v1_wines', **args)
+    wines = [{f: _API_FIELDS[f][1](w) for f in fields} for w in result.items]
+    if status == 'consumed' and 'quantity' in fields:
+        # As on the consumed tab: bottles drunk rather than those left
+        consumed = inventory.consumed_from([w.id for w in result.items])
+        for row, w in zip(wines, result.items):
+            row['quantity'] = consumed.get(w.id, 0)
+    return _conditional_json(etag, {
+        'wines': wines,
+        'total': total,
+        'page': result.page,
+        'total_pages': result.total_pages,
+        'next_cursor': result.next_cursor,
+        'next': next_url,
+    })
+
+
+@app.route('/api/v1/forecast')
+@login_required
+def api_v1_forecast():
+    """Bottles entering, inside and leaving their drinking window for each
+    year from ``from=`` (default this year) for ``years=`` years."""
+    etag = _api_etag()
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+    try:
+        start = int(request.args.get('from', as_of_year()))
+        years = min(max(int(request.args.get('years', drinking_windows.YEARS)), 1),
+                    drinking_windows.MAX_YEARS)
+    except ValueError:
+        return jsonify({'error': 'from and years must be integers'}), 400
+    return _conditional_json(etag, {
+        'years': [y.as_dict() for y in drinking_windows.forecast(current_user.id, start, years)],
+    })
 
-# Always initialize on import (needed for gunicorn)
-init_db()
 
 if __name__ == '__main__':
+    # Deployments run `python migrations.py` before starting the workers
+    migrations.restore_snapshot(app)
+    migrations.upgrade(app)
+    migrations.seed_if_empty(app)
     app.run(debug=True, port=5000)
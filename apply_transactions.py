@@ -7,32 +7,16 @@ This script:
 4. Creates missing consumed wine records for consumption events in the transaction data
 """
 import json
-import re
 import os
 from datetime import datetime, date
-from app import app, db
-from models import User, Wine
-
-
-def parse_wine_name(full_name):
-    """Parse '2015 Almaviva (Proprietary Blend) (750ml) RATED' into (vintage, name)."""
-    full_name = full_name.strip()
-    # Remove RATED suffix
-    full_name = re.sub(r'\s*RATED\s*$', '', full_name)
-    # Try to extract vintage and size
-    m = re.match(r'^(\d{4})\s+(.+?)\s*\((\d+(?:\.\d+)?(?:ml|l))\)\s*$', full_name)
-    if m:
-        return int(m.group(1)), m.group(2).strip()
-    # Try without size
-    m2 = re.match(r'^(\d{4})\s+(.+?)$', full_name)
-    if m2:
-        name = m2.group(2).strip()
-        # Remove trailing (750ml) etc if present
-        name = re.sub(r'\s*\(\d+(?:\.\d+)?(?:ml|l)\)\s*$', '', name).strip()
-        return int(m2.group(1)), name
-    # No vintage
-    name = re.sub(r'\s*\(\d+(?:\.\d+)?(?:ml|l)\)\s*$', '', full_name).strip()
-    return None, name
+from models import db, User, Wine
+from wine_names import parse as parse_wine_name, name_key
+import inventory
+from migrations import upgrade
+
+TXN_PATH = os.path.join(os.path.dirname(__file__), 'wine_transactions.json')
+# The account wine_transactions.json was scraped from
+TXN_USER = 'bread'
 
 
 def parse_date_str(date_str):
@@ -45,70 +29,111 @@ def parse_date_str(date_str):
         return None
 
 
-def normalize_name(name):
-    """Normalize a wine name for fuzzy matching."""
-    if not name:
-        return ''
-    # Lowercase, strip, remove extra spaces
-    n = re.sub(r'\s+', ' ', name.lower().strip())
-    # Remove common punctuation variations
-    n = n.replace("'", "'").replace("'", "'").replace('"', '')
-    return n
-
-
-def apply_transactions():
-    with app.app_context():
-        # Ensure new columns exist
-        db.create_all()
-
-        user = User.query.filter_by(username='bread').first()
-        if not user:
-            print("User 'bread' not found!")
-            return
-
-        # Load transaction data
-        txn_path = os.path.join(os.path.dirname(__file__), 'wine_transactions.json')
-        if not os.path.exists(txn_path):
-            print("wine_transactions.json not found!")
-            return
-
-        with open(txn_path) as f:
-            txns = json.load(f)
-        print(f"Loaded {len(txns)} transaction records")
-
-        # Get all cellar wines for bread
-        cellar_wines = Wine.query.filter_by(user_id=user.id, status='cellar').filter(
-            db.or_(Wine.on_order == False, Wine.on_order.is_(None))
-        ).all()
-        print(f"Found {len(cellar_wines)} cellar wines in DB")
-
-        # Get all consumed wines for bread
-        consumed_wines = Wine.query.filter_by(user_id=user.id, status='consumed').all()
-        print(f"Found {len(consumed_wines)} consumed wines in DB")
-
-        # Build lookup for cellar wines by normalized (vintage, name)
-        cellar_lookup = {}
-        for w in cellar_wines:
-            key = (w.vintage, normalize_name(w.name))
-            cellar_lookup[key] = w
-
+# Names are compared on at most this many leading characters when an exact
+# (vintage, name) match fails
+FUZZY_PREFIX = 20
+
+
+class CellarMatcher:
+    """Cellar wines indexed for matching transaction names.
+
+    Exact matches use a dict on (vintage, normalized name).  The fuzzy
+    fallback -- the first cellar wine of the same vintage whose name's
+    first FUZZY_PREFIX characters start the transaction's name -- uses a
+    per-vintage dict keyed by that prefix, so a lookup probes at most
+    FUZZY_PREFIX + 1 prefixes of the name instead of scanning every wine.
+    """
+
+    def __init__(self, wines):
+        self.exact = {}
+        self._rank = {}      # key -> position of its first wine
+        self._prefixes = {}  # vintage -> {name prefix: earliest key with it}
+        for w in wines:
+            key = (w.vintage, name_key(w.name))
+            if key not in self._rank:
+                self._rank[key] = len(self._rank)
+                self._prefixes.setdefault(key[0], {}).setdefault(key[1][:FUZZY_PREFIX], key)
+            self.exact[key] = w
+
+    def match(self, vintage, name):
+        """The cellar wine for a normalized transaction name, or None."""
+        wine = self.exact.get((vintage, name))
+        if wine:
+            return wine
+        prefixes = self._prefixes.get(vintage)
+        if not prefixes:
+            return None
+        keys = [prefixes[name[:n]] for n in range(min(len(name), FUZZY_PREFIX) + 1)
+                if name[:n] in prefixes]
+        if not keys:
+            return None
+        return self.exact[min(keys, key=self._rank.__getitem__)]
+
+
+def load_transactions(path=TXN_PATH):
+    """The scraped transaction records, or None if the file is missing."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def replay_transactions(user, txns, log=print, progress=None):
+    """Apply ``txns`` to ``user``'s wines and commit.
+
+    ``log`` receives the step-by-step report; ``progress(step, steps,
+    message)`` is called as each of the four steps finishes.  Returns the
+    step counts.
+    """
+    def step_done(step, message):
+        if progress:
+            progress(step, 4, message)
+
+    # Get all cellar wines for the user
+    cellar_wines = Wine.query.filter_by(user_id=user.id, status='cellar').filter(
+        db.or_(Wine.on_order == False, Wine.on_order.is_(None))
+    ).order_by(Wine.id).all()
+    log(f"Found {len(cellar_wines)} cellar wines in DB")
+
+    # Get all consumed wines for the user
+    consumed_wines = Wine.query.filter_by(user_id=user.id, status='consumed').order_by(Wine.id).all()
+    log(f"Found {len(consumed_wines)} consumed wines in DB")
+
+    matcher = CellarMatcher(cellar_wines)
+
+    # Consumed copies grouped by parent (in id order, new records last), and
+    # unlinked consumed wines by (vintage, normalized name)
+    copies_by_parent = {}
+    unlinked = {}
+    for cw in sorted(consumed_wines, key=lambda w: w.id):
+        if cw.parent_wine_id:
+            copies_by_parent.setdefault(cw.parent_wine_id, []).append(cw)
+        else:
+            unlinked.setdefault((cw.vintage, name_key(cw.name)), []).append(cw)
+
+    # Consumptions already in the inventory ledger, by wine
+    recorded = inventory.consumptions_by_wine(user.id)
+
+    def link(cw, parent):
+        cw.parent_wine_id = parent.id
+        copies_by_parent.setdefault(parent.id, []).append(cw)
+        unlinked[(cw.vintage, name_key(cw.name))].remove(cw)
+
+    # Parse every transaction name once
+    parsed = []
+    for txn in txns:
+        if 'error' in txn:
+            continue
+        vintage, name, _ = parse_wine_name(txn['wine_name'])
+        parsed.append((txn, vintage, name_key(name)))
+
+    # Everything below works on loaded objects; changes go out in one flush
+    with db.session.no_autoflush:
         # Step 1: Match cellar wines to transaction records and update acquisition data
         matched = 0
         unmatched_txns = []
-        for txn in txns:
-            if 'error' in txn:
-                continue
-            vintage, name = parse_wine_name(txn['wine_name'])
-            key = (vintage, normalize_name(name))
-            wine = cellar_lookup.get(key)
-
-            if not wine:
-                # Try fuzzy match - remove trailing size info
-                for ckey, cw in cellar_lookup.items():
-                    if ckey[0] == vintage and normalize_name(name).startswith(ckey[1][:20]):
-                        wine = cw
-                        break
-
+        for txn, vintage, name in parsed:
+            wine = matcher.match(vintage, name)
             if not wine:
                 unmatched_txns.append(txn['wine_name'][:60])
                 continue
@@ -134,69 +159,53 @@ def apply_transactions():
             if txn.get('in_cellar', 0) > 0:
                 wine.quantity = txn['in_cellar']
 
-        db.session.flush()
-        print(f"\nStep 1: Matched {matched} cellar wines to transaction records")
+        log(f"\nStep 1: Matched {matched} cellar wines to transaction records")
         if unmatched_txns:
-            print(f"  Unmatched: {len(unmatched_txns)} transactions")
+            log(f"  Unmatched: {len(unmatched_txns)} transactions")
             for name in unmatched_txns[:5]:
-                print(f"    - {name}")
+                log(f"    - {name}")
+        step_done(1, f"Matched {matched} cellar wines to transaction records")
 
         # Step 2: Link consumed wines to their cellar parents
         linked = 0
         for cw in consumed_wines:
             if cw.parent_wine_id:
                 continue  # Already linked
-            key = (cw.vintage, normalize_name(cw.name))
-            parent = cellar_lookup.get(key)
+            parent = matcher.exact.get((cw.vintage, name_key(cw.name)))
             if parent:
-                cw.parent_wine_id = parent.id
+                link(cw, parent)
                 linked += 1
 
-        db.session.flush()
-        print(f"\nStep 2: Linked {linked} consumed wines to cellar parents")
+        log(f"\nStep 2: Linked {linked} consumed wines to cellar parents")
+        step_done(2, f"Linked {linked} consumed wines to cellar parents")
 
         # Step 3: Create missing consumed wine records from transaction consumption events
         created = 0
-        for txn in txns:
-            if 'error' in txn or not txn.get('consumed_events'):
+        for txn, vintage, name in parsed:
+            if not txn.get('consumed_events'):
                 continue
-
-            vintage, name = parse_wine_name(txn['wine_name'])
-            key = (vintage, normalize_name(name))
-            parent = cellar_lookup.get(key)
+            parent = matcher.exact.get((vintage, name))
             if not parent:
                 continue
 
-            # Check existing consumed copies for this parent
-            existing_consumed = Wine.query.filter_by(
-                user_id=user.id, status='consumed', parent_wine_id=parent.id
-            ).all()
-
-            # Also find consumed wines matching by name that could be linked
-            name_matches = [w for w in consumed_wines
-                           if w.vintage == vintage
-                           and normalize_name(w.name) == normalize_name(parent.name)
-                           and not w.parent_wine_id]
-
-            # Link name matches first
-            for nm in name_matches:
-                nm.parent_wine_id = parent.id
+            # Link consumed wines matching by name first
+            for nm in list(unlinked.get((vintage, name_key(parent.name)), ())):
+                link(nm, parent)
                 linked += 1
 
-            existing_consumed = Wine.query.filter_by(
-                user_id=user.id, status='consumed', parent_wine_id=parent.id
-            ).all()
-            existing_count = sum(c.quantity for c in existing_consumed)
+            existing_consumed = copies_by_parent.get(parent.id, [])
+            ledger_count, ledger_dates = recorded.get(parent.id, (0, set()))
+            existing_count = sum(c.quantity for c in existing_consumed) + ledger_count
             expected_count = txn.get('consumed', 0)
 
             if existing_count >= expected_count:
                 continue  # Already have enough consumed records
 
             # Match consumption events to existing consumed records by date
-            existing_dates = set()
-            for ec in existing_consumed:
-                if ec.date_consumed:
-                    existing_dates.add(ec.date_consumed)
+            existing_dates = {ec.date_consumed for ec in existing_consumed if ec.date_consumed}
+            existing_dates |= ledger_dates
+            # Only records that existed before this transaction are candidates
+            candidates = list(existing_consumed)
 
             for evt in txn['consumed_events']:
                 evt_date = parse_date_str(evt.get('date'))
@@ -208,7 +217,7 @@ def apply_transactions():
 
                 # Update existing consumed record's date if it matches by qty
                 updated = False
-                for ec in existing_consumed:
+                for ec in candidates:
                     if not ec.date_consumed and ec.quantity == evt_qty:
                         ec.date_consumed = evt_date
                         updated = True
@@ -233,32 +242,58 @@ def apply_transactions():
                         drink_from=parent.drink_from, drink_to=parent.drink_to
                     )
                     db.session.add(consumed)
+                    copies_by_parent.setdefault(parent.id, []).append(consumed)
                     created += 1
                     existing_count += evt_qty
 
-        db.session.flush()
-        print(f"\nStep 3: Created {created} new consumed wine records from transaction events")
-        print(f"  Additional linked: {linked}")
+    db.session.flush()
+    log(f"\nStep 3: Created {created} new consumed wine records from transaction events")
+    log(f"  Additional linked: {linked}")
+    step_done(3, f"Created {created} consumed wine records")
+
+    # Step 4: Update consumed-only wines (no cellar entry) with acquisition dates
+    # These are wines that were fully consumed - find them in consumed_wines that
+    # don't have a parent_wine_id
+    orphan_consumed = [w for w in consumed_wines if not w.parent_wine_id]
+    log(f"\nStep 4: {len(orphan_consumed)} consumed wines with no cellar parent (fully consumed)")
+
+    # Fold the consumed records into the inventory ledger
+    events = inventory.sync(db.session.connection(), user_ids=[user.id],
+                            transactions={user.id: txns})
+    log(f"  Recorded {events} inventory events")
+
+    db.session.commit()
+    log("\nDone! All changes committed.")
+    step_done(4, f"{len(orphan_consumed)} consumed wines with no cellar parent")
+    return {'matched': matched, 'unmatched': len(unmatched_txns), 'linked': linked,
+            'created': created, 'orphans': len(orphan_consumed)}
+
 
-        # Step 4: Update consumed-only wines (no cellar entry) with acquisition dates
-        # These are wines that were fully consumed - find them in consumed_wines that
-        # don't have a parent_wine_id
-        orphan_consumed = [w for w in consumed_wines if not w.parent_wine_id]
-        print(f"\nStep 4: {len(orphan_consumed)} consumed wines with no cellar parent (fully consumed)")
+def apply_transactions():
+    from app import app
+    upgrade(app)
+    with app.app_context():
+        user = User.query.filter_by(username=TXN_USER).first()
+        if not user:
+            print(f"User '{TXN_USER}' not found!")
+            return
+
+        # Load transaction data
+        txns = load_transactions()
+        if txns is None:
+            print("wine_transactions.json not found!")
+            return
+        print(f"Loaded {len(txns)} transaction records")
 
-        db.session.commit()
-        print("\nDone! All changes committed.")
+        replay_transactions(user, txns)
 
         # Final stats
         cellar_with_acq = Wine.query.filter_by(user_id=user.id, status='cellar').filter(
             Wine.acq_date.isnot(None)
         ).count()
-        total_linked = Wine.query.filter_by(user_id=user.id, status='consumed').filter(
-            Wine.parent_wine_id.isnot(None)
-        ).count()
         print(f"\nFinal stats:")
         print(f"  Cellar wines with acq_date: {cellar_with_acq}")
-        print(f"  Consumed wines linked to parents: {total_linked}")
+        print(f"  Bottles consumed in the inventory ledger: {inventory.consumed_bottles(user.id)}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Benchmark the main routes against synthetic cellars of growing size.
+Usage: python bench_routes.py [--sizes 1000,10000,100000] [--requests N]
+                              [--gunicorn] [--workers N] [--concurrency N]
+                              [--baseline FILE] [--save-baseline]
+
+For each size a database is generated once (and kept in --data-dir): a
+'bench' user (password 'bench') whose wines, consumption history and tasting
+notes are sampled from cellar_data.csv and wine_transactions.json, plus a
+few smaller users so the tables are shared as in production.
+
+Each route is then measured in its own process through the Flask test
+client, so the peak RSS reported is that route's; with --gunicorn the
+same routes are also driven over HTTP against a multi-worker gunicorn,
+reporting the largest worker's peak RSS so far.  SQL counts come from the
+profiling headers.  Results are compared with the stored baseline
+(bench_baseline.json), or replace it with --save-baseline.
+"""
+import argparse
+import csv
+import http.cookiejar
+import json
+import os
+import random
+import re
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZES = (1000, 10000, 100000)
+BASELINE_PATH = os.path.join(HERE, 'bench_baseline.json')
+
+USERNAME, PASSWORD = 'bench', 'bench'
+# Other users get this fraction of the bench user's wines each
+OTHER_USERS = 3
+OTHER_FRACTION = 0.1
+
+ROUTES = {
+    'cellar': '/cellar',
+    'cellar_sorted': '/cellar?sort_by=price&sort_order=desc&page=3',
+    'ready': '/cellar/ready',
+    'stats': '/stats',
+    'search': '/search?query=cabernet',
+    'wine_detail': '/wine/{wine_id}',
+    'export': '/export',
+    'forecast': '/api/v1/forecast',
+}
+
+CUVEES = ['Reserve', 'Estate', 'Old Vines', 'Single Vineyard', 'Cuvée Speciale',
+          'Grand Vin', 'Selection', 'Barrel Select', 'Vieilles Vignes', 'Riserva']
+
+
+# ─── Synthetic data ───────────────────────────────────────────────
+
+def _samples():
+    """Wine templates and tasting note texts from cellar_data.csv, and
+    (acquired, consumed dates, price, source) histories from
+    wine_transactions.json."""
+    from csv_import import _read_header, parse_row
+    templates, notes = [], []
+    with open(os.path.join(HERE, 'cellar_data.csv'), encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        col = _read_header(reader)
+        for row in reader:
+            try:
+                parsed = parse_row(row, col)
+            except ValueError:
+                continue
+            if not parsed:
+                continue
+            kind, wine, note_text = parsed
+            templates.append(wine)
+            if note_text:
+                notes.append(note_text)
+
+    from apply_transactions import TXN_PATH, load_transactions, parse_date_str
+    histories = []
+    for txn in load_transactions(TXN_PATH):
+        if 'error' in txn:
+            continue
+        acq = (txn.get('acq_events') or [{}])[0]
+        consumed = [parse_date_str(e.get('date')) for e in txn.get('consumed_events', [])
+                    if e.get('type') == 'consumed' for _ in range(e.get('quantity') or 1)]
+        histories.append((txn.get('acquired') or 1, consumed,
+                          parse_date_str(acq.get('date')), acq.get('price'), acq.get('from')))
+    return templates, notes, histories
+
+
+def _wine_rows(rng, user_id, count, templates, histories):
+    """Yield (cellar wine values or None, [consumed copy values]) until
+    ``count`` rows have been produced."""
+    produced = 0
+    this_year = date.today().year
+    while produced < count:
+        t = rng.choice(templates)
+        acquired, consumed_dates, acq_date, acq_price, acq_from = rng.choice(histories)
+        vintage = t['vintage'] + rng.randint(-6, 2) if t['vintage'] else None
+        name = t['name'] if rng.random() < 0.5 else f"{t['name']} {rng.choice(CUVEES)}"
+        start = (vintage or this_year - 5) + rng.randint(1, 8)
+        shift = timedelta(days=rng.randint(-2000, 0))
+        base = dict(t, user_id=user_id, name=name, vintage=vintage,
+                    acq_date=acq_date + shift if acq_date else None,
+                    acq_price=acq_price, acq_from=(acq_from or '').split('\n')[0] or None,
+                    price=t['price'] or acq_price,
+                    drink_from=start, drink_to=start + rng.randint(4, 20),
+                    rating=rng.choice([None, None, 86, 88, 90, 91, 92, 93, 94, 95]),
+                    on_order=rng.random() < 0.03,
+                    date_added=datetime.utcnow() - timedelta(days=rng.randint(0, 3000)))
+        copies = [dict(base, status='consumed', quantity=1, on_order=False,
+                       date_consumed=(d + shift) if d else None)
+                  for d in consumed_dates[:max(0, count - produced - 1)]]
+        in_cellar = max(0, acquired - len(consumed_dates))
+        parent = dict(base, status='cellar', quantity=in_cellar or rng.randint(1, 6),
+                      original_quantity=acquired) if in_cellar or not copies else None
+        produced += len(copies) + (parent is not None)
+        yield parent, copies
+
+
+def generate(size, seed=1):
+    """Fill the (empty, migrated) database with the synthetic users."""
+    from app import app
+    from models import db, User, Wine, TastingNote
+    from csv_import import parse_tasting_note
+    import cellar_summary
+    import inventory
+    import wine_varietals
+
+    rng = random.Random(seed)
+    templates, notes, histories = _samples()
+    table = Wine.__table__
+    with app.app_context():
+        users = [User(username=USERNAME, email='bench@example.com')]
+        users += [User(username=f'bench{i}', email=f'bench{i}@example.com')
+                  for i in range(1, OTHER_USERS + 1)]
+        for user in users:
+            user.set_password(PASSWORD)
+        db.session.add_all(users)
+        db.session.commit()
+
+        conn = db.session.connection()
+        for user in users:
+            count = size if user.username == USERNAME else int(size * OTHER_FRACTION)
+            batch = list(_wine_rows(rng, user.id, count, templates, histories))
+            parents = [p for p, _ in batch if p]
+            ids = iter(conn.execute(table.insert().returning(table.c.id, sort_by_parameter_order=True),
+                                    parents).scalars().all()) if parents else iter(())
+            copies = []
+            for parent, wine_copies in batch:
+                parent_id = next(ids) if parent else None
+                copies.extend(dict(c, parent_wine_id=parent_id) for c in wine_copies)
+            if not copies:
+                continue
+            copy_ids = conn.execute(table.insert().returning(table.c.id, sort_by_parameter_order=True),
+                                    copies).scalars().all()
+            note_rows = [
+                dict(parse_tasting_note(rng.choice(notes)), wine_id=wine_id, user_id=user.id,
+                     tasting_date=copy['date_consumed'])
+                for wine_id, copy in zip(copy_ids, copies) if rng.random() < 0.3
+            ]
+            if note_rows:
+                conn.execute(TastingNote.__table__.insert(), note_rows)
+        # Consumed copies become inventory events, as after an import
+        inventory.sync(conn)
+        wine_varietals.backfill(conn)
+        cellar_summary.rebuild_all(conn)
+        db.session.commit()
+
+
+# ─── Measuring ────────────────────────────────────────────────────
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _summary(latencies, queries, rss_mb):
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(_percentile(latencies, 0.95) * 1000, 2),
+        'queries': max(queries) if queries else None,
+        'peak_rss_mb': round(rss_mb, 1),
+    }
+
+
+def _detail_wine_id(app):
+    """The bench user's wine with the longest inventory history."""
+    from models import db, User, InventoryEvent
+    with app.app_context():
+        user = User.query.filter_by(username=USERNAME).one()
+        return db.session.query(InventoryEvent.wine_id).filter(InventoryEvent.user_id == user.id) \
+            .group_by(InventoryEvent.wine_id).order_by(db.func.count().desc(), InventoryEvent.wine_id) \
+            .limit(1).scalar()
+
+
+def measure(route, requests):
+    """Time ``route`` through the test client (run in a fresh process)."""
+    from app import app
+    app.config['WTF_CSRF_ENABLED'] = False
+    path = ROUTES[route].format(wine_id=_detail_wine_id(app))
+    client = app.test_client()
+    client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    latencies, queries = [], []
+    for i in range(requests + 1):
+        start = time.perf_counter()
+        response = client.get(path)
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        assert response.status_code == 200, (path, response.status_code)
+        if i:  # the first request warms caches and is not counted
+            latencies.append(elapsed)
+            queries.append(int(response.headers.get('X-Perf-Queries', 0)))
+    return _summary(latencies, queries, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def _child(args, db_path):
+    env = dict(os.environ, DATABASE_PATH=db_path, PROFILE_REQUESTS='1')
+    env.pop('DATABASE_URL', None)
+    out = subprocess.run([sys.executable, __file__] + args, env=env, check=True,
+                         capture_output=True, text=True, cwd=HERE).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def dataset(data_dir, size):
+    """Path of the database for ``size``, generating it if needed."""
+    path = os.path.join(data_dir, f'bench_{size}.db')
+    if not os.path.exists(path):
+        print(f"Generating {size} wines...", file=sys.stderr)
+        started = time.perf_counter()
+        _child(['--generate', str(size)], path)
+        print(f"  done in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+    return path
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _worker_rss_mb(master_pid):
+    """Largest peak RSS (VmHWM) among the gunicorn workers."""
+    peak = 0
+    try:
+        with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+            pids = f.read().split()
+    except OSError:
+        return 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peak = max(peak, int(line.split()[1]) / 1024)
+        except OSError:
+            pass
+    return peak
+
+
+def _http_session(base_url):
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    page = opener.open(base_url + '/login').read().decode()
+    token = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', page).group(1)
+    opener.open(base_url + '/login', urllib.parse.urlencode(
+        {'csrf_token': token, 'username': USERNAME, 'password': PASSWORD}).encode()).read()
+    return opener
+
+
+def measure_gunicorn(db_path, workers, concurrency, requests):
+    """Drive every route over HTTP against ``workers`` gunicorn workers."""
+    port = _free_port()
+    env = dict(os.environ, DATABASE_PATH=db_path, PROFILE_REQUESTS='1')
+    env.pop('DATABASE_URL', None)
+    # The workers' perf log lines go to a file rather than over the report
+    log = open(os.path.join(os.path.dirname(db_path), 'gunicorn.log'), 'a')
+    server = subprocess.Popen(
+        ['gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app'],
+        env=env, cwd=HERE, stdout=log, stderr=log)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(base_url + '/login').read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        sessions = [_http_session(base_url) for _ in range(concurrency)]
+
+        from app import app
+        wine_id = _detail_wine_id(app)
+        results = {}
+        for route, template in ROUTES.items():
+            url = base_url + template.format(wine_id=wine_id)
+
+            def fetch(opener):
+                start = time.perf_counter()
+                with opener.open(url) as response:
+                    response.read()
+                    count = int(response.headers.get('X-Perf-Queries', 0))
+                return time.perf_counter() - start, count
+
+            with ThreadPoolExecutor(concurrency) as pool:
+                list(pool.map(fetch, sessions))  # warm every worker
+                timings = list(pool.map(fetch, [sessions[i % concurrency] for i in range(requests)]))
+            results[route] = _summary([t for t, _ in timings], [q for _, q in timings],
+                                      _worker_rss_mb(server.pid))
+        return results
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        log.close()
+
+
+# ─── Reporting ────────────────────────────────────────────────────
+
+def _change(new, old):
+    if old in (None, 0) or new is None:
+        return ''
+    return f'{(new - old) / old * 100:+.0f}%'
+
+
+def report(results, baseline):
+    print(f"{'run':<28}{'p50 ms':>9}{'p95 ms':>9}{'SQL':>6}{'RSS MB':>8}   vs baseline (p50 / p95 / SQL)")
+    for key, r in results.items():
+        old = baseline.get(key, {})
+        compare = ' / '.join(x for x in (
+            _change(r['p50_ms'], old.get('p50_ms')), _change(r['p95_ms'], old.get('p95_ms')),
+            (f"{old['queries']}->{r['queries']}" if old.get('queries') != r['queries'] and old else ''),
+        ) if x) or ('new' if not old else 'same')
+        print(f"{key:<28}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['queries'] or '':>6}{r['peak_rss_mb']:>8}   {compare}")
+
+
+def main(args):
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {}
+    for size in args.sizes:
+        db_path = dataset(args.data_dir, size)
+        for route in ROUTES:
+            results[f'client/{size}/{route}'] = _child(
+                ['--measure', route, '--requests', str(args.requests)], db_path)
+        if args.gunicorn:
+            os.environ['DATABASE_PATH'] = db_path
+            for route, r in measure_gunicorn(db_path, args.workers, args.concurrency,
+                                             args.requests).items():
+                results[f'gunicorn/{size}/{route}'] = r
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(',')], default=list(SIZES))
+    parser.add_argument('--requests', type=int, default=20, help='timed requests per route')
+    parser.add_argument('--gunicorn', action='store_true', help='also benchmark over HTTP')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--data-dir', default=os.path.join(HERE, 'instance', 'bench'))
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    # Internal: the per-process steps main() runs
+    parser.add_argument('--generate', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--measure', choices=ROUTES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.generate:
+        from app import app
+        import migrations
+        migrations.upgrade(app, log=lambda message: None)
+        generate(args.generate)
+        print(json.dumps({'generated': args.generate}))
+    elif args.measure:
+        print(json.dumps(measure(args.measure, args.requests)))
+    else:
+        main(args)
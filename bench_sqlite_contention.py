@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Measure write contention on a copy of the database with SQLite's default
+settings and with the sqlite_tuning profile.
+Usage: python bench_sqlite_contention.py [--writers N] [--readers N] [--seconds S]
+
+Writer processes each loop over a consume-style transaction (decrement a
+wine's quantity, add a tasting note); reader processes page through the
+cellar list as the /cellar route does.  Each profile runs against its own
+copy of the current database, so the real one is not touched.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+import sqlite_tuning
+
+WRITE = [
+    text('UPDATE wines SET quantity = quantity - 1 WHERE id = :id'),
+    text("INSERT INTO tasting_notes (wine_id, user_id, overall, created_at) "
+         "VALUES (:id, :user_id, 'benchmark', CURRENT_TIMESTAMP)"),
+]
+READ = text('SELECT id, name, producer, vintage, quantity FROM wines '
+            "WHERE user_id = :user_id AND status = 'cellar' "
+            'ORDER BY name, id LIMIT 50 OFFSET :offset')
+
+
+def make_engine(path, tuned):
+    if not tuned:
+        return create_engine(f'sqlite:///{path}')
+    engine = create_engine(f'sqlite:///{path}', **sqlite_tuning.ENGINE_OPTIONS)
+    event.listen(engine, 'connect',
+                 lambda conn, record: sqlite_tuning.apply_pragmas(conn, sqlite_tuning.PRAGMAS))
+    return engine
+
+
+def worker(path, tuned, role, seconds, wines, results):
+    engine = make_engine(path, tuned)
+    rng = random.Random(os.getpid())
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        wine_id, user_id = rng.choice(wines)
+        start = time.perf_counter()
+        try:
+            with engine.begin() as conn:
+                if role == 'write':
+                    for statement in WRITE:
+                        conn.execute(statement, {'id': wine_id, 'user_id': user_id})
+                else:
+                    conn.execute(READ, {'user_id': user_id, 'offset': rng.randrange(0, 300, 50)}).all()
+        except OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    engine.dispose()
+    results.put((role, latencies, errors))
+
+
+def run_profile(source, tuned, writers, readers, seconds):
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'bench.db')
+    with sqlite3.connect(source) as conn:
+        conn.execute('VACUUM INTO ?', (path,))
+    with sqlite3.connect(path) as conn:
+        # journal_mode is stored in the file; start both profiles from the default
+        conn.execute('PRAGMA journal_mode = DELETE')
+    engine = make_engine(path, tuned)
+    with engine.connect() as conn:
+        wines = [tuple(r) for r in conn.execute(
+            text("SELECT id, user_id FROM wines WHERE status = 'cellar'")).all()]
+    engine.dispose()
+
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=worker, args=(path, tuned, role, seconds, wines, results))
+             for role in ['write'] * writers + ['read'] * readers]
+    for p in procs:
+        p.start()
+    collected = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    shutil.rmtree(workdir)
+
+    summary = {}
+    for role in ('write', 'read'):
+        latencies = [x for r, lat, _ in collected if r == role for x in lat]
+        errors = sum(e for r, _, e in collected if r == role)
+        summary[role] = (latencies, errors)
+    return summary
+
+
+def report(label, summary, seconds):
+    print(label)
+    for role, (latencies, errors) in summary.items():
+        if not latencies:
+            print(f"  {role:5}  no successful transactions, {errors} lock errors")
+            continue
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(f"  {role:5}  {len(latencies) / seconds:8.0f} tx/s  "
+              f"p50 {statistics.median(latencies) * 1000:7.2f} ms  "
+              f"p95 {p95 * 1000:7.2f} ms  max {latencies[-1] * 1000:8.2f} ms  "
+              f"{errors} lock errors")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    from app import app
+    from models import db
+    with app.app_context():
+        source = db.engine.url.database
+    for label, tuned in (('SQLite defaults', False), ('sqlite_tuning profile', True)):
+        report(label, run_profile(source, tuned, args.writers, args.readers, args.seconds),
+               args.seconds)
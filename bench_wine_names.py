@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Time wine-name parsing over wine_transactions.json: the per-call re.*
+parsing the seed steps and transaction replay each used to carry, against
+the shared, precompiled and memoized wine_names module.
+Usage: python bench_wine_names.py [--passes N] [--repeat N]
+"""
+import argparse
+import json
+import re
+import time
+
+import wine_names
+from apply_transactions import TXN_PATH
+
+
+def legacy_parse(full_name):
+    """The parser as it was duplicated before wine_names existed."""
+    full_name = re.sub(r'\s*RATED\s*$', '', full_name.strip())
+    m = re.match(r'^(\d{4})\s+(.+?)\s*\((\d+(?:\.\d+)?(?:ml|l))\)\s*$', full_name)
+    if m:
+        size_str = m.group(3)
+        if 'l' in size_str and 'ml' not in size_str:
+            size_ml = int(float(size_str.replace('l', '')) * 1000)
+        else:
+            size_ml = int(float(size_str.replace('ml', '')))
+        return int(m.group(1)), m.group(2).strip(), size_ml
+    m2 = re.match(r'^(.+?)\s*\((\d+(?:\.\d+)?(?:ml|l))\)\s*$', full_name)
+    if m2:
+        size_str = m2.group(2)
+        if 'l' in size_str and 'ml' not in size_str:
+            size_ml = int(float(size_str.replace('l', '')) * 1000)
+        else:
+            size_ml = int(float(size_str.replace('ml', '')))
+        return None, m2.group(1).strip(), size_ml
+    return None, full_name, 750
+
+
+def legacy_key(name):
+    return re.sub(r'\s+', ' ', (name or '').lower().strip())
+
+
+def run(names, parse, key, passes):
+    """Parse and normalize every name once per pass, as each seed step does."""
+    for _ in range(passes):
+        for full_name in names:
+            vintage, name, size_ml = parse(full_name)
+            key(name)
+
+
+def best_of(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(passes, repeat):
+    with open(TXN_PATH) as f:
+        names = [tx['wine_name'] for tx in json.load(f) if 'error' not in tx]
+
+    mismatched = [n for n in names
+                  if wine_names.parse(n) != legacy_parse(n)
+                  or wine_names.name_key(n) != legacy_key(n)]
+    if mismatched:
+        print(f"{len(mismatched)} names parse differently, e.g. {mismatched[0]!r}")
+
+    def cold():
+        wine_names.parse.cache_clear()
+        wine_names.name_key.cache_clear()
+        run(names, wine_names.parse, wine_names.name_key, passes)
+
+    legacy = best_of(repeat, lambda: run(names, legacy_parse, legacy_key, passes))
+    shared = best_of(repeat, cold)
+    print(f"{len(names)} names x {passes} passes, best of {repeat}:")
+    print(f"  per-call re.*      {legacy * 1000:8.2f} ms")
+    print(f"  wine_names (cold)  {shared * 1000:8.2f} ms  {legacy / shared:5.1f}x")
+    print(f"  {wine_names.parse.cache_info()}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--passes', type=int, default=4,
+                        help='times each name is parsed per run (default 4, one per seed step)')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    main(args.passes, args.repeat)
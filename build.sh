@@ -3,3 +3,8 @@
 set -o errexit
 
 pip install -r requirements.txt
+
+# Seed a scratch database once at build time; a start with no database
+# copies this snapshot into place instead of seeding (see migrations.py)
+rm -f seed_snapshot.db
+DATABASE_PATH="$(mktemp -d)/winecellar.db" python migrations.py --snapshot seed_snapshot.db
@@ -0,0 +1,76 @@
+"""Aggregate queries behind the statistics page.
+
+Everything on /stats is read from the cellar summary or computed by the
+database with GROUP BY and comes back as plain rows, so the cost follows
+the number of distinct appellations and varietals rather than the number
+of bottles.
+"""
+from sqlalchemy import and_, func, literal, null, or_, select, union_all
+
+from cellar_summary import cellar_summary
+from models import db, Wine, Varietal, WineVarietal, InventoryEvent
+
+
+def in_cellar(user_id):
+    """Condition for wines physically in the cellar (not on order)."""
+    return and_(Wine.user_id == user_id, Wine.status == 'cellar',
+                or_(Wine.on_order == False, Wine.on_order.is_(None)))
+
+
+def _sorted_breakdown(rows):
+    return dict(sorted(rows, key=lambda x: x[1], reverse=True))
+
+
+def cellar_stats(user_id):
+    """Return the /stats figures for one user.
+
+    Totals, ready count and the type breakdown come from the maintained
+    cellar summary; the remaining breakdowns are one UNION of grouped
+    selects whose rows are (dimension, key, wines, bottles).
+    """
+    summary = cellar_summary(user_id)
+    cellar = in_cellar(user_id)
+
+    def grouped(dimension, key):
+        return select(
+            literal(dimension).label('dimension'), key.label('key'),
+            func.count(Wine.id), func.coalesce(func.sum(Wine.quantity), 0),
+        ).where(cellar).group_by(key)
+
+    # Blends count towards every varietal they list
+    varietal = func.coalesce(Varietal.name, 'Unknown')
+    varietals = select(
+        literal('varietal'), varietal,
+        func.count(func.distinct(Wine.id)), func.coalesce(func.sum(Wine.quantity), 0),
+    ).select_from(Wine).outerjoin(WineVarietal, WineVarietal.wine_id == Wine.id) \
+        .outerjoin(Varietal, Varietal.id == WineVarietal.varietal_id) \
+        .where(cellar).group_by(varietal)
+
+    # Consumptions recorded (and bottles they took), from the inventory ledger
+    consumed = select(
+        literal('consumed'), null(), func.count(InventoryEvent.id),
+        -func.coalesce(func.sum(InventoryEvent.quantity), 0),
+    ).where(InventoryEvent.user_id == user_id, InventoryEvent.kind == InventoryEvent.CONSUME)
+
+    rows = db.session.execute(union_all(
+        grouped('appellation', func.coalesce(func.nullif(Wine.appellation, ''), 'Unknown')),
+        varietals,
+        consumed,
+    )).all()
+
+    return {
+        'total_bottles': summary.bottles,
+        'total_value': summary.value,
+        'avg_price': summary.value / summary.bottles if summary.bottles > 0 else 0,
+        'consumed_count': sum(r[2] for r in rows if r[0] == 'consumed'),
+        'ready_count': summary.ready_wines,
+        'type_breakdown': summary.by_type,
+        'appellation_breakdown': _sorted_breakdown((r[1], r[3]) for r in rows if r[0] == 'appellation'),
+        'varietal_breakdown': _sorted_breakdown((r[1], r[3]) for r in rows if r[0] == 'varietal'),
+    }
+
+
+def top_rated(user_id, limit=10):
+    """Highest rated wines in the cellar."""
+    return Wine.query.filter(in_cellar(user_id), Wine.rating.isnot(None), Wine.rating > 0) \
+        .order_by(Wine.rating.desc(), Wine.id).limit(limit).all()
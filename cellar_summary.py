@@ -0,0 +1,232 @@
+"""Incremental maintenance of the cellar_summary table.
+
+Every flush that inserts, edits or deletes a Wine adds the change in its
+contribution (wines, bottles, value, ready counts) to the owner's
+cellar_summary row for that wine type, inside the same transaction.
+Core writes bypass the flush: inventory.py's quantity UPDATEs add their
+change with quantity_changed() and bulk imports with wines_inserted().
+The dashboard numbers on /, /stats and User.cellar_value()/total_bottles()
+are then read from a handful of summary rows instead of every bottle.
+
+Ready-to-drink counts depend on the calendar year; rows record the year
+they were computed for and are rebuilt on first read in a new year.
+"""
+from datetime import date
+
+from sqlalchemy import and_, case, event, func, inspect, or_, select
+from sqlalchemy.orm import Session
+
+from models import db, Wine, CellarSummary
+
+_TRACKED = ('user_id', 'status', 'on_order', 'wine_type', 'quantity', 'price',
+            'drink_from', 'drink_to')
+
+_COUNTERS = ('wines', 'bottles', 'value', 'ready_wines', 'ready_bottles')
+
+_UNKNOWN = object()
+
+
+class Summary:
+    """Cellar totals for one user, summed over their summary rows."""
+
+    def __init__(self, rows):
+        self.wines = sum(r.wines for r in rows)
+        self.bottles = sum(r.bottles for r in rows)
+        self.value = sum(r.value for r in rows)
+        self.ready_wines = sum(r.ready_wines for r in rows)
+        self.ready_bottles = sum(r.ready_bottles for r in rows)
+        by_type = {}
+        for r in rows:
+            if r.bottles:
+                by_type[r.wine_type or None] = by_type.get(r.wine_type or None, 0) + r.bottles
+        self.by_type = dict(sorted(by_type.items(), key=lambda x: x[1], reverse=True))
+
+
+def _contribution(values, year):
+    """(summary key, counters) a wine adds to the summary, or None."""
+    if values['status'] != 'cellar' or values['user_id'] is None:
+        return None
+    qty = values['quantity'] or 0
+    ready = (values['drink_from'] is not None and values['drink_from'] <= year
+             and (values['drink_to'] is None or values['drink_to'] >= year))
+    key = (values['user_id'], values['wine_type'] or '', bool(values['on_order']))
+    return key, (1, qty, (values['price'] or 0) * qty, int(ready), qty if ready else 0)
+
+
+def _old_values(state):
+    values = {}
+    for name in _TRACKED:
+        hist = state.attrs[name].history
+        if hist.deleted:
+            values[name] = hist.deleted[0]
+        elif hist.unchanged:
+            values[name] = hist.unchanged[0]
+        elif hist.added:
+            # Assigned without ever being loaded: the old value is unknown
+            return _UNKNOWN
+        else:
+            values[name] = None
+    return values
+
+
+def _new_values(obj):
+    return {name: getattr(obj, name) for name in _TRACKED}
+
+
+def _add(deltas, contribution, sign):
+    if contribution is None:
+        return
+    key, counters = contribution
+    current = deltas.get(key, (0, 0, 0, 0, 0))
+    deltas[key] = tuple(c + sign * v for c, v in zip(current, counters))
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_wine_changes(session, flush_context):
+    year = date.today().year
+    deltas = {}
+    rebuild_users = set()
+
+    for obj in session.new:
+        if isinstance(obj, Wine):
+            _add(deltas, _contribution(_new_values(obj), year), 1)
+    for obj in session.dirty:
+        if isinstance(obj, Wine) and session.is_modified(obj):
+            old = _old_values(inspect(obj))
+            if old is _UNKNOWN:
+                rebuild_users.add(obj.user_id)
+                continue
+            _add(deltas, _contribution(old, year), -1)
+            _add(deltas, _contribution(_new_values(obj), year), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Wine):
+            old = _old_values(inspect(obj))
+            if old is _UNKNOWN:
+                rebuild_users.add(obj.user_id)
+                continue
+            _add(deltas, _contribution(old, year), -1)
+
+    if not deltas and not rebuild_users:
+        return
+    conn = session.connection()
+    for key, counters in deltas.items():
+        if key[0] in rebuild_users or not any(counters):
+            continue
+        _apply_delta(conn, key, counters, year)
+    for user_id in rebuild_users:
+        rebuild_user(conn, user_id, year)
+
+
+def quantity_changed(conn, values, change, year=None):
+    """Add a change of ``change`` bottles made by a Core UPDATE (which the
+    flush hook never sees) to the summary; ``values`` are the wine's
+    tracked columns after the change."""
+    year = year or date.today().year
+    deltas = {}
+    _add(deltas, _contribution(dict(values, quantity=(values['quantity'] or 0) - change), year), -1)
+    _add(deltas, _contribution(values, year), 1)
+    for key, counters in deltas.items():
+        if any(counters):
+            _apply_delta(conn, key, counters, year)
+
+
+def wines_inserted(conn, rows, year=None):
+    """Add wines inserted by a Core executemany (``rows`` are the values
+    inserted) to the summary."""
+    year = year or date.today().year
+    deltas = {}
+    for row in rows:
+        _add(deltas, _contribution({name: row.get(name) for name in _TRACKED}, year), 1)
+    for key, counters in deltas.items():
+        if any(counters):
+            _apply_delta(conn, key, counters, year)
+
+
+def _apply_delta(conn, key, counters, year):
+    table = CellarSummary.__table__
+    user_id, wine_type, on_order = key
+    where = and_(table.c.user_id == user_id, table.c.wine_type == wine_type,
+                 table.c.on_order == on_order)
+    updated = conn.execute(table.update().where(where).values(
+        {name: table.c[name] + delta for name, delta in zip(_COUNTERS, counters)}
+    ))
+    if updated.rowcount == 0:
+        conn.execute(table.insert().values(
+            user_id=user_id, wine_type=wine_type, on_order=on_order, ready_year=year,
+            **dict(zip(_COUNTERS, counters))
+        ))
+
+
+def _aggregate(year, user_id=None):
+    """SELECT of the summary rows recomputed from wines."""
+    ready = and_(Wine.drink_from <= year, or_(Wine.drink_to.is_(None), Wine.drink_to >= year))
+    wine_type = func.coalesce(Wine.wine_type, '')
+    on_order = func.coalesce(Wine.on_order, False)
+    query = select(
+        Wine.user_id, wine_type, on_order,
+        func.count(Wine.id),
+        func.coalesce(func.sum(Wine.quantity), 0),
+        func.coalesce(func.sum(func.coalesce(Wine.price, 0) * Wine.quantity), 0),
+        func.coalesce(func.sum(case((ready, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((ready, Wine.quantity), else_=0)), 0),
+    ).where(Wine.status == 'cellar').group_by(Wine.user_id, wine_type, on_order)
+    if user_id is not None:
+        query = query.where(Wine.user_id == user_id)
+    return query
+
+
+def _insert_rows(conn, rows, year):
+    if rows:
+        conn.execute(CellarSummary.__table__.insert(), [
+            dict(zip(('user_id', 'wine_type', 'on_order') + _COUNTERS, row), ready_year=year)
+            for row in rows
+        ])
+
+
+def rebuild_user(conn, user_id, year=None):
+    """Recompute one user's summary rows from their wines."""
+    year = year or date.today().year
+    table = CellarSummary.__table__
+    conn.execute(table.delete().where(table.c.user_id == user_id))
+    _insert_rows(conn, conn.execute(_aggregate(year, user_id)).all(), year)
+
+
+def rebuild_all(conn, year=None):
+    """Recompute every user's summary rows from their wines."""
+    year = year or date.today().year
+    conn.execute(CellarSummary.__table__.delete())
+    _insert_rows(conn, conn.execute(_aggregate(year)).all(), year)
+
+
+def verify(conn, year=None):
+    """Return the summary keys whose stored counters differ from a recount."""
+    year = year or date.today().year
+    expected = {tuple(r[:3]): tuple(r[3:]) for r in conn.execute(_aggregate(year)).all()}
+    table = CellarSummary.__table__
+    stored = {}
+    for r in conn.execute(select(table)).mappings():
+        counters = tuple(r[name] for name in _COUNTERS)
+        if any(counters):
+            stored[(r['user_id'], r['wine_type'], bool(r['on_order']))] = counters
+    mismatched = []
+    for key in set(expected) | set(stored):
+        want = expected.get(key, (0, 0, 0, 0, 0))
+        have = stored.get(key, (0, 0, 0, 0, 0))
+        if any(abs(w - h) > 0.005 for w, h in zip(want, have)):
+            mismatched.append((key, have, want))
+    return mismatched
+
+
+def cellar_summary(user_id, include_on_order=False):
+    """Cellar totals for ``user_id`` (bottles physically in the cellar unless
+    ``include_on_order``), rebuilding the user's rows if their ready counts
+    are from a previous year."""
+    year = date.today().year
+    rows = CellarSummary.query.filter_by(user_id=user_id).all()
+    if any(r.ready_year != year for r in rows):
+        rebuild_user(db.session.connection(), user_id, year)
+        db.session.commit()
+        rows = CellarSummary.query.filter_by(user_id=user_id).all()
+    if not include_on_order:
+        rows = [r for r in rows if not r.on_order]
+    return Summary(rows)
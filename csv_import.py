@@ -0,0 +1,343 @@
+"""Chunked import of ManageYourCellar CSV exports.
+
+Used by the Cellar Import page and by import_cellar.py.  The file is read
+in one streaming pass; every ``chunk_size`` data rows the new wines and
+tasting notes are written with executemany INSERTs and committed together
+with the run's progress in import_runs.  A row that cannot be parsed is
+recorded as an error and skipped rather than failing the file, and
+importing the same file again after an interruption picks up after the
+last committed chunk.
+
+Core inserts skip the ORM flush hooks, so each chunk also updates the
+varietal links, the cellar summary and the user's change counter itself;
+the finished import records the new wines' inventory events.
+"""
+import csv
+import hashlib
+import re
+
+from sqlalchemy import select
+
+from models import db, Wine, TastingNote, ImportRun
+from cellar_summary import wines_inserted
+from wine_varietals import sync_slots
+from wine_versions import bump
+import inventory
+
+CHUNK_SIZE = 500
+
+# Notes starting with this author are tasting notes; anything else in the
+# Notes column of a cellar row is the wine's description
+NOTE_AUTHOR = 'Brad & Erica Sklar'
+
+_MAX_LOGGED_ERRORS = 100
+
+WHITE_GRAPES = {'Chardonnay', 'Sauvignon Blanc', 'Pinot Grigio', 'Pinot Gris',
+                'Riesling', 'Gewürztraminer', 'Viognier', 'Sémillon', 'Aligoté',
+                'Pinot Blanc', 'Chenin Blanc', 'Muscat', 'Grenache Blanc',
+                'Roussanne', 'Marsanne', 'Falanghina', 'Prosecco', 'Xarel-Lo',
+                'Macabeo', 'Parellada', 'Grenache Gris', 'Vermentino',
+                'Sauvignon Blanc-Sémillon'}
+SPARKLING_KEYWORDS = ['Champagne', 'Brut', 'Sparkling', 'Prosecco', 'Franciacorta']
+DESSERT_KEYWORDS = ['Sauternes', 'Barsac']
+
+DESCRIPTORS = {
+    'pale': 'appearance', 'bright': 'appearance', 'deep': 'appearance',
+    'dark': 'appearance', 'evolved': 'appearance',
+    'fragrant': 'nose', 'floral': 'nose', 'complex': 'nose',
+    'intense': 'nose', 'discreet': 'nose', 'nutty': 'nose',
+    'supple': 'palate', 'crisp': 'palate', 'lively': 'palate',
+    'tannic': 'palate', 'flat': 'palate', 'woody': 'palate',
+    'light-bodied': 'palate', 'medium-bodied': 'palate',
+    'full-bodied': 'palate', 'alcoholic': 'palate',
+}
+
+_STARS_RE = re.compile(r'(\d+(?:\.\d+)?)\s*stars?')
+_POINTS_RE = re.compile(r'(\d+)\s*points?')
+_AUTHOR_RE = re.compile(r'^\s*Brad\s*&\s*Erica\s*Sklar:\s*')
+_RATING_PREFIX_RE = re.compile(r'^\d+(?:\.\d+)?\s*(?:stars?|points?)\s*')
+
+_WINE_FIELDS = ('name', 'producer', 'vintage', 'appellation', 'wine_type',
+                'varietal1', 'varietal2', 'varietal3', 'varietal4',
+                'size_ml', 'quantity', 'price', 'stored', 'description', 'status')
+
+
+class ImportFileError(Exception):
+    """The file cannot be imported at all (no header row)."""
+
+
+def detect_wine_type(name, appellation, varietals):
+    """Detect wine type from name, appellation, and varietals."""
+    if any(kw.lower() in name.lower() for kw in SPARKLING_KEYWORDS):
+        return 'Sparkling'
+    if any(kw.lower() in appellation.lower() for kw in DESSERT_KEYWORDS):
+        return 'Dessert'
+    if 'Rosé' in name or 'Rose' in name:
+        return 'Rosé'
+    if varietals and all(v in WHITE_GRAPES for v in varietals):
+        return 'White'
+    return 'Red'
+
+
+def parse_tasting_note(notes_text):
+    """Parse tasting note text from ManageYourCellar CSV format into
+    TastingNote column values.
+
+    Handles "Brad & Erica Sklar: X stars  occasion description details"
+    and "Brad & Erica Sklar: X points  description".
+    """
+    score = None
+    star_match = _STARS_RE.search(notes_text)
+    if star_match:
+        score = int(float(star_match.group(1)) * 20)  # Convert 5-star to 100 scale
+    point_match = _POINTS_RE.search(notes_text)
+    if point_match:
+        score = int(point_match.group(1))
+
+    overall = _AUTHOR_RE.sub('', notes_text)
+    overall = _RATING_PREFIX_RE.sub('', overall).strip()
+
+    words = {'appearance': [], 'nose': [], 'palate': []}
+    for word in overall.lower().split():
+        word_clean = word.strip(',.;:')
+        if word_clean in DESCRIPTORS:
+            words[DESCRIPTORS[word_clean]].append(word_clean)
+
+    return {
+        'appearance': ', '.join(words['appearance']) or None,
+        'nose': ', '.join(words['nose']) or None,
+        'palate': ', '.join(words['palate']) or None,
+        'overall': overall or None,
+        'score': score,
+    }
+
+
+def file_fingerprint(binary_file):
+    """SHA-1 of a seekable binary file, leaving it rewound."""
+    digest = hashlib.sha1()
+    for block in iter(lambda: binary_file.read(1 << 16), b''):
+        digest.update(block)
+    binary_file.seek(0)
+    return digest.hexdigest()
+
+
+def _read_header(reader):
+    for row in reader:
+        cleaned = [c.strip() for c in row]
+        if 'Name' in cleaned and 'Producer' in cleaned:
+            return {h.lower(): i for i, h in enumerate(cleaned)}
+    raise ImportFileError('Could not find header row with Name and Producer columns.')
+
+
+def count_rows(text_file):
+    """Number of data rows after the header, for progress reporting."""
+    reader = csv.reader(text_file)
+    try:
+        _read_header(reader)
+    except ImportFileError:
+        return 0
+    return sum(1 for _ in reader)
+
+
+def parse_row(row, col):
+    """Turn one data row into (kind, wine values, note text), or None for
+    rows without a name and producer.  Raises ValueError for bad values."""
+    def field(name):
+        i = col.get(name)
+        return row[i].strip() if i is not None and i < len(row) else ''
+
+    name, producer = field('name'), field('producer')
+    if not name or not producer:
+        return None
+    appellation = field('appellation')
+    varietal_str = field('varietal')
+    qty_str = field('quantity')
+    notes = field('notes')
+    if not qty_str and not notes:
+        return None
+
+    vintage = None
+    if field('vintage'):
+        try:
+            vintage = int(field('vintage'))
+        except ValueError:
+            pass
+    size_ml = 750
+    if field('size'):
+        try:
+            size_ml = int(field('size'))
+        except ValueError:
+            pass
+    price = None
+    if field('price'):
+        try:
+            price = float(field('price'))
+        except ValueError:
+            pass
+
+    # Varietals are hyphen-separated
+    varietals = [v.strip() for v in varietal_str.split('-') if v.strip()][:4]
+    wine = dict.fromkeys(_WINE_FIELDS)
+    wine.update(
+        name=name, producer=producer, vintage=vintage, appellation=appellation,
+        wine_type=detect_wine_type(name, appellation, varietals),
+        size_ml=size_ml, price=price, stored=field('stored'),
+    )
+    for i, varietal in enumerate(varietals, 1):
+        wine[f'varietal{i}'] = varietal
+
+    if qty_str:
+        try:
+            wine['quantity'] = int(qty_str)
+        except ValueError:
+            raise ValueError(f'invalid quantity {qty_str!r}')
+        wine['status'] = 'cellar'
+        if notes and NOTE_AUTHOR not in notes:
+            wine['description'] = notes
+            return 'cellar', wine, None
+        return 'cellar', wine, notes or None
+
+    # No quantity: a consumed bottle recorded by its tasting note
+    wine['quantity'] = 1
+    wine['status'] = 'consumed'
+    return 'consumed', wine, notes
+
+
+def start_run(user_id, filename, fingerprint, restart=False):
+    """The unfinished run for this file to resume, or a new one.
+
+    With ``restart`` any unfinished run is abandoned and a new run starts
+    from the first row.
+    """
+    run = ImportRun.query.filter(
+        ImportRun.user_id == user_id, ImportRun.fingerprint == fingerprint,
+        ImportRun.status.in_(('running', 'failed')),
+    ).order_by(ImportRun.id.desc()).first()
+    if run and restart:
+        run.status = 'abandoned'
+        run = None
+    if run is None:
+        run = ImportRun(user_id=user_id, filename=filename, fingerprint=fingerprint,
+                        status='running', rows_done=0, wines=0, notes=0, error_count=0)
+        db.session.add(run)
+    run.status = 'running'
+    db.session.commit()
+    return run
+
+
+def _wine_keys(run):
+    """(vintage, name, producer) -> wine id for wines an earlier attempt of
+    ``run`` inserted, so consumed rows still find their cellar wine."""
+    if run.first_wine_id is None:
+        return {}
+    rows = db.session.execute(
+        select(Wine.id, Wine.vintage, Wine.name, Wine.producer)
+        .where(Wine.user_id == run.user_id, Wine.id >= run.first_wine_id)
+        .order_by(Wine.id)
+    ).all()
+    return {(r.vintage, r.name, r.producer): r.id for r in rows}
+
+
+def _log_errors(run, errors):
+    run.error_count += len(errors)
+    logged = run.errors.splitlines() if run.errors else []
+    logged.extend(errors[:max(0, _MAX_LOGGED_ERRORS - len(logged))])
+    run.errors = '\n'.join(logged) or None
+
+
+def _write_chunk(run, chunk, wine_keys):
+    """Insert one chunk of parsed rows and commit it with the run's progress.
+
+    ``chunk`` is a list of (kind, wine values, note text); ``wine_keys``
+    maps (vintage, name, producer) to a wine id or to the position of a
+    wine still pending in this chunk.
+    """
+    conn = db.session.connection()
+    new_wines = []
+    new_keys = {}
+    notes = []  # (wine id or pending position, note text)
+    for kind, wine, note_text in chunk:
+        key = (wine['vintage'], wine['name'], wine['producer'])
+        if kind == 'cellar' or key not in wine_keys:
+            wine_keys[key] = new_keys[key] = ('new', len(new_wines))
+            new_wines.append(dict(wine, user_id=run.user_id))
+        if note_text:
+            notes.append((wine_keys[key], note_text))
+
+    wine_ids = []
+    if new_wines:
+        table = Wine.__table__
+        wine_ids = conn.execute(
+            table.insert().returning(table.c.id, sort_by_parameter_order=True), new_wines
+        ).scalars().all()
+        sync_slots(conn, {
+            wine_id: [(i, w[f'varietal{i}']) for i in range(1, 5) if w[f'varietal{i}']]
+            for wine_id, w in zip(wine_ids, new_wines)
+        })
+        if run.first_wine_id is None:
+            run.first_wine_id = wine_ids[0]
+    for key, ref in new_keys.items():
+        wine_keys[key] = wine_ids[ref[1]]
+
+    if notes:
+        conn.execute(TastingNote.__table__.insert(), [
+            dict(parse_tasting_note(text), user_id=run.user_id,
+                 wine_id=wine_ids[ref[1]] if isinstance(ref, tuple) else ref)
+            for ref, text in notes
+        ])
+    if new_wines:
+        wines_inserted(conn, new_wines)
+        bump(conn, [run.user_id])
+    run.wines += len(new_wines)
+    run.notes += len(notes)
+
+
+def run_import(run, text_file, chunk_size=CHUNK_SIZE, progress=None):
+    """Import ``text_file`` (an open CSV text stream) into ``run``.
+
+    Rows up to ``run.rows_done`` were committed by an earlier attempt and
+    are skipped.  ``progress(run)`` is called after every committed chunk.
+    A failure rolls back the current chunk only, marks the run failed and
+    re-raises; running the same file again resumes from there.
+    """
+    reader = csv.reader(text_file)
+    try:
+        col = _read_header(reader)
+        wine_keys = _wine_keys(run)
+        rows_seen = 0
+        chunk, errors = [], []
+        for row in reader:
+            rows_seen += 1
+            if rows_seen <= run.rows_done:
+                continue
+            try:
+                parsed = parse_row(row, col)
+            except ValueError as e:
+                errors.append(f'line {reader.line_num}: {e}')
+                parsed = None
+            if parsed:
+                chunk.append(parsed)
+            if rows_seen - run.rows_done >= chunk_size:
+                _write_chunk(run, chunk, wine_keys)
+                _log_errors(run, errors)
+                run.rows_done = rows_seen
+                db.session.commit()
+                if progress:
+                    progress(run)
+                chunk, errors = [], []
+        _write_chunk(run, chunk, wine_keys)
+        _log_errors(run, errors)
+        # Opening inventory events for the wines this run imported
+        if run.first_wine_id is not None:
+            inventory.sync(db.session.connection(), user_ids=[run.user_id], since_id=run.first_wine_id)
+        run.rows_done = rows_seen
+        run.status = 'done'
+        db.session.commit()
+        if progress:
+            progress(run)
+    except Exception:
+        db.session.rollback()
+        run.status = 'failed'
+        db.session.commit()
+        raise
+    return run
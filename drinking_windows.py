@@ -0,0 +1,71 @@
+"""Year-by-year forecast of drinking windows.
+
+A wine's window runs from drink_from to drink_to inclusive, or stays open
+with no drink_to; wines without a drink_from are never ready (as in
+Wine.is_ready_at).  One GROUP BY over the (user_id, status, drink_from,
+drink_to) index returns the bottles per distinct window, and a sweep over
+the window starts and ends gives every year's counts, so the cost follows
+the number of distinct windows rather than bottles or years.
+"""
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from models import db, Wine
+
+YEARS = 15
+MAX_YEARS = 100
+
+
+class YearForecast:
+    """Bottles (and wines) entering, inside and leaving their window in one year."""
+
+    def __init__(self, year):
+        self.year = year
+        self.entering = 0   # first year of the window
+        self.ready = 0      # window includes the year
+        self.leaving = 0    # last year of the window
+        self.ready_wines = 0
+
+    def as_dict(self):
+        return {'year': self.year, 'entering': self.entering, 'ready': self.ready,
+                'leaving': self.leaving, 'ready_wines': self.ready_wines}
+
+
+def windows(user_id):
+    """(drink_from, drink_to, wines, bottles) for each distinct window among
+    the user's cellar wines (on order included, as on the ready list)."""
+    return db.session.query(
+        Wine.drink_from, Wine.drink_to, func.count(Wine.id), func.coalesce(func.sum(Wine.quantity), 0)
+    ).filter(
+        Wine.user_id == user_id, Wine.status == 'cellar', Wine.drink_from.isnot(None)
+    ).group_by(Wine.drink_from, Wine.drink_to).all()
+
+
+def forecast(user_id, start, years=YEARS):
+    """A YearForecast for each year from ``start`` for ``years`` years."""
+    end = start + years  # exclusive
+    # Changes to the running totals at the year they take effect
+    bottles_delta, wines_delta = defaultdict(int), defaultdict(int)
+    result = [YearForecast(year) for year in range(start, end)]
+    for drink_from, drink_to, wines, bottles in windows(user_id):
+        if drink_to is not None and (drink_to < drink_from or drink_to < start):
+            continue
+        if drink_from >= end:
+            continue
+        if start <= drink_from:
+            result[drink_from - start].entering += bottles
+        if drink_to is not None and drink_to < end:
+            result[drink_to - start].leaving += bottles
+        first = max(drink_from, start)
+        bottles_delta[first] += bottles
+        wines_delta[first] += wines
+        if drink_to is not None:
+            bottles_delta[drink_to + 1] -= bottles
+            wines_delta[drink_to + 1] -= wines
+    ready = ready_wines = 0
+    for entry in result:
+        ready += bottles_delta[entry.year]
+        ready_wines += wines_delta[entry.year]
+        entry.ready, entry.ready_wines = ready, ready_wines
+    return result
@@ -0,0 +1,73 @@
+"""Distinct filter values (facets) for a user's wines, with counts.
+
+The cellar filter dropdown and the search form suggestions need the
+distinct varietals, appellations, producers, types and vintages a user
+has.  They come from one UNION ALL of GROUP BY selects and are cached per
+user together with the user's wine_version; an entry is recomputed once
+the counter moves, whichever process changed the wines.
+"""
+from sqlalchemy import String, cast, func, literal, select, union_all
+
+from models import db, Wine, Varietal, WineVarietal
+import wine_versions
+
+DIMENSIONS = ('varietal', 'appellation', 'producer', 'wine_type', 'vintage')
+
+_cache = {}
+
+
+class Facets:
+    """Distinct values per dimension as (value, wine count) lists."""
+
+    def __init__(self, rows):
+        grouped = {dimension: [] for dimension in DIMENSIONS}
+        for dimension, value, count in rows:
+            if dimension == 'vintage':
+                value = int(value)
+            grouped[dimension].append((value, count))
+        for dimension, values in grouped.items():
+            values.sort(key=lambda x: x[0], reverse=(dimension == 'vintage'))
+        self.varietals = grouped['varietal']
+        self.appellations = grouped['appellation']
+        self.producers = grouped['producer']
+        self.types = grouped['wine_type']
+        self.vintages = grouped['vintage']
+
+
+def _facet_query(user_id):
+    def grouped(dimension, column):
+        return select(
+            literal(dimension).label('dimension'), column.label('value'),
+            func.count(Wine.id).label('wines'),
+        ).where(Wine.user_id == user_id, column.isnot(None), column != '').group_by(column)
+
+    # A wine lists up to four varietals; count each wine once per varietal
+    varietals = select(
+        literal('varietal'), Varietal.name, func.count(func.distinct(WineVarietal.wine_id)),
+    ).join(WineVarietal, WineVarietal.varietal_id == Varietal.id) \
+        .join(Wine, Wine.id == WineVarietal.wine_id) \
+        .where(Wine.user_id == user_id).group_by(Varietal.name)
+
+    # Cast so every branch's value column has one type (PostgreSQL insists)
+    vintage = select(
+        literal('vintage'), cast(Wine.vintage, String), func.count(Wine.id),
+    ).where(Wine.user_id == user_id, Wine.vintage.isnot(None)).group_by(Wine.vintage)
+
+    return union_all(
+        varietals,
+        grouped('appellation', Wine.appellation),
+        grouped('producer', Wine.producer),
+        grouped('wine_type', Wine.wine_type),
+        vintage,
+    )
+
+
+def wine_facets(user_id):
+    """Facets for every wine ``user_id`` owns, from the cache when current."""
+    version = wine_versions.current(user_id)
+    cached = _cache.get(user_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    facets = Facets(db.session.execute(_facet_query(user_id)).all())
+    _cache[user_id] = (version, facets)
+    return facets
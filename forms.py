@@ -4,9 +4,9 @@ from wtforms import (
     TextAreaField, SelectField, DateField, BooleanField
 )
 from wtforms.validators import (
-    DataRequired, Email, EqualTo, Length, Optional, NumberRange, ValidationError
+    DataRequired, Email, EqualTo, InputRequired, Length, Optional, NumberRange, ValidationError
 )
-from models import User
+from models import User, MATURITY_STAGES
 
 
 class LoginForm(FlaskForm):
@@ -71,6 +71,11 @@ class WineForm(FlaskForm):
     submit = SubmitField('Save Wine')
 
 
+class EditWineForm(WineForm):
+    # Zero for a wine whose bottles have all been consumed
+    quantity = IntegerField('Quantity', validators=[InputRequired(), NumberRange(min=0)], default=1)
+
+
 class TastingNoteForm(FlaskForm):
     tasting_date = DateField('Tasting Date', validators=[DataRequired()])
     appearance = StringField('Appearance', validators=[Optional(), Length(max=200)])
@@ -97,12 +102,25 @@ class SearchForm(FlaskForm):
     varietal = StringField('Varietal', validators=[Optional()])
     min_vintage = IntegerField('Min Vintage', validators=[Optional()])
     max_vintage = IntegerField('Max Vintage', validators=[Optional()])
+    maturity = SelectField('Maturity', choices=[('', 'Any Maturity')] + [
+        (stage, stage) for stage in MATURITY_STAGES
+    ], validators=[Optional()])
     sort_by = SelectField('Sorted by', choices=[
         ('name', 'Name'), ('vintage', 'Vintage'), ('producer', 'Producer'),
         ('appellation', 'Appellation'), ('varietal', 'Varietal'),
         ('wine_type', 'Type/Color'), ('rating', 'Rating'),
-        ('price', 'Price'), ('date_added', 'Date Added')
+        ('price', 'Price'), ('date_added', 'Date Added'), ('maturity', 'Maturity')
     ], default='name', validators=[Optional()])
     sort_order = SelectField('Order', choices=[
         ('asc', 'Ascending'), ('desc', 'Descending')
     ], default='asc', validators=[Optional()])
+
+
+class TastingFilterForm(FlaskForm):
+    class Meta:
+        csrf = False
+
+    from_date = DateField('From', validators=[Optional()])
+    to_date = DateField('To', validators=[Optional()])
+    min_score = IntegerField('Min Score', validators=[Optional(), NumberRange(min=1, max=100)])
+    max_score = IntegerField('Max Score', validators=[Optional(), NumberRange(min=1, max=100)])
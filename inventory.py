@@ -0,0 +1,347 @@
+"""The inventory ledger: every acquisition, consumption and adjustment of
+a wine's bottles as an InventoryEvent row.
+
+Routes change bottle counts through record(), which writes the event and
+moves Wine.quantity (the running balance) by the same amount, so a wine's
+events always sum to its quantity.  The move is a single conditional
+UPDATE rather than a read-modify-write in Python, so it is safe when
+several workers change the same wine at once.  Consuming part of a wine is a consume
+event on the wine itself rather than a cloned status='consumed' row; a
+wine whose balance reaches zero becomes consumed.
+
+sync() brings older data into the ledger: it is run by migration 6 and
+after the bulk writers (seeding, CSV import, transaction replay), which
+still create consumed rows.  Each consumed copy (a row with
+parent_wine_id) becomes a consume event on its parent, carrying the
+copy's date, price and storage; the parent takes over the copy's tasting
+notes, and its rating as a scored note when none of those has a score,
+and the copy row moves to archived_wines.  Wines with no events get an
+opening history, acquisitions taken from wine_transactions.json when the
+wine matches one; and any balance that disagrees with Wine.quantity is
+settled with an adjustment.
+"""
+from datetime import date
+
+from sqlalchemy import and_, bindparam, case, delete, exists, func, inspect, or_, select, true
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+
+from models import db, Wine, TastingNote, InventoryEvent, WineVarietal, archived_wines
+import cellar_summary
+import wine_versions
+
+ACQUIRE, CONSUME, ADJUST = InventoryEvent.ACQUIRE, InventoryEvent.CONSUME, InventoryEvent.ADJUST
+
+# Statuses whose quantity is bottles held; a wishlist quantity is a wish
+_HELD = ('cellar', 'consumed')
+
+# Columns a quantity UPDATE returns: what cellar_summary tracks, and the
+# columns it changes
+_RETURNED = ('user_id', 'status', 'on_order', 'wine_type', 'quantity', 'price',
+             'drink_from', 'drink_to', 'date_consumed', 'version_id')
+
+
+def held(wine):
+    """Bottles of ``wine`` in the ledger; none for a wish list wine."""
+    return (wine.quantity or 0) if wine.status in _HELD else 0
+
+
+def record(wine, kind, bottles, on=None, price=None, party=None, location=None):
+    """Add an event for ``wine`` and apply it to wine.quantity.
+
+    ``bottles`` counts bottles acquired or consumed, or is the signed
+    change for an adjustment.  Consuming the last bottle marks the wine
+    consumed.  Returns the event, or None without changing anything when
+    the wine holds fewer bottles than a consumption (or a negative
+    adjustment) takes away.
+    """
+    change = -bottles if kind == CONSUME else bottles
+    on = on or date.today()
+    if not _move(wine, change, consumed_on=on if kind == CONSUME else None):
+        return None
+    if kind == CONSUME and wine.quantity <= 0:
+        wine.status = 'consumed'
+    return _add_event(wine, kind, change, on, price, party, location)
+
+
+def adjust_to(wine, bottles, on=None):
+    """Record an adjustment bringing wine.quantity to ``bottles``.
+
+    Only held bottles are in the ledger.  A wish list quantity is set
+    without an event; a wine whose status (already assigned) moves it
+    into the cellar gets its opening balance, and one moving out of it an
+    adjustment to zero first.  Raises StaleDataError if the quantity is
+    no longer the one loaded into ``wine`` (another request consumed or
+    added bottles meanwhile).
+    """
+    hist = inspect(wine).attrs.status.history
+    was_held = (hist.deleted[0] if hist.deleted else wine.status) in _HELD
+    if not was_held:
+        wine.quantity = bottles
+        if wine.status in _HELD:
+            open_balance(wine)
+        return None
+    if wine.status not in _HELD:
+        event = _adjust(wine, 0, on)
+        wine.quantity = bottles
+        return event
+    return _adjust(wine, bottles, on)
+
+
+def _adjust(wine, bottles, on):
+    loaded = wine.quantity or 0
+    change = bottles - loaded
+    if not change:
+        return None
+    on = on or date.today()
+    if not _move(wine, change, expected=loaded):
+        raise StaleDataError(f'quantity of wine {wine.id} changed from {loaded}')
+    return _add_event(wine, ADJUST, change, on)
+
+
+def _move(wine, change, expected=None, consumed_on=None):
+    """Add ``change`` to wine.quantity; False if that would leave it
+    negative or it is not ``expected``.
+
+    A saved wine is changed by one conditional UPDATE ... SET quantity =
+    quantity + :change WHERE quantity >= -:change, which also bumps
+    version_id, so concurrent requests (other workers, other threads)
+    cannot lose each other's changes or consume a bottle twice.  The row it
+    returns becomes the wine's loaded state.
+    """
+    if not inspect(wine).persistent:
+        # Not saved yet, so no other request can see it
+        if (wine.quantity or 0) + change < 0:
+            return False
+        wine.quantity = (wine.quantity or 0) + change
+        if consumed_on and (not wine.date_consumed or consumed_on > wine.date_consumed):
+            wine.date_consumed = consumed_on
+        return True
+
+    db.session.flush()  # pending edits go first, under their own version check
+    table = Wine.__table__
+    stmt = table.update().where(table.c.id == wine.id).values(
+        quantity=func.coalesce(table.c.quantity, 0) + change, version_id=table.c.version_id + 1)
+    if change < 0:
+        stmt = stmt.where(table.c.quantity >= -change)
+    if expected is not None:
+        stmt = stmt.where(func.coalesce(table.c.quantity, 0) == expected)
+    if consumed_on:
+        stmt = stmt.values(date_consumed=case(
+            (or_(table.c.date_consumed.is_(None), table.c.date_consumed < consumed_on), consumed_on),
+            else_=table.c.date_consumed))
+    row = db.session.execute(stmt.returning(*(table.c[name] for name in _RETURNED))).first()
+    if row is None:
+        return False
+    values = row._asdict()
+    for name, value in values.items():
+        set_committed_value(wine, name, value)
+    conn = db.session.connection()
+    cellar_summary.quantity_changed(conn, values, change)
+    wine_versions.bump(conn, [wine.user_id])
+    return True
+
+
+def _add_event(wine, kind, change, on, price=None, party=None, location=None):
+    event = InventoryEvent(wine=wine, user_id=wine.user_id, kind=kind, event_date=on,
+                           quantity=change, price=price, party=party,
+                           location=location or wine.stored)
+    db.session.add(event)
+    return event
+
+
+def open_balance(wine):
+    """Record the bottles a new wine was entered with as its acquisition
+    (and, for a wine entered as consumed, their consumption)."""
+    bottles = wine.quantity or 0
+    if wine.status not in _HELD or bottles <= 0:
+        return
+    wine.quantity = 0
+    record(wine, ACQUIRE, bottles, on=wine.acq_date, price=wine.acq_price, party=wine.acq_from)
+    if wine.status == 'consumed':
+        record(wine, CONSUME, bottles, on=wine.date_consumed)
+
+
+def history(wine_id):
+    """The wine's events, oldest first."""
+    return InventoryEvent.query.filter_by(wine_id=wine_id) \
+        .order_by(InventoryEvent.event_date.asc().nulls_first(), InventoryEvent.id).all()
+
+
+def has_consumed():
+    """Condition for wines with at least one consumption recorded."""
+    return exists().where(InventoryEvent.wine_id == Wine.id, InventoryEvent.kind == CONSUME)
+
+
+def consumed_bottles(user_id):
+    """Bottles the user has consumed, over ix_inventory_events_user_kind_date."""
+    return -(db.session.query(func.coalesce(func.sum(InventoryEvent.quantity), 0))
+             .filter(InventoryEvent.user_id == user_id, InventoryEvent.kind == CONSUME).scalar())
+
+
+def consumed_from(wine_ids):
+    """wine id -> bottles consumed, for ``wine_ids`` (a list or a SELECT
+    of ids), over ix_inventory_events_wine_kind."""
+    return dict(db.session.query(InventoryEvent.wine_id, -func.sum(InventoryEvent.quantity))
+                .filter(InventoryEvent.wine_id.in_(wine_ids), InventoryEvent.kind == CONSUME)
+                .group_by(InventoryEvent.wine_id).all())
+
+
+def consumptions_by_wine(user_id):
+    """wine id -> (bottles consumed, set of consumption dates) for the user."""
+    result = {}
+    rows = db.session.query(InventoryEvent.wine_id, InventoryEvent.event_date, InventoryEvent.quantity) \
+        .filter(InventoryEvent.user_id == user_id, InventoryEvent.kind == CONSUME)
+    for wine_id, on, change in rows:
+        total, dates = result.get(wine_id, (0, set()))
+        result[wine_id] = (total - change, dates | {on} if on else dates)
+    return result
+
+
+# ─── Converting older data ────────────────────────────────────────
+
+def _acquisitions_from_transactions(wines, transactions):
+    """wine id -> acq_events for the cellar wines matched by name, per user."""
+    from apply_transactions import CellarMatcher, parse_date_str
+    from wine_names import parse as parse_wine_name, name_key
+
+    matched = {}
+    for user_id, txns in (transactions or {}).items():
+        candidates = [w for w in wines if w.user_id == user_id and w.status == 'cellar'
+                      and not w.on_order and not w.parent_wine_id]
+        matcher = CellarMatcher(candidates)
+        for txn in txns:
+            if 'error' in txn or not txn.get('acq_events'):
+                continue
+            vintage, name, _ = parse_wine_name(txn['wine_name'])
+            wine = matcher.match(vintage, name_key(name))
+            if wine:
+                matched[wine.id] = [
+                    (parse_date_str(e.get('date')), e.get('quantity') or 1, e.get('price'),
+                     (e.get('from') or '').split('\n')[0].strip() or None)
+                    for e in txn['acq_events']
+                ]
+    return matched
+
+
+def sync(conn, user_ids=None, transactions=None, today=None, since_id=None):
+    """Convert consumed copies and event-less wines into ledger events and
+    settle balances that differ from Wine.quantity (see module docstring).
+
+    ``since_id`` limits the work to wines with that id or later (those a
+    bulk insert just added).  ``transactions`` maps a user id to that user's wine_transactions.json
+    records.  Returns the number of events written.
+    """
+    today = today or date.today()
+    wines_t, events_t = Wine.__table__, InventoryEvent.__table__
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return 0
+    wine_filter = wines_t.c.user_id.in_(user_ids) if user_ids is not None else true()
+    event_filter = events_t.c.user_id.in_(user_ids) if user_ids is not None else true()
+    if since_id is not None:
+        wine_filter = and_(wine_filter, wines_t.c.id >= since_id)
+        event_filter = and_(event_filter, events_t.c.wine_id >= since_id)
+
+    wines = conn.execute(select(
+        wines_t.c.id, wines_t.c.user_id, wines_t.c.name, wines_t.c.vintage, wines_t.c.status,
+        wines_t.c.on_order, wines_t.c.quantity, wines_t.c.original_quantity, wines_t.c.acq_date,
+        wines_t.c.acq_price, wines_t.c.acq_from, wines_t.c.stored, wines_t.c.parent_wine_id,
+        wines_t.c.date_consumed, wines_t.c.price, wines_t.c.rating,
+    ).where(wine_filter).order_by(wines_t.c.id)).all()
+    balances = dict(conn.execute(
+        select(events_t.c.wine_id, func.sum(events_t.c.quantity)).where(event_filter)
+        .group_by(events_t.c.wine_id)
+    ).all())
+    by_id = {w.id: w for w in wines}
+
+    # Consumed copies whose parent holds bottles become the parent's events
+    copies = {}
+    for w in wines:
+        parent = by_id.get(w.parent_wine_id)
+        if (w.status == 'consumed' and parent is not None and parent.status in _HELD
+                and not parent.parent_wine_id and w.id not in balances):
+            copies.setdefault(parent.id, []).append(w)
+    copy_ids = {c.id: parent_id for parent_id, cs in copies.items() for c in cs}
+    acquisitions = _acquisitions_from_transactions(
+        [w for w in wines if w.id not in balances], transactions)
+
+    events, updates = [], []
+
+    def event(w, kind, on, change, price=None, party=None, location=None):
+        events.append({'wine_id': w.id, 'user_id': w.user_id, 'kind': kind, 'event_date': on,
+                       'quantity': change, 'price': price, 'party': party,
+                       'location': location or w.stored})
+
+    for w in wines:
+        if w.id in copy_ids or w.status not in _HELD:
+            continue
+        consumed = [(c.date_consumed, c.quantity or 0, c.stored, c.price) for c in copies.get(w.id, ())]
+        target = (w.quantity or 0) if w.status == 'cellar' else 0
+        if w.id in balances:
+            balance = balances[w.id]
+        else:
+            # Opening history: a consumed wine's own quantity was its last consumption
+            if w.status == 'consumed':
+                consumed.append((w.date_consumed, w.quantity or 0, w.stored, w.price))
+            total_consumed = sum(c[1] for c in consumed)
+            balance = 0
+            if w.id in acquisitions:
+                for on, bottles, price, party in acquisitions[w.id]:
+                    event(w, ACQUIRE, on, bottles, price, party)
+                    balance += bottles
+            else:
+                bottles = max(w.original_quantity or 0, target + total_consumed)
+                if bottles:
+                    event(w, ACQUIRE, w.acq_date, bottles, w.acq_price, w.acq_from)
+                    balance = bottles
+        for on, bottles, stored, price in sorted(consumed, key=lambda c: (c[0] is not None, c[0] or today)):
+            if bottles:
+                event(w, CONSUME, on, -bottles, price, location=stored)
+                balance -= bottles
+        if balance != target:
+            event(w, ADJUST, today, target - balance)
+        last = max([c[0] for c in consumed if c[0]] + ([w.date_consumed] if w.date_consumed else []),
+                   default=None)
+        if target != (w.quantity or 0) or last != w.date_consumed:
+            updates.append({'b_id': w.id, 'b_quantity': target, 'b_date': last})
+
+    if events:
+        conn.execute(events_t.insert(), events)
+    if copy_ids:
+        # A copy's rating outlives it as a note on its parent, unless one
+        # of the copy's own notes (which move to the parent) is scored
+        notes_t = TastingNote.__table__
+        ids = list(copy_ids)
+        scored = set()
+        for start in range(0, len(ids), 500):
+            scored.update(conn.execute(select(notes_t.c.wine_id).where(
+                notes_t.c.wine_id.in_(ids[start:start + 500]), notes_t.c.score.isnot(None))).scalars())
+        ratings = [{'wine_id': copy_ids[c.id], 'user_id': c.user_id, 'tasting_date': c.date_consumed,
+                    'score': c.rating}
+                   for c in (by_id[i] for i in ids) if c.rating and c.id not in scored]
+        if ratings:
+            conn.execute(notes_t.insert(), ratings)
+        conn.execute(TastingNote.__table__.update()
+                     .where(TastingNote.__table__.c.wine_id == bindparam('b_copy'))
+                     .values(wine_id=bindparam('b_parent')),
+                     [{'b_copy': c, 'b_parent': p} for c, p in copy_ids.items()])
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            conn.execute(delete(WineVarietal.__table__).where(WineVarietal.__table__.c.wine_id.in_(batch)))
+            conn.execute(wines_t.update().where(wines_t.c.parent_wine_id.in_(batch))
+                         .values(parent_wine_id=None))
+            conn.execute(archived_wines.insert().from_select(
+                [c.name for c in wines_t.columns], select(wines_t).where(wines_t.c.id.in_(batch))))
+            conn.execute(delete(wines_t).where(wines_t.c.id.in_(batch)))
+    if updates:
+        conn.execute(wines_t.update().where(wines_t.c.id == bindparam('b_id'))
+                     .values(quantity=bindparam('b_quantity'), date_consumed=bindparam('b_date'),
+                             version_id=wines_t.c.version_id + 1),
+                     updates)
+    if events or copy_ids or updates:
+        changed = {by_id[e['wine_id']].user_id for e in events} | {by_id[u['b_id']].user_id for u in updates}
+        changed |= {by_id[c].user_id for c in copy_ids}
+        wine_versions.bump(conn, sorted(changed))
+    return len(events)
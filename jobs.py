@@ -0,0 +1,124 @@
+"""In-process background jobs backed by the jobs table.
+
+Routes call enqueue() to record a job and hand it to a small thread pool,
+then return straight away; the job's row carries its progress for the
+/jobs/<id> page.  Because the queue is the table, nothing is lost when a
+worker restarts: start() re-submits queued jobs, and running jobs whose
+heartbeat has gone stale (their process died), when the web app starts.
+Several gunicorn workers can share the table; a job is claimed with a
+conditional UPDATE so only one of them runs it.
+
+Handlers are registered with @handler(kind) and called as
+``fn(job, params)`` inside an app context; they report progress with
+report() and return a JSON-serialisable result.
+"""
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from models import db, Job
+
+WORKERS = 2
+
+# A running job that has not reported for this long is presumed dead
+STALE_AFTER = timedelta(minutes=5)
+
+_handlers = {}
+_executor = None
+_app = None
+_lock = threading.Lock()
+
+
+def handler(kind):
+    """Register ``fn(job, params)`` as the handler for jobs of ``kind``."""
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+def start(app, workers=WORKERS):
+    """Start the worker pool (once per process) and pick up jobs left
+    queued or abandoned by a previous process."""
+    global _executor, _app
+    with _lock:
+        if _executor is not None:
+            return
+        _app = app
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jobs')
+    with app.app_context():
+        stale = datetime.utcnow() - STALE_AFTER
+        pending = Job.query.filter(db.or_(
+            Job.status == 'queued',
+            db.and_(Job.status == 'running', Job.heartbeat_at < stale),
+        )).order_by(Job.id).all()
+        for job in pending:
+            if job.status == 'running':
+                job.status = 'queued'
+                job.message = 'Restarted after the previous worker stopped'
+        db.session.commit()
+        job_ids = [job.id for job in pending]
+    for job_id in job_ids:
+        _executor.submit(_run, job_id)
+
+
+def enqueue(kind, user_id, params=None):
+    """Record a job and schedule it; returns the Job."""
+    if kind not in _handlers:
+        raise ValueError(f'Unknown job kind: {kind}')
+    job = Job(user_id=user_id, kind=kind, params=json.dumps(params or {}),
+              status='queued', done=0, attempts=0)
+    db.session.add(job)
+    db.session.commit()
+    if _executor is not None:
+        _executor.submit(_run, job.id)
+    return job
+
+
+def report(job, done, total=None, message=None):
+    """Record progress for a running job and commit it."""
+    job.done = done
+    if total is not None:
+        job.total = total
+    if message is not None:
+        job.message = message
+    job.heartbeat_at = datetime.utcnow()
+    db.session.commit()
+
+
+def _claim(job_id):
+    """Mark a queued job running; False if another worker got there first."""
+    table = Job.__table__
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        table.update()
+        .where(table.c.id == job_id, table.c.status == 'queued')
+        .values(status='running', started_at=now, heartbeat_at=now,
+                attempts=table.c.attempts + 1)
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def _run(job_id):
+    with _app.app_context():
+        if not _claim(job_id):
+            return
+        job = db.session.get(Job, job_id)
+        try:
+            result = _handlers[job.kind](job, json.loads(job.params or '{}'))
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(Job, job_id)
+            job.status = 'failed'
+            job.message = str(e) or e.__class__.__name__
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            traceback.print_exc()
+            return
+        job.status = 'done'
+        job.result = json.dumps(result) if result is not None else None
+        job.finished_at = job.heartbeat_at = datetime.utcnow()
+        db.session.commit()
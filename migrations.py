@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations, run once per deploy rather than on import.
+Usage: python migrations.py [--no-seed] [--snapshot PATH]
+
+The database records the last migration applied in the one-row
+schema_version table.  upgrade() runs the MIGRATIONS after it in order,
+each in its own transaction together with the version bump, so a failed
+step is retried from that step next time.  A database from before
+versioning starts at 0; the early steps check what already exists.
+
+Several processes may call upgrade() at once (a deploy's migrate step
+racing a restarted worker, or several web nodes sharing a PostgreSQL
+database): upgrade() and seed_if_empty() take an exclusive lock first -- a
+file next to an SQLite database, an advisory lock on PostgreSQL -- and
+the later ones find nothing left to do.  The steps use the SQLAlchemy
+schema and inspector rather than SQLite-only statements.
+
+Seeding runs the import passes in seed.py and takes seconds, so the build
+writes the seeded database to seed_snapshot.db (--snapshot) and a start
+that finds no database copies the snapshot into place instead.
+"""
+import argparse
+import os
+import shutil
+from contextlib import contextmanager
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select, text
+from sqlalchemy.schema import CreateIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock, run migrations from one process
+    fcntl = None
+
+from models import db, User, Wine, TastingNote, InventoryEvent, archived_wines
+import search_index
+import cellar_summary
+import wine_varietals
+import inventory
+
+_metadata = MetaData()
+schema_version = Table('schema_version', _metadata, Column('version', Integer, nullable=False))
+
+# Written by build.sh; restored in place of seeding on a fresh start
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seed_snapshot.db')
+
+# Columns added after their table was first created: (table, column, DDL type)
+_ADDED_COLUMNS = [
+    ('wines', 'parent_wine_id', 'INTEGER REFERENCES wines(id)'),
+    ('wines', 'original_quantity', 'INTEGER'),
+    ('wines', 'producer_url', 'VARCHAR(300)'),
+    ('wines', 'maturity_override', 'VARCHAR(30)'),
+    ('wines', 'acq_price', 'FLOAT'),
+    ('tasting_notes', 'description', 'TEXT'),
+    ('tasting_notes', 'participants', 'TEXT'),
+    ('tasting_notes', 'recommended_with', 'TEXT'),
+    ('users', 'wine_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('wines', 'version_id', 'INTEGER NOT NULL DEFAULT 1'),
+]
+
+
+def _create_tables(conn):
+    """Tables from models.py, and any columns older databases lack."""
+    db.metadata.create_all(conn)
+    _add_columns(conn)
+
+
+def _add_columns(conn):
+    """The _ADDED_COLUMNS a table does not have yet."""
+    inspector = inspect(conn)
+    existing = {}
+    for table, column, ddl in _ADDED_COLUMNS:
+        if table not in existing:
+            existing[table] = {c['name'] for c in inspector.get_columns(table)}
+        if column not in existing[table]:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def _create_indexes(conn):
+    """Indexes added to tables that already existed (create_all skips them)."""
+    for table in (Wine.__table__, TastingNote.__table__):
+        for index in table.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _install_search_index(conn):
+    search_index.install(conn)
+
+
+def _build_cellar_summary(conn):
+    cellar_summary.rebuild_all(conn)
+
+
+def _build_wine_varietals(conn):
+    wine_varietals.backfill(conn)
+
+
+def _build_inventory_ledger(conn):
+    """Fold consumed copies into inventory events; the owner of
+    wine_transactions.json gets its acquisition history."""
+    from apply_transactions import TXN_USER, load_transactions
+    _create_archive(conn)
+    InventoryEvent.__table__.create(conn, checkfirst=True)
+    transactions = {}
+    owner = conn.execute(select(User.id).where(User.username == TXN_USER)).scalar()
+    txns = load_transactions() if owner else None
+    if txns:
+        transactions[owner] = txns
+    inventory.sync(conn, transactions=transactions)
+
+
+def _create_archive(conn):
+    """archived_wines, where inventory.sync() moves the consumed copies."""
+    archived_wines.create(conn, checkfirst=True)
+
+
+def _repair_foreign_keys(conn):
+    """Clear what PRAGMA foreign_key_check finds, left from before SQLite
+    enforced foreign keys: a dangling nullable reference (parent_wine_id)
+    becomes NULL, a row whose required parent is gone is deleted.
+    PostgreSQL has always enforced them."""
+    if conn.dialect.name != 'sqlite':
+        return
+    while True:
+        orphans = conn.exec_driver_sql('PRAGMA foreign_key_check').all()
+        if not orphans:
+            return
+        fixes = []
+        for table, rowid, _, fkid in orphans:
+            column = next(fk[3] for fk in conn.exec_driver_sql(f'PRAGMA foreign_key_list({table})')
+                          if fk[0] == fkid)
+            nullable = next(not c[3] for c in conn.exec_driver_sql(f'PRAGMA table_info({table})')
+                            if c[1] == column)
+            fixes.append(f'UPDATE {table} SET {column} = NULL WHERE rowid = ?' if nullable
+                         else f'DELETE FROM {table} WHERE rowid = ?')
+        # Checked at commit, so a deleted wine's own notes can go on the
+        # next pass.  Set just before writing: until the first write opens
+        # the transaction, each statement commits and resets it.
+        conn.exec_driver_sql('PRAGMA defer_foreign_keys = ON')
+        for (_, rowid, _, _), fix in zip(orphans, fixes):
+            conn.exec_driver_sql(fix, (rowid,))
+
+
+# Append new steps; never reorder or remove them
+MIGRATIONS = [
+    (1, 'create tables and added columns', _create_tables),
+    (2, 'indexes on wines and tasting_notes', _create_indexes),
+    (3, 'full-text search index', _install_search_index),
+    (4, 'cellar summary', _build_cellar_summary),
+    (5, 'normalized wine varietals', _build_wine_varietals),
+    (6, 'inventory ledger', _build_inventory_ledger),
+    (7, 'wines.version_id for optimistic locking', _add_columns),
+    (8, 'archived_wines for folded consumed copies', _create_archive),
+    (9, 'dangling foreign keys from before they were enforced', _repair_foreign_keys),
+]
+
+
+def current_version(conn):
+    """The last migration applied, creating schema_version if needed."""
+    schema_version.create(conn, checkfirst=True)
+    version = conn.execute(select(schema_version.c.version)).scalar()
+    if version is None:
+        conn.execute(schema_version.insert().values(version=0))
+        version = 0
+    return version
+
+
+# pg_advisory_lock key for migrating and seeding
+_ADVISORY_LOCK = 0x77696e65
+
+
+@contextmanager
+def _exclusive(app):
+    """Hold the migration lock: a session advisory lock on PostgreSQL,
+    otherwise an exclusive lock on the MIGRATION_LOCK file."""
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': _ADVISORY_LOCK})
+            conn.commit()
+            try:
+                yield
+            finally:
+                conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': _ADVISORY_LOCK})
+                conn.commit()
+        return
+    lock_path = app.config.get('MIGRATION_LOCK')
+    if fcntl is None or not lock_path:
+        yield
+        return
+    with open(lock_path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def upgrade(app, log=print):
+    """Apply pending migrations; returns the number applied."""
+    with app.app_context(), _exclusive(app):
+        with db.engine.begin() as conn:
+            version = current_version(conn)
+        applied = 0
+        for number, description, step in MIGRATIONS:
+            if number <= version:
+                continue
+            with db.engine.begin() as conn:
+                step(conn)
+                conn.execute(schema_version.update().values(version=number))
+            log(f"Applied migration {number}: {description}")
+            applied += 1
+        return applied
+
+
+def _database_file(app):
+    with app.app_context():
+        url = db.engine.url
+    return url.database if url.get_backend_name() == 'sqlite' else None
+
+
+def restore_snapshot(app, snapshot=SNAPSHOT_PATH):
+    """Copy the seed snapshot into place when there is no database yet."""
+    path = _database_file(app)
+    if not path or not os.path.exists(snapshot):
+        return False
+    with _exclusive(app):
+        if os.path.exists(path) and os.path.getsize(path):
+            return False
+        partial = f'{path}.restoring'
+        shutil.copyfile(snapshot, partial)
+        os.replace(partial, path)
+    return True
+
+
+def write_snapshot(app, path):
+    """Write a compacted copy of the SQLite database to ``path``."""
+    if _database_file(app) is None:
+        raise ValueError('Seed snapshots are SQLite files; DATABASE_URL is not SQLite.')
+    if os.path.exists(path):
+        os.remove(path)
+    with app.app_context(), db.engine.connect() as conn:
+        conn.exec_driver_sql('VACUUM INTO ?', (os.path.abspath(path),))
+
+
+def seed_if_empty(app):
+    """Load the sample data into a database with no users."""
+    with _exclusive(app):
+        with app.app_context():
+            if User.query.first():
+                return False
+        try:
+            from seed import seed_database
+            seed_database()
+        except Exception as e:
+            print(f"Seed error: {e}")
+            return False
+        return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bring the database schema up to date.')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='do not load the sample data into an empty database')
+    parser.add_argument('--snapshot', metavar='PATH',
+                        help='then write the database to PATH as the seed snapshot')
+    args = parser.parse_args()
+    from app import app
+    if restore_snapshot(app):
+        print(f"Restored the database from {SNAPSHOT_PATH}")
+    if not upgrade(app):
+        print("Database schema is up to date.")
+    if not args.no_seed:
+        seed_if_empty(app)
+    if args.snapshot:
+        write_snapshot(app, args.snapshot)
+        print(f"Wrote seed snapshot to {args.snapshot}")
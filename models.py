@@ -1,10 +1,25 @@
+import json
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date
+from flask import g, has_request_context
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.ext.hybrid import hybrid_method
 
 db = SQLAlchemy()
 
+# Maturity stages in the order a bottle passes through them
+MATURITY_STAGES = ('Hold', 'Hold/Drink', 'Drink', 'Drink/Mature', 'Mature')
+
+
+def as_of_year():
+    """The year drinking windows are judged against: fixed for the whole
+    request (g.as_of_year, which a view may set), otherwise this year."""
+    if has_request_context():
+        return g.setdefault('as_of_year', date.today().year)
+    return date.today().year
+
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -14,6 +29,7 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    wine_version = db.Column(db.Integer, nullable=False, default=0)  # bumped by wine_versions.py
 
     wines = db.relationship('Wine', backref='owner', lazy='dynamic', cascade='all, delete-orphan')
     tasting_notes = db.relationship('TastingNote', backref='author', lazy='dynamic', cascade='all, delete-orphan')
@@ -25,10 +41,12 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
     def cellar_value(self):
-        return sum(w.price * w.quantity for w in self.wines.filter_by(status='cellar') if w.price)
+        return db.session.query(func.coalesce(func.sum(CellarSummary.value), 0)) \
+            .filter(CellarSummary.user_id == self.id).scalar()
 
     def total_bottles(self):
-        return sum(w.quantity for w in self.wines.filter_by(status='cellar'))
+        return db.session.query(func.coalesce(func.sum(CellarSummary.bottles), 0)) \
+            .filter(CellarSummary.user_id == self.id).scalar()
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -75,6 +93,8 @@ class Wine(db.Model):
     drink_from = db.Column(db.Integer)  # year
     drink_to = db.Column(db.Integer)    # year
     maturity_override = db.Column(db.String(30))  # Exact maturity from original site
+    # Loaded by list queries with with_expression(Wine.maturity, Wine.maturity_at(year))
+    maturity = db.query_expression()
 
     # Rating (1-100 scale)
     rating = db.Column(db.Integer)
@@ -83,25 +103,57 @@ class Wine(db.Model):
     parent_wine_id = db.Column(db.Integer, db.ForeignKey('wines.id'), nullable=True)
     original_quantity = db.Column(db.Integer)  # total originally acquired
 
+    # Optimistic locking: every UPDATE of the row through the ORM or
+    # inventory.py increments it and an ORM UPDATE of a row whose version
+    # moved on since it was loaded fails with StaleDataError
+    version_id = db.Column(db.Integer, nullable=False, default=1)
+
     # Relationships
     consumed_copies = db.relationship('Wine', backref=db.backref('parent_wine', remote_side='Wine.id'),
                                        lazy='dynamic', foreign_keys='Wine.parent_wine_id')
     tasting_notes = db.relationship('TastingNote', backref='wine', lazy='dynamic', cascade='all, delete-orphan')
+    inventory_events = db.relationship('InventoryEvent', backref='wine', lazy='dynamic',
+                                       cascade='all, delete-orphan', passive_deletes=True)
+
+    # Indexes for the per-user list filters (cellar/on order/consumed, ready to
+    # drink), consumption history lookups and the case-insensitive sort columns
+    __table_args__ = (
+        db.Index('ix_wines_user_status_on_order', user_id, status, on_order),
+        db.Index('ix_wines_user_status_drink_window', user_id, status, drink_from, drink_to),
+        db.Index('ix_wines_parent_date_consumed', parent_wine_id, date_consumed),
+        db.Index('ix_wines_user_date_added', user_id, date_added),
+        db.Index('ix_wines_user_status_lower_name', user_id, status, func.lower(name)),
+        db.Index('ix_wines_user_status_lower_producer', user_id, status, func.lower(producer)),
+    )
+    __mapper_args__ = {'version_id_col': version_id}
+
+    @property
+    def varietal_slots(self):
+        """(position, name) for each filled varietal column."""
+        slots = [self.varietal1, self.varietal2, self.varietal3, self.varietal4]
+        return [(i, v) for i, v in enumerate(slots, 1) if v]
 
     @property
     def varietals_display(self):
         """Return hyphen-separated list of varietals (matching ManageYourCellar format)."""
-        parts = [v for v in [self.varietal1, self.varietal2, self.varietal3, self.varietal4] if v]
+        parts = [v for _, v in self.varietal_slots]
         return ' - '.join(parts) if parts else ''
 
+    @hybrid_method
+    def is_ready_at(self, year):
+        """Whether ``year`` falls inside the drinking window (which needs a
+        start year; no end year means it stays open)."""
+        if self.drink_from is None:
+            return False
+        return self.drink_from <= year and (self.drink_to is None or year <= self.drink_to)
+
+    @is_ready_at.expression
+    def is_ready_at(cls, year):
+        return and_(cls.drink_from <= year, or_(cls.drink_to >= year, cls.drink_to.is_(None)))
+
     @property
     def is_ready_to_drink(self):
-        current_year = date.today().year
-        if not self.drink_from:
-            return False
-        if self.drink_to:
-            return self.drink_from <= current_year <= self.drink_to
-        return current_year >= self.drink_from
+        return self.is_ready_at(as_of_year())
 
     @property
     def drinking_window_display(self):
@@ -121,39 +173,55 @@ class Wine(db.Model):
             return f"{self.size_ml / 1000:.1f}L"
         return f"{self.size_ml}ml"
 
-    @property
-    def maturity_display(self):
-        """Return maturity text matching ManageYourCellar format."""
+    @hybrid_method
+    def maturity_at(self, year):
+        """Maturity in ``year`` matching ManageYourCellar format: one of
+        MATURITY_STAGES, the stored override, or '' without a window."""
         if self.maturity_override:
             return self.maturity_override
-        current_year = date.today().year
-        if not self.drink_from and not self.drink_to:
-            return ''
-        if self.drink_to and current_year > self.drink_to:
+        if self.drink_to and year > self.drink_to:
             return 'Mature'
         if self.drink_from and self.drink_to:
-            if current_year < self.drink_from:
+            if year < self.drink_from:
                 return 'Hold'
-            elif current_year >= self.drink_from and current_year <= self.drink_to:
-                mid = (self.drink_from + self.drink_to) / 2
-                if current_year < mid:
-                    return 'Hold/Drink'
-                else:
-                    return 'Drink'
-            else:
-                return 'Drink/Mature'
+            # Before the middle of the window
+            return 'Hold/Drink' if 2 * year < self.drink_from + self.drink_to else 'Drink'
         if self.drink_from:
-            if current_year < self.drink_from:
-                return 'Hold'
-            elif current_year >= self.drink_from:
-                return 'Drink'
+            return 'Hold' if year < self.drink_from else 'Drink'
         if self.drink_to:
-            if current_year <= self.drink_to:
-                return 'Drink'
-            else:
-                return 'Mature'
+            return 'Drink'
         return ''
 
+    @maturity_at.expression
+    def maturity_at(cls, year):
+        # NULL and 0 count as unset, as in the Python version
+        has_from, has_to = cls.drink_from != 0, cls.drink_to != 0
+        return case(
+            (func.coalesce(cls.maturity_override, '') != '', cls.maturity_override),
+            (and_(has_to, cls.drink_to < year), 'Mature'),
+            (and_(has_from, has_to, cls.drink_from > year), 'Hold'),
+            (and_(has_from, has_to, cls.drink_from + cls.drink_to > 2 * year), 'Hold/Drink'),
+            (and_(has_from, has_to), 'Drink'),
+            (and_(has_from, cls.drink_from > year), 'Hold'),
+            (or_(has_from, has_to), 'Drink'),
+            else_='',
+        )
+
+    @classmethod
+    def maturity_rank_at(cls, year):
+        """Position of the maturity in MATURITY_STAGES (from 1), for sorting;
+        0 for no window or an override outside the stages."""
+        return case({stage: i for i, stage in enumerate(MATURITY_STAGES, 1)},
+                    value=cls.maturity_at(year), else_=0)
+
+    @property
+    def maturity_display(self):
+        """Maturity as loaded by the list query, or worked out for the
+        request's as-of year."""
+        if self.maturity is not None:
+            return self.maturity
+        return self.maturity_at(as_of_year())
+
     @property
     def rating_text(self):
         """Convert numeric rating to text matching ManageYourCellar format."""
@@ -186,20 +254,21 @@ class Wine(db.Model):
         parts.append(name_with_size)
         return parts
 
+    def inventory_totals(self):
+        """(acquired, consumed, on hand) bottles from the inventory ledger."""
+        return InventoryEvent.totals(self.id)
+
     @property
     def total_acquired(self):
-        """Total bottles originally acquired (from original_quantity or current quantity)."""
-        return self.original_quantity or self.quantity
+        return self.inventory_totals()[0]
 
     @property
     def total_consumed(self):
-        """Total bottles consumed (count from linked consumed copies)."""
-        return sum(c.quantity for c in self.consumed_copies.all())
+        return self.inventory_totals()[1]
 
     @property
     def actual_in_cellar(self):
-        """Actual bottles remaining in cellar."""
-        return self.total_acquired - self.total_consumed
+        return self.inventory_totals()[2]
 
     @property
     def has_rating(self):
@@ -228,5 +297,189 @@ class TastingNote(db.Model):
     score = db.Column(db.Integer)              # 1-100
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_tasting_notes_wine_date', wine_id, tasting_date),
+        db.Index('ix_tasting_notes_user_date', user_id, tasting_date),
+    )
+
     def __repr__(self):
         return f'<TastingNote {self.wine_id} by {self.user_id}>'
+
+
+class InventoryEvent(db.Model):
+    """One change to a wine's bottle count: an acquisition, a consumption
+    or an adjustment (a correction, breakage, a gift given away).
+
+    The ledger is the record of what happened; ``quantity`` is signed
+    (consumptions are negative) so a wine's events sum to its
+    Wine.quantity, which inventory.py keeps as the running balance.
+    """
+    __tablename__ = 'inventory_events'
+
+    ACQUIRE, CONSUME, ADJUST = 'acquire', 'consume', 'adjust'
+
+    id = db.Column(db.Integer, primary_key=True)
+    wine_id = db.Column(db.Integer, db.ForeignKey('wines.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)     # acquire, consume, adjust
+    event_date = db.Column(db.Date)
+    quantity = db.Column(db.Integer, nullable=False)    # bottles, signed
+    price = db.Column(db.Float)                         # per bottle: paid, or estimated when consumed
+    party = db.Column(db.String(200))                   # bought from / shared with
+    location = db.Column(db.String(200))                # where the bottles are (or were) stored
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_inventory_events_wine_kind', wine_id, kind, quantity),
+        db.Index('ix_inventory_events_user_kind_date', user_id, kind, event_date),
+    )
+
+    @classmethod
+    def totals(cls, wine_id):
+        """(acquired, consumed, on hand) for one wine, from one aggregate
+        over ix_inventory_events_wine_kind."""
+        rows = dict(db.session.query(cls.kind, func.sum(cls.quantity))
+                    .filter(cls.wine_id == wine_id).group_by(cls.kind).all())
+        acquired = rows.get(cls.ACQUIRE) or 0
+        consumed = -(rows.get(cls.CONSUME) or 0)
+        return acquired, consumed, sum(v or 0 for v in rows.values())
+
+    def __repr__(self):
+        return f'<InventoryEvent {self.wine_id} {self.kind} {self.quantity}>'
+
+
+# Consumed copies (status='consumed' rows with a parent_wine_id) that
+# inventory.sync() folded into their parents' consume events: the whole
+# wines row as it was, kept out of the lists, plus when it was archived
+archived_wines = db.Table(
+    'archived_wines',
+    *(db.Column(c.name, c.type, primary_key=c.primary_key) for c in Wine.__table__.columns),
+    db.Column('archived_at', db.DateTime, server_default=func.current_timestamp()),
+    db.Index('ix_archived_wines_parent', 'parent_wine_id'),
+)
+
+
+class CellarSummary(db.Model):
+    """Running cellar totals per user, wine type and on-order flag.
+
+    Maintained incrementally on every flush by cellar_summary.py; run
+    rebuild_summary.py to verify or repair it.
+    """
+    __tablename__ = 'cellar_summary'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    wine_type = db.Column(db.String(30), primary_key=True, default='')
+    on_order = db.Column(db.Boolean, primary_key=True, default=False)
+
+    wines = db.Column(db.Integer, nullable=False, default=0)
+    bottles = db.Column(db.Integer, nullable=False, default=0)
+    value = db.Column(db.Float, nullable=False, default=0)
+    ready_wines = db.Column(db.Integer, nullable=False, default=0)
+    ready_bottles = db.Column(db.Integer, nullable=False, default=0)
+    ready_year = db.Column(db.Integer)  # year the ready_* counts were computed for
+
+    def __repr__(self):
+        return f'<CellarSummary {self.user_id} {self.wine_type} {self.bottles}>'
+
+
+class Varietal(db.Model):
+    """Lookup table of grape varietal names."""
+    __tablename__ = 'varietals'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+
+    def __repr__(self):
+        return f'<Varietal {self.name}>'
+
+
+class WineVarietal(db.Model):
+    """One varietal of a wine, in the position it is listed on the label.
+
+    Mirrors Wine.varietal1-4 (which stay the editable fields); kept in step
+    on every flush by wine_varietals.py.
+    """
+    __tablename__ = 'wine_varietals'
+
+    wine_id = db.Column(db.Integer, db.ForeignKey('wines.id', ondelete='CASCADE'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)  # 1-4, the varietalN column
+    varietal_id = db.Column(db.Integer, db.ForeignKey('varietals.id'), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_wine_varietals_varietal_wine', varietal_id, wine_id),
+    )
+
+    def __repr__(self):
+        return f'<WineVarietal {self.wine_id} {self.position} {self.varietal_id}>'
+
+
+class ImportRun(db.Model):
+    """Progress of one CSV import, so an interrupted file can be resumed.
+
+    Written by csv_import.py after every committed chunk; a run is matched
+    to a re-uploaded file by the SHA-1 of its contents.
+    """
+    __tablename__ = 'import_runs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    filename = db.Column(db.String(255))
+    fingerprint = db.Column(db.String(40), nullable=False)  # SHA-1 of the file
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, done, failed, abandoned
+    rows_done = db.Column(db.Integer, nullable=False, default=0)  # data rows committed
+    wines = db.Column(db.Integer, nullable=False, default=0)
+    notes = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text)                  # "line N: message", one per line
+    first_wine_id = db.Column(db.Integer)        # lowest wines.id this run inserted
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_import_runs_user_fingerprint', user_id, fingerprint),
+    )
+
+    def __repr__(self):
+        return f'<ImportRun {self.id} {self.filename} {self.status} {self.rows_done}>'
+
+
+class Job(db.Model):
+    """A background job (CSV import, transaction replay) run by jobs.py.
+
+    Rows outlive the process: jobs still queued, or running with a stale
+    heartbeat, are picked up again when the web app starts.
+    """
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    kind = db.Column(db.String(30), nullable=False)            # import, replay
+    params = db.Column(db.Text)                                 # JSON arguments for the handler
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    done = db.Column(db.Integer, nullable=False, default=0)     # units of work finished
+    total = db.Column(db.Integer)                               # units expected, if known
+    message = db.Column(db.Text)                                # latest progress line or error
+    result = db.Column(db.Text)                                 # JSON summary once done
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_heartbeat', status, heartbeat_at),
+        db.Index('ix_jobs_user_created', user_id, created_at),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id, 'kind': self.kind, 'status': self.status,
+            'done': self.done, 'total': self.total, 'message': self.message,
+            'result': json.loads(self.result) if self.result else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
@@ -0,0 +1,120 @@
+"""SQL-side pagination for the list pages (cellar, ready to drink, ...).
+
+Pages are fetched with LIMIT/OFFSET, or with a keyset "seek" on
+(sort column, id) when the request carries a cursor taken from the
+neighbouring page, so deep pages don't pay for every row they skip.
+"""
+import base64
+import json
+from datetime import date, datetime
+
+from sqlalchemy import and_, or_
+
+PAGE_SIZE = 50
+
+
+class Page:
+    """One page of results plus the cursors needed to reach its neighbours."""
+
+    def __init__(self, items, page, total_pages, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.page = page
+        self.total_pages = total_pages
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def encode_cursor(sort_key, value, row_id):
+    """Pack (sort key, sort value, row id) into an opaque URL-safe token."""
+    if isinstance(value, datetime):
+        value = {'dt': value.isoformat()}
+    elif isinstance(value, date):
+        value = {'d': value.isoformat()}
+    raw = json.dumps([sort_key, value, row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, sort_key):
+    """Return (value, row_id) for a cursor, or None if it is invalid or
+    was issued for a different sort order."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        cursor_sort, value, row_id = json.loads(raw.decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if cursor_sort != sort_key or not isinstance(row_id, int):
+        return None
+    if isinstance(value, dict):
+        try:
+            if 'dt' in value:
+                value = datetime.fromisoformat(value['dt'])
+            elif 'd' in value:
+                value = date.fromisoformat(value['d'])
+            else:
+                return None
+        except (TypeError, ValueError):
+            return None
+    return value, row_id
+
+
+def _order_by(sort_col, id_col, descending, id_descending=False):
+    # NULLs sort first ascending and last descending (SQLite's default),
+    # spelled out so the seek predicates below match on any backend.
+    sort = sort_col.desc().nulls_last() if descending else sort_col.asc().nulls_first()
+    return [sort, id_col.desc() if id_descending else id_col.asc()]
+
+
+def _seek(sort_col, id_col, value, row_id, descending, id_descending=False):
+    """Rows strictly after (value, row_id) in the matching _order_by() ordering."""
+    id_after = id_col < row_id if id_descending else id_col > row_id
+    if descending:
+        if value is None:
+            return and_(sort_col.is_(None), id_after)
+        return or_(sort_col < value, and_(sort_col == value, id_after), sort_col.is_(None))
+    if value is None:
+        return or_(and_(sort_col.is_(None), id_after), sort_col.isnot(None))
+    return or_(sort_col > value, and_(sort_col == value, id_after))
+
+
+def paginate(query, sort_col, id_col, total, page=1, sort_key='', descending=False,
+             after=None, before=None, show_all=False, per_page=PAGE_SIZE, id_descending=False):
+    """Fetch one page of ``query`` ordered by ``sort_col`` then ``id_col``.
+
+    ``total`` is the row count of the filtered query (callers usually get it
+    from the same aggregate query as their other totals).  ``after``/``before``
+    are cursors from the neighbouring page; when one is valid for
+    ``sort_key`` the page is fetched with a keyset seek instead of OFFSET.
+    Ties on ``sort_col`` are broken by ascending id unless ``id_descending``.
+    """
+    total_pages = max(1, (total + per_page - 1) // per_page)
+    page = min(max(page, 1), total_pages)
+    query = query.add_columns(sort_col).order_by(None)
+
+    if show_all:
+        rows = query.order_by(*_order_by(sort_col, id_col, descending, id_descending)).all()
+        return Page([r[0] for r in rows], 1, total_pages)
+
+    rows = None
+    seek_after = decode_cursor(after, sort_key)
+    seek_before = decode_cursor(before, sort_key)
+    if seek_after:
+        rows = query.filter(_seek(sort_col, id_col, *seek_after, descending, id_descending)) \
+            .order_by(*_order_by(sort_col, id_col, descending, id_descending)).limit(per_page).all()
+    elif seek_before:
+        # Walk backwards from the cursor, then restore display order
+        rows = query.filter(_seek(sort_col, id_col, *seek_before, not descending, not id_descending)) \
+            .order_by(*_order_by(sort_col, id_col, not descending, not id_descending)).limit(per_page).all()
+        rows.reverse()
+    if not rows:
+        rows = query.order_by(*_order_by(sort_col, id_col, descending, id_descending)) \
+            .offset((page - 1) * per_page).limit(per_page).all()
+
+    items = [r[0] for r in rows]
+    next_cursor = prev_cursor = None
+    if rows and page < total_pages:
+        next_cursor = encode_cursor(sort_key, rows[-1][1], rows[-1][0].id)
+    if rows and page > 1:
+        prev_cursor = encode_cursor(sort_key, rows[0][1], rows[0][0].id)
+    return Page(items, page, total_pages, next_cursor, prev_cursor)
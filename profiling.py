@@ -0,0 +1,200 @@
+"""Opt-in per-request profiling and SQL statement counting.
+
+With PROFILE_REQUESTS set (app.config, or the environment variable) every
+request records its wall time, the number of SQL statements and the time
+spent in them, the ORM objects loaded (orm_rows; rows read by Core
+statements are not counted) and the time spent rendering templates.  The
+figures go out as X-Perf-* and Server-Timing response headers and as one
+JSON log line per request on the ``perf`` logger.  When the app also runs
+in debug mode, /debug/perf shows the slowest recent requests and
+per-endpoint averages; it lists every user's requests, so it is not
+served otherwise.
+A streamed body (the CSV export) is produced after the headers are sent,
+so only the statements run before streaming starts are counted.
+
+max_queries() works whether or not profiling is on: it fails a block of
+code (typically a test-client request) that issues more statements than
+expected, listing them.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import abort, current_app, g, has_request_context, render_template, request, \
+    template_rendered, before_render_template
+from flask_login import login_required
+from sqlalchemy import event
+
+from models import db
+
+RECENT = 200
+
+log = logging.getLogger('perf')
+
+_recent = deque(maxlen=RECENT)
+_recent_lock = threading.Lock()
+
+
+class Profile:
+    """Counters for one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.orm_rows = 0
+        self.template_time = 0.0
+        self._template_started = []
+
+    def as_dict(self):
+        return {
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'queries': self.queries,
+            'sql_ms': round(self.sql_time * 1000, 2),
+            'orm_rows': self.orm_rows,
+            'template_ms': round(self.template_time * 1000, 2),
+        }
+
+
+def _current():
+    return g.get('perf') if has_request_context() else None
+
+
+# The start time is kept on the statement's execution context, so a
+# statement that raises (and never reaches after_cursor_execute) leaves
+# nothing behind on its pooled connection
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._perf_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_perf_started', None)
+    profile = _current()
+    if profile is not None:
+        profile.queries += 1
+        if started is not None:
+            profile.sql_time += time.perf_counter() - started
+
+
+def _on_load(target, context):
+    profile = _current()
+    if profile is not None:
+        profile.orm_rows += 1
+
+
+def _before_render(sender, template, context, **extra):
+    profile = _current()
+    if profile is not None:
+        profile._template_started.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    profile = _current()
+    if profile is not None and profile._template_started:
+        profile.template_time += time.perf_counter() - profile._template_started.pop()
+
+
+def _start():
+    g.perf = Profile()
+
+
+def _finish(response):
+    profile = g.pop('perf', None)
+    if profile is None:
+        return response
+    record = profile.as_dict()
+    record['status'] = response.status_code
+    response.headers['X-Perf-Time-Ms'] = str(record['ms'])
+    response.headers['X-Perf-Queries'] = str(record['queries'])
+    response.headers['X-Perf-SQL-Ms'] = str(record['sql_ms'])
+    response.headers['X-Perf-ORM-Rows'] = str(record['orm_rows'])
+    response.headers['X-Perf-Template-Ms'] = str(record['template_ms'])
+    response.headers['Server-Timing'] = (
+        f'sql;dur={record["sql_ms"]};desc="{record["queries"]} queries", '
+        f'tpl;dur={record["template_ms"]}, total;dur={record["ms"]}'
+    )
+    log.info(json.dumps(record))
+    with _recent_lock:
+        _recent.append(record)
+    return response
+
+
+def _endpoint_summary(records):
+    by_endpoint = {}
+    for r in records:
+        by_endpoint.setdefault(r['endpoint'] or r['path'], []).append(r)
+    summary = []
+    for endpoint, rs in by_endpoint.items():
+        summary.append({
+            'endpoint': endpoint,
+            'requests': len(rs),
+            'avg_ms': round(sum(r['ms'] for r in rs) / len(rs), 2),
+            'max_ms': max(r['ms'] for r in rs),
+            'avg_queries': round(sum(r['queries'] for r in rs) / len(rs), 1),
+            'max_queries': max(r['queries'] for r in rs),
+        })
+    return sorted(summary, key=lambda s: s['avg_ms'], reverse=True)
+
+
+@login_required
+def debug_perf():
+    if not current_app.debug:
+        abort(404)
+    with _recent_lock:
+        records = list(_recent)
+    slowest = sorted(records, key=lambda r: r['ms'], reverse=True)[:25]
+    return render_template('debug_perf.html', endpoints=_endpoint_summary(records),
+                           slowest=slowest, recent=len(records))
+
+
+def init_app(app):
+    """Install the request hooks when PROFILE_REQUESTS is set."""
+    enabled = app.config.get('PROFILE_REQUESTS', os.environ.get('PROFILE_REQUESTS'))
+    if not enabled or enabled in ('0', 'false', 'False'):
+        return False
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(db.Model, 'load', _on_load, propagate=True)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.add_url_rule('/debug/perf', 'debug_perf', debug_perf)
+    if not log.handlers and not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO)
+    log.setLevel(logging.INFO)
+    return True
+
+
+@contextmanager
+def max_queries(limit, engine=None):
+    """Fail with AssertionError if the block runs more than ``limit`` SQL
+    statements.  Needs an app context unless ``engine`` is given.
+
+        with max_queries(5):
+            client.get('/tastings')
+    """
+    engine = engine or db.engine
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'after_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'after_cursor_execute', count)
+    if len(statements) > limit:
+        listing = '\n'.join(f'  {i}. {s.strip()[:200]}' for i, s in enumerate(statements, 1))
+        raise AssertionError(f'{len(statements)} SQL statements, expected at most {limit}:\n{listing}')
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Verify the cellar_summary table against the wines table and repair it.
+Usage: python rebuild_summary.py [--check]
+"""
+import sys
+from app import app, db
+from cellar_summary import rebuild_all, verify
+
+
+def rebuild_summary(check_only=False):
+    with app.app_context():
+        conn = db.session.connection()
+        mismatched = verify(conn)
+        for key, have, want in mismatched:
+            print(f"  user {key[0]} type {key[1] or '-'!r} on_order={key[2]}: "
+                  f"stored {have}, expected {want}")
+        if not mismatched:
+            print("Cellar summary is up to date.")
+            return 0
+        print(f"{len(mismatched)} summary row(s) out of date.")
+        if check_only:
+            return 1
+        rebuild_all(conn)
+        db.session.commit()
+        print("Rebuilt cellar summary.")
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(rebuild_summary(check_only='--check' in sys.argv[1:]))
@@ -0,0 +1,230 @@
+"""Full-text search for the Wine Finder box.
+
+On SQLite it is backed by an FTS5 table.
+
+``wines_fts`` mirrors the searchable text of every wine (rowid = wines.id)
+and is kept in sync by triggers on ``wines``, so ORM writes, bulk deletes
+and the seed/import scripts all update it without extra code.  The
+unicode61 tokenizer folds case and diacritics (Rosé/rose,
+Gewürztraminer/gewurztraminer) and every search term is matched as a prefix.
+
+On PostgreSQL the same columns, with the same relative weights, form one
+weighted tsvector expression behind a GIN expression index; the query
+repeats the indexed expression so the planner can use it.  Words are
+matched as prefixes there too, though without diacritic folding (unaccent
+cannot be used in an index).  pg_trgm indexes on the searched columns back
+the ILIKE fallback used for input with no words.
+
+If the SQLite build has no FTS5 (so the migration could not create the
+table) the routes fall back to the old ILIKE scan.
+"""
+import re
+
+from sqlalchemy import Float, Integer, Text, cast, func, inspect, literal_column, or_, select, text
+
+from models import db, Wine
+
+FTS_TABLE = 'wines_fts'
+
+# bm25 column weights: name, producer, vintage, varietals, appellation, acq_from
+_WEIGHTS = '10.0, 6.0, 2.0, 4.0, 3.0, 1.0'
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_backend = None  # 'fts5', 'tsvector' or 'like'; decided by backend() on first use
+
+_FTS_VALUES = """
+    new.id, new.name, new.producer, coalesce(new.vintage, ''),
+    coalesce(new.varietal1, '') || ' ' || coalesce(new.varietal2, '') || ' ' ||
+    coalesce(new.varietal3, '') || ' ' || coalesce(new.varietal4, ''),
+    coalesce(new.appellation, ''), coalesce(new.acq_from, '')
+"""
+
+_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        name, producer, vintage, varietals, appellation, acq_from,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS wines_fts_insert AFTER INSERT ON wines BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, producer, vintage, varietals, appellation, acq_from)
+        VALUES ({_FTS_VALUES});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS wines_fts_delete AFTER DELETE ON wines BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS wines_fts_update AFTER UPDATE OF
+        name, producer, vintage, varietal1, varietal2, varietal3, varietal4, appellation, acq_from
+        ON wines BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+        INSERT INTO {FTS_TABLE}(rowid, name, producer, vintage, varietals, appellation, acq_from)
+        VALUES ({_FTS_VALUES});
+    END""",
+]
+
+
+# Columns the ILIKE fallback searches, given pg_trgm indexes on PostgreSQL
+_LIKE_COLUMNS = ('name', 'producer', 'varietal1', 'varietal2', 'varietal3', 'varietal4',
+                 'appellation', 'acq_from')
+
+_PG_CONFIG = literal_column("'simple'::regconfig")
+
+
+def _pg_document():
+    """The weighted tsvector of a wine (A highest): name; producer;
+    varietals and appellation; vintage and source.  Constants are inlined
+    so the query text matches the index expression whatever the driver's
+    parameter style."""
+    empty, space = literal_column("''"), literal_column("' '")
+
+    def weighted(expr, weight):
+        return func.setweight(func.to_tsvector(_PG_CONFIG, func.coalesce(expr, empty)),
+                              literal_column(f"'{weight}'"))
+    varietals = func.coalesce(Wine.varietal1, empty)
+    for column in (Wine.varietal2, Wine.varietal3, Wine.varietal4):
+        varietals = varietals.op('||')(space).op('||')(func.coalesce(column, empty))
+    parts = [
+        weighted(Wine.name, 'A'), weighted(Wine.producer, 'B'),
+        weighted(varietals, 'C'), weighted(Wine.appellation, 'C'),
+        weighted(cast(Wine.vintage, Text), 'D'), weighted(Wine.acq_from, 'D'),
+    ]
+    document = parts[0]
+    for part in parts[1:]:
+        document = document.op('||')(part)
+    return document
+
+
+def _install_postgresql(conn):
+    document = _pg_document().compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True})
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_wines_search ON wines USING gin (({document}))'))
+    try:
+        with conn.begin_nested():
+            conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            for column in _LIKE_COLUMNS:
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_wines_{column}_trgm '
+                                  f'ON wines USING gin ({column} gin_trgm_ops)'))
+    except Exception as e:
+        print(f"pg_trgm unavailable, substring search will not be indexed: {e}")
+
+
+def install(conn):
+    """Create the FTS table and triggers, rebuilding the index if it is out
+    of step with ``wines`` (new database, or rows written before install).
+    On PostgreSQL, create the search indexes instead."""
+    global _backend
+    _backend = None
+    if conn.dialect.name == 'postgresql':
+        _install_postgresql(conn)
+        return
+    if conn.dialect.name != 'sqlite':
+        return
+    try:
+        with conn.begin_nested():
+            for ddl in _DDL:
+                conn.execute(text(ddl))
+            indexed = conn.execute(text(f'SELECT count(*) FROM {FTS_TABLE}')).scalar()
+            total = conn.execute(text('SELECT count(*) FROM wines')).scalar()
+            if indexed != total:
+                rebuild(conn)
+    except Exception as e:
+        print(f"Full-text search unavailable, using LIKE search: {e}")
+
+
+def backend():
+    """'fts5' when the FTS table exists, 'tsvector' on PostgreSQL, otherwise
+    'like'; checked once per process."""
+    global _backend
+    if _backend is None:
+        bind = db.session.get_bind()
+        if bind.dialect.name == 'postgresql':
+            _backend = 'tsvector'
+        elif bind.dialect.name == 'sqlite' and inspect(bind).has_table(FTS_TABLE):
+            _backend = 'fts5'
+        else:
+            _backend = 'like'
+    return _backend
+
+
+def rebuild(conn):
+    """Repopulate the FTS table from ``wines``."""
+    conn.execute(text(f'DELETE FROM {FTS_TABLE}'))
+    conn.execute(text(f"""
+        INSERT INTO {FTS_TABLE}(rowid, name, producer, vintage, varietals, appellation, acq_from)
+        SELECT {_FTS_VALUES.replace('new.', '')} FROM wines
+    """))
+
+
+def _tokens(search_text):
+    return _TOKEN_RE.findall(search_text or '')
+
+
+def match_expression(search_text):
+    """Turn free text into an FTS5 query: every word must match as a prefix."""
+    tokens = _tokens(search_text)
+    if not tokens:
+        return None
+    return ' '.join(f'"{t}"*' for t in tokens)
+
+
+def _pg_query(search_text):
+    """The tsquery for free text (every word as a prefix), or None."""
+    tokens = _tokens(search_text)
+    if not tokens:
+        return None
+    return func.to_tsquery(_PG_CONFIG, ' & '.join(f'{t.lower()}:*' for t in tokens))
+
+
+def _ranked(expr):
+    return text(
+        f'SELECT rowid AS wine_id, bm25({FTS_TABLE}, {_WEIGHTS}) AS rank '
+        f'FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :fts_query'
+    ).bindparams(fts_query=expr).columns(wine_id=Integer, rank=Float).subquery('fts')
+
+
+def _like_condition(search_text):
+    search_term = f"%{search_text}%"
+    or_conditions = [
+        Wine.name.ilike(search_term),
+        Wine.producer.ilike(search_term),
+        Wine.varietal1.ilike(search_term),
+        Wine.varietal2.ilike(search_term),
+        Wine.varietal3.ilike(search_term),
+        Wine.varietal4.ilike(search_term),
+        Wine.appellation.ilike(search_term),
+        Wine.acq_from.ilike(search_term),
+    ]
+    try:
+        year = int(search_text.strip())
+        if 1900 <= year <= 2100:
+            or_conditions.append(Wine.vintage == year)
+    except ValueError:
+        pass
+    return or_(*or_conditions)
+
+
+def filter_wines(query, search_text):
+    """Restrict a Wine query to rows matching ``search_text``."""
+    search = backend()
+    if search == 'tsvector':
+        tsquery = _pg_query(search_text)
+        if tsquery is not None:
+            return query.filter(_pg_document().op('@@')(tsquery))
+    expr = match_expression(search_text) if search == 'fts5' else None
+    if not expr:
+        return query.filter(_like_condition(search_text))
+    return query.filter(Wine.id.in_(select(_ranked(expr).c.wine_id)))
+
+
+def rank_wines(query, search_text):
+    """Restrict a Wine query to rows matching ``search_text``, best match first."""
+    search = backend()
+    if search == 'tsvector':
+        tsquery = _pg_query(search_text)
+        if tsquery is not None:
+            document = _pg_document()
+            return query.filter(document.op('@@')(tsquery)) \
+                .order_by(func.ts_rank(document, tsquery).desc(), Wine.name)
+    expr = match_expression(search_text) if search == 'fts5' else None
+    if not expr:
+        return query.filter(_like_condition(search_text)).order_by(Wine.name)
+    fts = _ranked(expr)
+    return query.join(fts, fts.c.wine_id == Wine.id).order_by(fts.c.rank, Wine.name)
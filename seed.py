@@ -2,6 +2,10 @@
 from datetime import date, datetime
 from app import app, db
 from models import User, Wine, TastingNote
+from migrations import upgrade
+from wine_names import parse as parse_wine_name, name_key
+from apply_transactions import load_transactions
+import inventory
 
 SAMPLE_WINES = [
     {
@@ -440,6 +444,7 @@ def seed_database():
             )
             db.session.add(note)
 
+        inventory.sync(db.session.connection(), user_ids=[user.id, user2.id])
         db.session.commit()
         print("Database seeded successfully!")
         print(f"  - Created users: demo (password: demo123), winelover (password: wine123)")
@@ -606,7 +611,7 @@ def _seed_bread_user():
     # Adjust bottle count to 690
     cellar_check = Wine.query.filter_by(user_id=user.id, status='cellar').filter(
         db.or_(Wine.on_order == False, Wine.on_order.is_(None))
-    ).all()
+    ).order_by(Wine.id).all()
     btl = sum(w.quantity for w in cellar_check)
     if btl != 690:
         diff = btl - 690
@@ -628,10 +633,10 @@ def _seed_bread_user():
         print(f"  - Adjusted cellar bottles to 690")
 
     # Propagate tasting note scores to wine ratings
-    all_wines = Wine.query.filter_by(user_id=user.id).all()
+    all_wines = Wine.query.filter_by(user_id=user.id).order_by(Wine.id).all()
     rating_count = 0
     for w in all_wines:
-        notes_list = TastingNote.query.filter_by(wine_id=w.id).all()
+        notes_list = TastingNote.query.filter_by(wine_id=w.id).order_by(TastingNote.id).all()
         scores = [n.score for n in notes_list if n.score]
         if scores:
             w.rating = max(scores)
@@ -749,12 +754,20 @@ def _seed_bread_user():
     db.session.commit()
     print("  - Committed all post-processing fixes")
 
+    # Fold the consumed copies into the inventory ledger, with the
+    # acquisition history from wine_transactions.json
+    txns = load_transactions()
+    events = inventory.sync(db.session.connection(), user_ids=[user.id],
+                            transactions={user.id: txns} if txns else None)
+    db.session.commit()
+    print(f"  - Recorded {events} inventory events")
+
 
 def _reassociate_tasting_notes(user_id):
     """Move tasting notes from cellar wines to their consumed copies, using the consumption date."""
     cellar_wines = Wine.query.filter_by(user_id=user_id, status='cellar').filter(
         db.or_(Wine.on_order == False, Wine.on_order.is_(None))
-    ).all()
+    ).order_by(Wine.id).all()
 
     fixed = 0
     for cw in cellar_wines:
@@ -778,7 +791,7 @@ def _reassociate_tasting_notes(user_id):
 def _propagate_tasting_ratings(user_id):
     """After tasting notes have been reassociated to consumed copies, propagate their scores to wine ratings."""
     from models import TastingNote
-    notes = TastingNote.query.filter_by(user_id=user_id).all()
+    notes = TastingNote.query.filter_by(user_id=user_id).order_by(TastingNote.id).all()
     updated = 0
     for note in notes:
         if note.score:
@@ -808,37 +821,24 @@ def _apply_tasting_note_details(user_id):
     with open(mapping_path) as f:
         txns = json.load(f)
 
-    def _norm(name):
-        return re.sub(r'\s+', ' ', (name or '').lower().strip())
-
-    def _parse_wine_name(full_name):
-        full_name = re.sub(r'\s*RATED\s*$', '', full_name.strip())
-        m = re.match(r'^(\d{4})\s+(.+?)\s*\(\d+(?:\.\d+)?(?:ml|l)\)\s*$', full_name, re.I)
-        if m:
-            return int(m.group(1)), m.group(2).strip()
-        m2 = re.match(r'^(.+?)\s*\(\d+(?:\.\d+)?(?:ml|l)\)\s*$', full_name, re.I)
-        if m2:
-            return None, m2.group(1).strip()
-        return None, full_name
-
     # Build lookup: orig_id -> (vintage, name)
     orig_lookup = {}
     for tx in txns:
         if 'error' in tx:
             continue
-        vintage, name = _parse_wine_name(tx['wine_name'])
-        orig_lookup[tx['wine_id']] = (vintage, _norm(name))
+        vintage, name, _ = parse_wine_name(tx['wine_name'])
+        orig_lookup[tx['wine_id']] = (vintage, name_key(name))
 
     # Build reverse lookup: (vintage, norm_name) -> orig_id
     name_to_orig = {v: k for k, v in orig_lookup.items()}
 
     # Get all wines for user
-    all_wines = Wine.query.filter_by(user_id=user_id).all()
+    all_wines = Wine.query.filter_by(user_id=user_id).order_by(Wine.id).all()
     wine_by_id = {w.id: w for w in all_wines}
 
     # Build mapping: orig_id -> our wine ids with tasting notes
     from models import TastingNote
-    all_notes = TastingNote.query.filter_by(user_id=user_id).all()
+    all_notes = TastingNote.query.filter_by(user_id=user_id).order_by(TastingNote.id).all()
 
     orig_to_notes = {}
     for note in all_notes:
@@ -849,7 +849,7 @@ def _apply_tasting_note_details(user_id):
         check_w = w
         if w.parent_wine_id and w.parent_wine_id in wine_by_id:
             check_w = wine_by_id[w.parent_wine_id]
-        key = (check_w.vintage, _norm(check_w.name))
+        key = (check_w.vintage, name_key(check_w.name))
         orig_id = name_to_orig.get(key)
         if orig_id:
             orig_to_notes.setdefault(str(orig_id), []).append(note)
@@ -934,29 +934,6 @@ def _apply_original_wine_details(user_id):
     detail_by_id = {d['wine_id']: d for d in details if 'error' not in d and d.get('wine_id')}
     txn_by_id = {tx['wine_id']: tx for tx in txns if tx.get('wine_id')}
 
-    def _norm(name):
-        return re.sub(r'\s+', ' ', (name or '').lower().strip())
-
-    def _parse_wine_name(full_name):
-        full_name = re.sub(r'\s*RATED\s*$', '', full_name.strip())
-        m = re.match(r'^(\d{4})\s+(.+?)\s*\((\d+(?:\.\d+)?(?:ml|l))\)\s*$', full_name)
-        if m:
-            size_str = m.group(3)
-            if 'l' in size_str and 'ml' not in size_str:
-                size_ml = int(float(size_str.replace('l', '')) * 1000)
-            else:
-                size_ml = int(float(size_str.replace('ml', '')))
-            return int(m.group(1)), m.group(2).strip(), size_ml
-        m2 = re.match(r'^(.+?)\s*\((\d+(?:\.\d+)?(?:ml|l))\)\s*$', full_name)
-        if m2:
-            size_str = m2.group(2)
-            if 'l' in size_str and 'ml' not in size_str:
-                size_ml = int(float(size_str.replace('l', '')) * 1000)
-            else:
-                size_ml = int(float(size_str.replace('ml', '')))
-            return None, m2.group(1).strip(), size_ml
-        return None, full_name, 750
-
     def _parse_price(price_str):
         if not price_str:
             return None
@@ -967,25 +944,25 @@ def _apply_original_wine_details(user_id):
 
     cellar_wines = Wine.query.filter_by(user_id=user_id, status='cellar').filter(
         db.or_(Wine.on_order == False, Wine.on_order.is_(None))
-    ).all()
+    ).order_by(Wine.id).all()
 
     # Size-aware lookup to handle duplicate names with different bottle sizes
     our_lookup = {}
     for w in cellar_wines:
-        our_lookup[(_norm(w.name), w.vintage, w.size_ml or 750)] = w
+        our_lookup[(name_key(w.name), w.vintage, w.size_ml or 750)] = w
 
     updated = 0
     for orig_id, detail in detail_by_id.items():
         tx = txn_by_id.get(orig_id)
         if not tx:
             continue
-        vintage, name, size_ml = _parse_wine_name(tx['wine_name'])
-        key = (_norm(name), vintage, size_ml)
+        vintage, name, size_ml = parse_wine_name(tx['wine_name'])
+        key = (name_key(name), vintage, size_ml)
         wine = our_lookup.get(key)
         if not wine:
             # Fallback: try without size
             for ckey, cw in our_lookup.items():
-                if ckey[1] == vintage and ckey[0][:20] == _norm(name)[:20]:
+                if ckey[1] == vintage and ckey[0][:20] == key[0][:20]:
                     wine = cw
                     break
         if not wine:
@@ -1141,8 +1118,8 @@ def _apply_original_wine_details(user_id):
         if title:
             detail_by_title[title] = d
 
-    consumed_wines = Wine.query.filter_by(user_id=user_id, status='consumed').all()
-    on_order_wines = Wine.query.filter_by(user_id=user_id, on_order=True).all()
+    consumed_wines = Wine.query.filter_by(user_id=user_id, status='consumed').order_by(Wine.id).all()
+    on_order_wines = Wine.query.filter_by(user_id=user_id, on_order=True).order_by(Wine.id).all()
 
     consumed_updated = 0
     for wine in consumed_wines + on_order_wines:
@@ -1161,7 +1138,7 @@ def _apply_original_wine_details(user_id):
         detail = detail_by_title.get(title_key)
         if not detail:
             for key in detail_by_title:
-                if _norm(full_name) in key:
+                if name_key(full_name) in key:
                     detail = detail_by_title[key]
                     break
 
@@ -1223,7 +1200,7 @@ def _recalibrate_ready_count(user_id):
 
     cellar_wines = Wine.query.filter_by(user_id=user_id, status='cellar').filter(
         db.or_(Wine.on_order == False, Wine.on_order.is_(None))
-    ).all()
+    ).order_by(Wine.id).all()
 
     ready = [w for w in cellar_wines if w.drink_from and w.drink_from <= current_year
              and w.drink_to and w.drink_to >= current_year]
@@ -1259,7 +1236,6 @@ def _apply_transaction_data(user_id):
     """Apply scraped transaction data to set acquisition dates and link consumed wines."""
     import json
     import os
-    import re
     from datetime import datetime as _dt
 
     txn_path = os.path.join(os.path.dirname(__file__), 'wine_transactions.json')
@@ -1270,17 +1246,6 @@ def _apply_transaction_data(user_id):
     with open(txn_path) as f:
         txns = json.load(f)
 
-    def parse_wine_name(full_name):
-        full_name = re.sub(r'\s*RATED\s*$', '', full_name.strip())
-        m = re.match(r'^(\d{4})\s+(.+?)\s*\(\d+(?:\.\d+)?(?:ml|l)\)\s*$', full_name)
-        if m:
-            return int(m.group(1)), m.group(2).strip()
-        m2 = re.match(r'^(\d{4})\s+(.+?)$', full_name)
-        if m2:
-            name = re.sub(r'\s*\(\d+(?:\.\d+)?(?:ml|l)\)\s*$', '', m2.group(2).strip()).strip()
-            return int(m2.group(1)), name
-        return None, re.sub(r'\s*\(\d+(?:\.\d+)?(?:ml|l)\)\s*$', '', full_name).strip()
-
     def parse_date(ds):
         if not ds:
             return None
@@ -1289,28 +1254,25 @@ def _apply_transaction_data(user_id):
         except ValueError:
             return None
 
-    def norm(name):
-        return re.sub(r'\s+', ' ', (name or '').lower().strip())
-
     cellar_wines = Wine.query.filter_by(user_id=user_id, status='cellar').filter(
         db.or_(Wine.on_order == False, Wine.on_order.is_(None))
-    ).all()
-    consumed_wines = Wine.query.filter_by(user_id=user_id, status='consumed').all()
+    ).order_by(Wine.id).all()
+    consumed_wines = Wine.query.filter_by(user_id=user_id, status='consumed').order_by(Wine.id).all()
 
     cellar_lookup = {}
     for w in cellar_wines:
-        cellar_lookup[(w.vintage, norm(w.name))] = w
+        cellar_lookup[(w.vintage, name_key(w.name))] = w
 
     matched = 0
     for txn in txns:
         if 'error' in txn:
             continue
-        vintage, name = parse_wine_name(txn['wine_name'])
-        key = (vintage, norm(name))
+        vintage, name, _ = parse_wine_name(txn['wine_name'])
+        key = (vintage, name_key(name))
         wine = cellar_lookup.get(key)
         if not wine:
             for ckey, cw in cellar_lookup.items():
-                if ckey[0] == vintage and norm(name).startswith(ckey[1][:20]):
+                if ckey[0] == vintage and key[1].startswith(ckey[1][:20]):
                     wine = cw
                     break
         if not wine:
@@ -1337,7 +1299,7 @@ def _apply_transaction_data(user_id):
     for cw in consumed_wines:
         if cw.parent_wine_id:
             continue
-        key = (cw.vintage, norm(cw.name))
+        key = (cw.vintage, name_key(cw.name))
         parent = cellar_lookup.get(key)
         if parent:
             cw.parent_wine_id = parent.id
@@ -1373,27 +1335,7 @@ def _import_consumed_wines(user_id):
 
     count = 0
     for w in consumed_data:
-        name_full = w['name']
-        m = re.match(r'^(\d{4})\s+(.+?)\s+\((\d+(?:\.\d+)?(?:ml|l))\)', name_full)
-        if m:
-            vintage = int(m.group(1))
-            wine_name = m.group(2)
-            size_str = m.group(3)
-        else:
-            m2 = re.match(r'^(.+?)\s+\((\d+(?:\.\d+)?(?:ml|l))\)', name_full)
-            if m2:
-                vintage = None
-                wine_name = m2.group(1)
-                size_str = m2.group(2)
-            else:
-                vintage = None
-                wine_name = name_full
-                size_str = '750ml'
-
-        if 'l' in size_str and 'ml' not in size_str:
-            size_ml = int(float(size_str.replace('l', '')) * 1000)
-        else:
-            size_ml = int(float(size_str.replace('ml', '')))
+        vintage, wine_name, size_ml = parse_wine_name(w['name'])
 
         varietal_str = w.get('varietal', '')
         varietals = [v.strip() for v in re.split(r'\s*-\s*', varietal_str) if v.strip()]
@@ -1462,4 +1404,5 @@ def _add_note(wine_id, user_id, notes_text):
 
 
 if __name__ == '__main__':
+    upgrade(app)
     seed_database()
@@ -0,0 +1,64 @@
+"""Connection settings for the SQLite database.
+
+Every new connection gets the PRAGMAs below, which suit several gunicorn
+workers (plus their job threads) sharing one database file:
+
+- WAL lets readers carry on while one connection writes, and with
+  synchronous=NORMAL a commit no longer waits for an fsync of the main
+  database (a power cut can lose the last commits, never corrupt it).
+- busy_timeout makes a writer wait for the lock rather than fail with
+  "database is locked" straight away.
+- cache_size, mmap_size and temp_store keep hot pages and sort/temporary
+  b-trees in memory.
+- foreign_keys enforces the REFERENCES clauses (SQLite ignores them by
+  default), including ON DELETE CASCADE from wines to wine_varietals.
+  Migration 9 clears the dangling references written before.
+
+app.config['SQLITE_PRAGMAS'] overrides individual values, and
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] the pool settings.
+"""
+from sqlalchemy import event
+
+from models import db
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,             # ms
+    'cache_size': -16000,             # negative: KiB, so 16 MB per connection
+    'mmap_size': 128 * 1024 * 1024,   # bytes
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+
+# Each gunicorn worker process has its own pool, used by its request
+# thread and the jobs.py worker threads; connections are never opened
+# before the fork, so none is shared between processes.
+ENGINE_OPTIONS = {
+    'pool_size': 4,
+    'max_overflow': 4,
+    'pool_timeout': 10,
+}
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    """Run ``PRAGMA name = value`` for each setting on a raw connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
+
+
+def init_app(app):
+    """Apply the PRAGMAs to every connection ``app``'s engine opens."""
+    pragmas = dict(PRAGMAS, **app.config.get('SQLITE_PRAGMAS', {}))
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
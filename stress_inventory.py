@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Hammer the bottle-count routes from many processes and threads at once and
+check that no change was lost.
+Usage: python stress_inventory.py [--processes N] [--threads N] [--ops N]
+                                  [--wines N] [--bottles N] [--gunicorn] [--workers N]
+
+A fresh database gets a 'stress' user (password 'stress') with a few wines
+of --bottles bottles each, so every request contends for the same rows.
+Each thread of each process then consumes a bottle, adds bottles or saves
+the edit form (re-posting the quantity it was shown) on random wines,
+through the Flask test client or, with --gunicorn, over HTTP against a
+multi-worker gunicorn.  The threads count the changes the app reported
+as done, and afterwards every wine must satisfy:
+
+- quantity = starting bottles + bottles added - bottles consumed, never
+  below zero, and status consumed exactly when it is zero;
+- its inventory events sum to its quantity, with one consume event per
+  reported consumption and no adjustments (an edit saved over a
+  concurrent change would have "adjusted" the quantity back);
+- the cellar_summary rows match a recount.
+
+Any error response also fails the run.  Exits 1 if a check fails.  The
+database (and gunicorn's log) live in a temporary directory that is
+removed afterwards; tests/test_concurrency.py runs a smaller load.
+
+On SQLite every write queues for the one database lock, and a request
+that waits longer than busy_timeout fails with "database is locked" (an
+HTTP 500 after about 5 s).  Far more concurrent writers than the
+deployment has workers, especially on few CPUs, can starve a request
+that long, so raise --processes/--threads with that in mind.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+USERNAME, PASSWORD = 'stress', 'stress'
+PRODUCER = 'Stress Test Cellars'
+
+# Share of operations that consume a bottle or add bottles; the rest are edits
+CONSUME_SHARE, ACQUIRE_SHARE = 0.55, 0.25
+
+CONSUMED = 'Enjoyed a bottle of'
+NOTHING_LEFT = ('nothing was removed', 'no bottles of')
+ADDED = re.compile(r'Added (\d+) bottle\(s\)')
+UPDATED = 'updated.'
+CONFLICT = 'changed while you were editing it'
+
+
+def _wine_name(i):
+    return f'Stress Wine {i}'
+
+
+def setup(wines, bottles):
+    """Create the stress user and its wines in the (empty, migrated) database."""
+    from app import app
+    from models import db, User, Wine
+    import inventory
+
+    with app.app_context():
+        user = User(username=USERNAME, email='stress@example.com')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.flush()
+        for i in range(wines):
+            wine = Wine(user_id=user.id, name=_wine_name(i), producer=PRODUCER, wine_type='Red',
+                        vintage=2015, quantity=bottles, price=30.0, status='cellar',
+                        drink_from=2020, drink_to=2035)
+            db.session.add(wine)
+            inventory.open_balance(wine)
+        db.session.commit()
+        return {wine.id: wine.name for wine in Wine.query.filter_by(user_id=user.id)}
+
+
+# ─── Clients ──────────────────────────────────────────────────────
+
+class TestClient:
+    """The app in this process, through the Flask test client."""
+
+    def __init__(self):
+        from app import app
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+        self.client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+
+    def get(self, path):
+        return self._page(self.client.get(path))
+
+    def post(self, path, data):
+        return self._page(self.client.post(path, data=data, follow_redirects=True))
+
+    def _page(self, response):
+        if response.status_code != 200:
+            raise RuntimeError(f'{response.request.path}: HTTP {response.status_code}')
+        return response.get_data(as_text=True)
+
+
+class HTTPClient:
+    """A logged-in session against a running server."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        page = self.get('/login')
+        self.token = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', page).group(1)
+        self.post('/login', {'username': USERNAME, 'password': PASSWORD})
+
+    def get(self, path):
+        return self._open(path)
+
+    def post(self, path, data):
+        return self._open(path, urllib.parse.urlencode(
+            dict(data, csrf_token=getattr(self, 'token', ''))).encode())
+
+    def _open(self, path, body=None):
+        try:
+            with self.opener.open(self.base_url + path, body) as response:
+                return response.read().decode()
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f'{path}: HTTP {e.code}') from None
+
+
+# ─── Load ─────────────────────────────────────────────────────────
+
+class Tally:
+    """What the app reported doing, per wine, and the outcomes seen."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = {}
+        self.consumed = {}
+        self.outcomes = {}
+        self.errors = []
+
+    def count(self, outcome, wine_id=None, acquired=0, consumed=0):
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            if acquired:
+                self.acquired[wine_id] = self.acquired.get(wine_id, 0) + acquired
+            if consumed:
+                self.consumed[wine_id] = self.consumed.get(wine_id, 0) + consumed
+
+    def as_dict(self):
+        return {'acquired': self.acquired, 'consumed': self.consumed,
+                'outcomes': self.outcomes, 'errors': self.errors}
+
+
+def _consume(client, tally, wine_id, rng):
+    page = client.post(f'/wine/{wine_id}/consume', {'quantity': '1'})
+    if CONSUMED in page:
+        tally.count('consumed', wine_id, consumed=1)
+    elif any(text in page for text in NOTHING_LEFT):
+        tally.count('nothing left')
+    else:
+        raise RuntimeError(f'consume {wine_id}: no outcome on the page')
+
+
+def _acquire(client, tally, wine_id, rng):
+    page = client.post(f'/wine/{wine_id}/add-to-cellar',
+                       {'quantity': str(rng.randint(1, 3)), 'price': '30'})
+    added = ADDED.search(page)
+    if not added:
+        raise RuntimeError(f'add-to-cellar {wine_id}: no outcome on the page')
+    tally.count('acquired', wine_id, acquired=int(added.group(1)))
+
+
+def _edit(client, tally, wine_id, rng, names, think):
+    """Post the edit form back with the quantity it showed, after a pause."""
+    form = client.get(f'/wine/{wine_id}/edit')
+    version = re.search(r'name="version_id" value="(\d+)"', form).group(1)
+    quantity = re.search(r'id="quantity"[^>]*value="(\d+)"', form).group(1)
+    status = re.search(r'<select[^>]*name="status".*?<option selected value="(\w+)"', form, re.S).group(1)
+    time.sleep(think)
+    page = client.post(f'/wine/{wine_id}/edit', {
+        'version_id': version, 'name': names[wine_id], 'producer': PRODUCER, 'vintage': '2015',
+        'wine_type': 'Red', 'size_ml': '750', 'quantity': quantity, 'price': '30', 'status': status,
+        'drink_from': '2020', 'drink_to': '2035', 'description': f'edited {rng.random():.6f}',
+    })
+    if CONFLICT in page:
+        tally.count('edit conflict')
+    elif UPDATED in page:
+        tally.count('edited')
+    else:
+        raise RuntimeError(f'edit {wine_id}: no outcome on the page')
+
+
+def run_worker(names, threads, ops, think, base_url, seed):
+    """Run ``threads`` threads of ``ops`` random operations each."""
+    tally = Tally()
+    wine_ids = sorted(names)
+
+    def thread(n):
+        rng = random.Random(seed * 1000 + n)
+        client = HTTPClient(base_url) if base_url else TestClient()
+        for _ in range(ops):
+            wine_id = rng.choice(wine_ids)
+            roll = rng.random()
+            started = time.perf_counter()
+            try:
+                if roll < CONSUME_SHARE:
+                    _consume(client, tally, wine_id, rng)
+                elif roll < CONSUME_SHARE + ACQUIRE_SHARE:
+                    _acquire(client, tally, wine_id, rng)
+                else:
+                    _edit(client, tally, wine_id, rng, names, think)
+            except Exception as e:  # noqa: BLE001 -- every failure is reported
+                with tally.lock:
+                    tally.errors.append(f'{e} (after {time.perf_counter() - started:.1f} s)')
+
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(thread, range(threads)))
+    return tally.as_dict()
+
+
+# ─── Checking ─────────────────────────────────────────────────────
+
+def check(names, bottles, acquired, consumed):
+    """Compare the database with the bottles the app reported adding and
+    consuming; returns each wine's figures and the failures."""
+    from app import app
+    from models import db, Wine, InventoryEvent
+    import cellar_summary
+
+    wines, failures = [], []
+    with app.app_context():
+        for wine_id, name in sorted(names.items()):
+            wine = db.session.get(Wine, wine_id)
+            expected = bottles + acquired.get(wine_id, 0) - consumed.get(wine_id, 0)
+            events = InventoryEvent.query.filter_by(wine_id=wine_id).all()
+            by_kind = {}
+            for e in events:
+                by_kind.setdefault(e.kind, []).append(e.quantity)
+            ledger = sum(e.quantity for e in events)
+            problems = []
+            if wine.quantity != expected:
+                problems.append(f'quantity {wine.quantity}, expected {expected}')
+            if wine.quantity < 0:
+                problems.append('negative quantity')
+            if (wine.status == 'consumed') != (wine.quantity == 0):
+                problems.append(f'status {wine.status} with {wine.quantity} bottles')
+            if ledger != wine.quantity:
+                problems.append(f'events sum to {ledger}')
+            if len(by_kind.get(InventoryEvent.CONSUME, [])) != consumed.get(wine_id, 0):
+                problems.append(f"{len(by_kind.get(InventoryEvent.CONSUME, []))} consume events, "
+                                f"{consumed.get(wine_id, 0)} consumptions reported")
+            if by_kind.get(InventoryEvent.ADJUST):
+                problems.append(f'adjustments {by_kind[InventoryEvent.ADJUST]}')
+            wines.append({'name': name, 'quantity': wine.quantity, 'expected': expected,
+                          'ledger': ledger, 'acquired': acquired.get(wine_id, 0),
+                          'consumed': consumed.get(wine_id, 0), 'version': wine.version_id,
+                          'problems': problems})
+            failures.extend(f'{name}: {p}' for p in problems)
+        for key, have, want in cellar_summary.verify(db.session.connection()):
+            failures.append(f'cellar_summary {key}: {have}, recount {want}')
+    return {'wines': wines, 'failures': failures}
+
+
+# ─── Driver ───────────────────────────────────────────────────────
+
+def _child(args, db_path):
+    env = dict(os.environ, DATABASE_PATH=db_path)
+    env.pop('DATABASE_URL', None)
+    env.pop('PROFILE_REQUESTS', None)
+    return subprocess.Popen([sys.executable, __file__] + args, env=env, cwd=HERE,
+                            stdout=subprocess.PIPE, text=True)
+
+
+def _result(proc):
+    out, _ = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(f'worker failed with exit code {proc.returncode}')
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _start_gunicorn(db_path, workers):
+    port = _free_port()
+    env = dict(os.environ, DATABASE_PATH=db_path)
+    env.pop('DATABASE_URL', None)
+    log = open(os.path.join(os.path.dirname(db_path), 'gunicorn.log'), 'a')
+    server = subprocess.Popen(
+        ['gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app'],
+        env=env, cwd=HERE, stdout=log, stderr=log)
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base_url + '/login').read()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return server, log, base_url
+
+
+def run(processes=4, threads=2, ops=50, wines=3, bottles=12, think=0.005,
+        gunicorn=False, workers=4):
+    """Run the load against a new database in a temporary directory, which
+    is removed afterwards.  Returns the outcomes, each wine's figures from
+    check() and the failures (errors seen by the threads included)."""
+    data_dir = tempfile.mkdtemp(prefix='stress-inventory-')
+    db_path = os.path.join(data_dir, 'stress.db')
+    server = log = None
+    try:
+        names = {int(k): v for k, v in _result(_child(
+            ['--setup', '--wines', str(wines), '--bottles', str(bottles)], db_path)).items()}
+        base_url = ''
+        if gunicorn:
+            server, log, base_url = _start_gunicorn(db_path, workers)
+        started = time.perf_counter()
+        procs = [_child(['--worker', str(seed), '--threads', str(threads), '--ops', str(ops),
+                         '--think', str(think), '--names', json.dumps(names), '--url', base_url],
+                        db_path) for seed in range(processes)]
+        tallies = [_result(p) for p in procs]
+        elapsed = time.perf_counter() - started
+        if server:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+            server = None
+
+        outcomes, acquired, consumed, errors = {}, {}, {}, []
+        for t in tallies:
+            for outcome, n in t['outcomes'].items():
+                outcomes[outcome] = outcomes.get(outcome, 0) + n
+            for wine_id, n in t['acquired'].items():
+                acquired[wine_id] = acquired.get(wine_id, 0) + n
+            for wine_id, n in t['consumed'].items():
+                consumed[wine_id] = consumed.get(wine_id, 0) + n
+            errors.extend(t['errors'])
+        result = _result(_child(['--check', '--bottles', str(bottles), '--names', json.dumps(names),
+                                 '--acquired', json.dumps(acquired), '--consumed', json.dumps(consumed)],
+                                db_path))
+    finally:
+        if server:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        if log:
+            log.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return {'outcomes': outcomes, 'elapsed': elapsed, 'wines': result['wines'],
+            'failures': errors + result['failures']}
+
+
+def main(args):
+    target = f'gunicorn with {args.workers} workers' if args.gunicorn else 'the test client'
+    print(f"{args.processes} processes x {args.threads} threads x {args.ops} operations "
+          f"on {args.wines} wines through {target}")
+    result = run(args.processes, args.threads, args.ops, args.wines, args.bottles, args.think,
+                 args.gunicorn, args.workers)
+    outcomes = result['outcomes']
+    print(f"{sum(outcomes.values())} operations in {result['elapsed']:.1f} s: "
+          + ', '.join(f'{n} {outcome}' for outcome, n in sorted(outcomes.items())))
+    for w in result['wines']:
+        print(f"  {w['name']:<16}{w['quantity']:>5} bottles  +{w['acquired']} -{w['consumed']}  "
+              f"version {w['version']}" + (f"  FAIL: {'; '.join(w['problems'])}" if w['problems'] else ''))
+
+    failures = result['failures']
+    if failures:
+        print(f"{len(failures)} problem(s):")
+        for f in failures[:50]:
+            print(f"  {f}")
+        sys.exit(1)
+    print("All invariants hold.")
+
+
+def _ids(value):
+    return {int(k): v for k, v in json.loads(value).items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=2, help='threads per process')
+    parser.add_argument('--ops', type=int, default=50, help='operations per thread')
+    parser.add_argument('--wines', type=int, default=3)
+    parser.add_argument('--bottles', type=int, default=12, help='starting bottles per wine')
+    parser.add_argument('--think', type=float, default=0.005,
+                        help='seconds between loading and saving the edit form')
+    parser.add_argument('--gunicorn', action='store_true', help='drive gunicorn over HTTP')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    # Internal: the per-process steps run() starts
+    parser.add_argument('--setup', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--check', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--names', type=_ids, help=argparse.SUPPRESS)
+    parser.add_argument('--acquired', type=_ids, help=argparse.SUPPRESS)
+    parser.add_argument('--consumed', type=_ids, help=argparse.SUPPRESS)
+    parser.add_argument('--url', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.setup:
+        from app import app
+        import migrations
+        migrations.upgrade(app, log=lambda message: None)
+        print(json.dumps(setup(args.wines, args.bottles)))
+    elif args.worker is not None:
+        print(json.dumps(run_worker(args.names, args.threads, args.ops, args.think, args.url, args.worker)))
+    elif args.check:
+        print(json.dumps(check(args.names, args.bottles, args.acquired, args.consumed)))
+    else:
+        main(args)
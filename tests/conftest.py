@@ -0,0 +1,57 @@
+"""Fixtures for the route and query tests.
+
+The app is configured from the environment when it is imported, so the
+tests point it at a fresh SQLite database in a temporary directory unless
+DATABASE_URL names a (throwaway) PostgreSQL database to run against.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp_dir = None
+if not os.environ.get('DATABASE_URL'):
+    _tmp_dir = tempfile.mkdtemp(prefix='winecellar-test-')
+    os.environ['DATABASE_PATH'] = os.path.join(_tmp_dir, 'winecellar.db')
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app
+    import migrations
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    migrations.upgrade(app, log=lambda *args: None)
+    yield app
+    from models import db
+    with app.app_context():
+        db.engine.dispose()
+    if _tmp_dir:
+        shutil.rmtree(_tmp_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def user(app):
+    """A new user of their own for each test."""
+    from models import db, User
+    with app.app_context():
+        name = f'test_{uuid.uuid4().hex[:12]}'
+        u = User(username=name, email=f'{name}@example.com')
+        u.set_password('secret')
+        db.session.add(u)
+        db.session.commit()
+        return u.id, u.username
+
+
+@pytest.fixture
+def client(app, user):
+    """A test client logged in as ``user``."""
+    client = app.test_client()
+    response = client.post('/login', data={'username': user[1], 'password': 'secret'})
+    assert response.status_code == 302
+    return client
@@ -0,0 +1,17 @@
+"""Concurrent consumes, acquisitions and edits lose no bottle changes.
+
+Runs a small stress_inventory.py load: several processes of several
+threads each against one new SQLite database.
+"""
+import stress_inventory
+
+
+def test_no_lost_updates():
+    result = stress_inventory.run(processes=3, threads=2, ops=20, wines=2, bottles=10)
+
+    assert result['failures'] == []
+    assert sum(result['outcomes'].values()) == 3 * 2 * 20
+    for wine in result['wines']:
+        # Every consumption and acquisition the app reported is in the quantity
+        assert wine['quantity'] == wine['expected'], wine
+        assert wine['ledger'] == wine['quantity'], wine
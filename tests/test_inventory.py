@@ -0,0 +1,116 @@
+"""Every route that changes bottle counts keeps each wine's inventory
+ledger summing to its quantity (and a wish list wine's to zero)."""
+import re
+from datetime import date
+
+import pytest
+from sqlalchemy import func
+
+from models import db, Wine, InventoryEvent
+import inventory
+
+WINE = {'name': 'Reserve Cabernet', 'producer': 'Test Winery', 'wine_type': 'Red',
+        'size_ml': '750', 'quantity': '3', 'status': 'cellar'}
+
+
+def assert_ledger_matches(app, user_id):
+    with app.app_context():
+        balances = dict(db.session.query(InventoryEvent.wine_id, func.sum(InventoryEvent.quantity))
+                        .filter_by(user_id=user_id).group_by(InventoryEvent.wine_id).all())
+        for wine in Wine.query.filter_by(user_id=user_id):
+            assert balances.get(wine.id, 0) == inventory.held(wine), (wine.name, wine.status, wine.quantity)
+
+
+def _wine(app, user_id):
+    with app.app_context():
+        wine = Wine.query.filter_by(user_id=user_id).one()
+        db.session.expunge(wine)
+        return wine
+
+
+def _edit(client, wine, **fields):
+    response = client.post(f'/wine/{wine.id}/edit', data=dict(WINE, version_id=wine.version_id, **fields))
+    assert response.status_code == 302
+    return response
+
+
+@pytest.mark.parametrize('status', ['cellar', 'wishlist', 'consumed'])
+def test_add_edit_consume_and_acquire(app, client, user, status):
+    client.post('/wine/add', data=dict(WINE, status=status))
+    assert_ledger_matches(app, user[0])
+    wine = _wine(app, user[0])
+
+    _edit(client, wine, status=status, quantity='5')
+    assert_ledger_matches(app, user[0])
+
+    client.post(f'/wine/{wine.id}/consume', data={'quantity': '2'})
+    assert_ledger_matches(app, user[0])
+
+    client.post(f'/wine/{wine.id}/add-to-cellar', data={'quantity': '4'})
+    assert_ledger_matches(app, user[0])
+    assert _wine(app, user[0]).status == 'cellar'
+
+
+def test_moving_between_wishlist_and_cellar(app, client, user):
+    client.post('/wine/add', data=dict(WINE, status='wishlist', quantity='2'))
+    wine = _wine(app, user[0])
+
+    _edit(client, wine, status='cellar', quantity='2')
+    assert_ledger_matches(app, user[0])
+    wine = _wine(app, user[0])
+    assert (wine.status, wine.quantity) == ('cellar', 2)
+
+    _edit(client, wine, status='wishlist', quantity='6')
+    assert_ledger_matches(app, user[0])
+    wine = _wine(app, user[0])
+    assert (wine.status, wine.quantity) == ('wishlist', 6)
+
+    _edit(client, wine, status='wishlist', quantity='1')
+    client.post(f'/wine/{wine.id}/add-to-cellar', data={'quantity': '2'})
+    assert_ledger_matches(app, user[0])
+    wine = _wine(app, user[0])
+    assert (wine.status, wine.quantity) == ('cellar', 2)
+
+
+def test_quick_entry(app, client, user):
+    client.post('/quick-entry', data={'name[]': ['A', 'B'], 'producer[]': ['P', 'P'],
+                                      'vintage[]': ['2019', ''], 'varietal[]': ['', ''],
+                                      'quantity[]': ['4', ''], 'price[]': ['', '12.5']})
+    assert_ledger_matches(app, user[0])
+
+
+def test_sync_keeps_consumed_copies_data(app, client, user):
+    with app.app_context():
+        parent = Wine(user_id=user[0], name='Old Vine Zin', producer='P', status='cellar',
+                      quantity=2, original_quantity=5)
+        db.session.add(parent)
+        db.session.flush()
+        db.session.add(Wine(user_id=user[0], name='Old Vine Zin', producer='P', status='consumed',
+                            quantity=3, parent_wine_id=parent.id, price=40.0, rating=93,
+                            date_consumed=date(2024, 5, 1)))
+        db.session.commit()
+        version = parent.version_id
+        inventory.sync(db.session.connection(), user_ids=[user[0]])
+        db.session.commit()
+
+        (event,) = InventoryEvent.query.filter_by(wine_id=parent.id, kind=inventory.CONSUME).all()
+        assert (event.quantity, event.price, event.event_date) == (-3, 40.0, date(2024, 5, 1))
+        assert [n.score for n in parent.tasting_notes] == [93]
+        # The new date_consumed moved the version on, as an ORM update would
+        assert (parent.date_consumed, parent.version_id) == (date(2024, 5, 1), version + 1)
+    assert_ledger_matches(app, user[0])
+
+    html = client.get('/cellar?status=consumed').get_data(as_text=True)
+    assert re.search(r'1 wines\s*\(3 bottles\)', html)
+    html = client.get('/stats').get_data(as_text=True)
+    assert re.search(r'stat-value">1</div><div class="stat-label">Consumed', html)
+
+
+def test_search_shows_bottles_drunk(app, client, user):
+    client.post('/wine/add', data=WINE)
+    wine = _wine(app, user[0])
+    client.post(f'/wine/{wine.id}/consume', data={'quantity': '3'})
+    assert _wine(app, user[0]).status == 'consumed'
+
+    html = client.get('/search?query=Reserve').get_data(as_text=True)
+    assert re.search(r'<td style="text-align:center;">3</td>', html)
@@ -0,0 +1,131 @@
+"""EXPLAIN QUERY PLAN of the hot wine and tasting-note queries, and of
+every statement behind the cellar list, search and ready-to-drink pages:
+none may fall back to a full table scan, and each uses the index declared
+for it."""
+import re
+
+import pytest
+from sqlalchemy import create_engine, event, func, or_, select
+
+from models import db, Wine, TastingNote
+import inventory
+
+USER, WINE, YEAR = 1, 1, 2026
+
+# A full scan of a table; SCAN of an FTS5 virtual table is an index lookup
+_FULL_SCAN = re.compile(r'^SCAN (?!\S+ VIRTUAL TABLE)')
+
+
+def _in_cellar():
+    return (Wine.user_id == USER, Wine.status == 'cellar',
+            or_(Wine.on_order == False, Wine.on_order.is_(None)))  # noqa: E712
+
+
+QUERIES = {
+    'cellar list by name': (
+        select(Wine).where(*_in_cellar()).order_by(func.lower(Wine.name), Wine.id).limit(50),
+        'ix_wines_user_status_lower_name'),
+    'cellar list by producer': (
+        select(Wine).where(*_in_cellar()).order_by(func.lower(Wine.producer), Wine.id).limit(50),
+        'ix_wines_user_status_lower_producer'),
+    'on order': (
+        select(Wine).where(Wine.user_id == USER, Wine.status == 'cellar', Wine.on_order == True),  # noqa: E712
+        'ix_wines_user_status_on_order'),
+    'ready to drink': (
+        select(Wine).where(Wine.user_id == USER, Wine.status == 'cellar', Wine.drink_from <= YEAR,
+                           or_(Wine.drink_to.is_(None), Wine.drink_to >= YEAR)),
+        'ix_wines_user_status_drink_window'),
+    'search': (
+        select(Wine).where(Wine.user_id == USER, or_(Wine.name.ilike('%cab%'),
+                                                     Wine.producer.ilike('%cab%')))
+        .order_by(func.lower(Wine.name)),
+        'ix_wines_user_'),
+    'consumed copies': (
+        select(Wine).where(Wine.parent_wine_id == WINE).order_by(Wine.date_consumed),
+        'ix_wines_parent_date_consumed'),
+    'recent additions': (
+        select(Wine).where(Wine.user_id == USER).order_by(Wine.date_added.desc()).limit(5),
+        'ix_wines_user_date_added'),
+    'notes of a wine': (
+        select(TastingNote).where(TastingNote.wine_id == WINE).order_by(TastingNote.tasting_date),
+        'ix_tasting_notes_wine_date'),
+    'notes of a user': (
+        select(TastingNote).where(TastingNote.user_id == USER).order_by(TastingNote.tasting_date.desc()),
+        'ix_tasting_notes_user_date'),
+}
+
+
+@pytest.fixture(scope='module')
+def engine():
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def plan(engine, statement):
+    sql = str(statement.compile(engine, compile_kwargs={'literal_binds': True}))
+    with engine.connect() as conn:
+        return [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql)]
+
+
+@pytest.mark.parametrize('name', QUERIES)
+def test_query_uses_its_index(engine, name):
+    statement, index = QUERIES[name]
+    lines = plan(engine, statement)
+    assert not [line for line in lines if _FULL_SCAN.match(line)], lines
+    assert any(index in line for line in lines), lines
+
+
+@pytest.fixture
+def cellar(app, client, user):
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            pytest.skip('query plans are checked on SQLite')
+        for i in range(30):
+            wine = Wine(user_id=user[0], name=f'Plan Wine {i}', producer=f'Producer {i % 4}',
+                        wine_type='Red', vintage=2010 + i % 10, quantity=2, price=20.0 + i,
+                        status=('cellar', 'cellar', 'wishlist')[i % 3], on_order=(i % 5 == 0),
+                        drink_from=2018 + i % 8, drink_to=2030)
+            db.session.add(wine)
+            inventory.open_balance(wine)
+        db.session.commit()
+    return client
+
+
+def _plans(app, client, url):
+    """[(statement, plan lines)] for the SELECTs the page runs."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        assert client.get(url).status_code == 200
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    with app.app_context():
+        conn = db.session.connection()
+        return [(statement, [row[-1] for row in conn.exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + statement, parameters)]) for statement, parameters in statements]
+
+
+@pytest.mark.parametrize('url, index', [
+    ('/cellar', 'ix_wines_user_status_lower_name'),
+    ('/cellar?sort_by=producer', 'ix_wines_user_status_lower_producer'),
+    ('/cellar?status=on_order', 'ix_wines_user_status_on_order'),
+    ('/cellar?status=wishlist', 'ix_wines_user_status_lower_name'),
+    ('/cellar?status=consumed', 'ix_inventory_events_wine_kind'),
+    ('/cellar?query=Producer', 'wines_fts'),
+    ('/search?query=Plan', 'wines_fts'),
+    ('/cellar/ready', 'ix_wines_user_status_drink_window'),
+])
+def test_no_full_scans(app, cellar, url, index):
+    plans = _plans(app, cellar, url)
+    scans = [(statement, line) for statement, lines in plans for line in lines if _FULL_SCAN.match(line)]
+    assert scans == []
+    assert any(index in line for _, lines in plans for line in lines)
@@ -0,0 +1,204 @@
+"""Migrations and the main pages, on SQLite or on the PostgreSQL database
+named by DATABASE_URL."""
+import csv
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import create_engine, inspect, select, text
+
+import migrations
+from models import db, User, Wine, TastingNote, InventoryEvent, archived_wines
+import inventory
+
+
+@contextmanager
+def _scratch(app):
+    """A connection whose users/wines/tasting_notes tables are empty
+    shells, as in a database from before the added columns."""
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            conn.execute(text('CREATE SCHEMA scratch'))
+            conn.execute(text('SET LOCAL search_path TO scratch'))
+            try:
+                yield conn
+            finally:
+                conn.rollback()
+        return
+    path = os.path.join(tempfile.mkdtemp(prefix='winecellar-scratch-'), 'old.db')
+    engine = create_engine(f'sqlite:///{path}')
+    try:
+        with engine.begin() as conn:
+            yield conn
+    finally:
+        engine.dispose()
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+
+def test_upgrade_is_applied_once(app):
+    with app.app_context(), db.engine.begin() as conn:
+        assert migrations.current_version(conn) == migrations.MIGRATIONS[-1][0]
+    # Concurrent starts wait for the lock, then find nothing to do
+    applied = []
+    threads = [threading.Thread(target=lambda: applied.append(migrations.upgrade(app, log=lambda m: None)))
+               for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert applied == [0, 0, 0]
+
+
+def test_added_columns_ddl(app):
+    with _scratch(app) as conn:
+        for table in ('users', 'wines', 'tasting_notes'):
+            conn.execute(text(f'CREATE TABLE {table} (id INTEGER PRIMARY KEY)'))
+        conn.execute(text('INSERT INTO wines (id) VALUES (1)'))
+        migrations._add_columns(conn)
+
+        inspector = inspect(conn)
+        for table, column, _ in migrations._ADDED_COLUMNS:
+            assert column in {c['name'] for c in inspector.get_columns(table)}
+        row = conn.execute(text('SELECT version_id, parent_wine_id, acq_price FROM wines')).one()
+        assert tuple(row) == (1, None, None)
+        conn.execute(text('INSERT INTO wines (id, parent_wine_id, acq_price) VALUES (2, 1, 12.5)'))
+
+
+def test_ledger_migration_keeps_consumed_history(app):
+    """A database from before the ledger: its consumed copies, every
+    column of them, come through the migrations in archived_wines."""
+    wines = Wine.__table__
+    with _scratch(app) as conn:
+        db.metadata.create_all(conn, tables=[User.__table__, wines, TastingNote.__table__])
+        conn.execute(User.__table__.insert().values(id=1, username='old', email='old@example.com',
+                                                    password_hash='x'))
+        conn.execute(wines.insert().values(id=1, user_id=1, name='Old Vine Zin', producer='P',
+                                           status='cellar', quantity=2, original_quantity=6))
+        copy = dict(
+            user_id=1, name='Old Vine Zin', vintage=2015, producer='P', wine_type='Red',
+            appellation='Lodi', varietal1='Zinfandel', varietal2='Petite Sirah', varietal3='Carignan',
+            varietal4='Mourvèdre', size_ml=1500, alcohol_pct=14.5, description='Dense and brambly',
+            producer_url='https://example.com', acq_date=date(2019, 3, 1), quantity=3, price=40.0,
+            acq_price=32.5, acq_from='Shop', on_order=False, stored='Rack 4',
+            acq_description='Case deal', status='consumed', date_added=datetime(2019, 3, 2, 10, 30),
+            date_consumed=date(2024, 5, 1), drink_from=2020, drink_to=2030, maturity_override='Drink',
+            rating=93, parent_wine_id=1, original_quantity=3, version_id=4)
+        assert set(copy) | {'id'} == set(wines.c.keys())
+        conn.execute(wines.insert(), [dict(copy, id=2),
+                                      dict(copy, id=3, quantity=1, date_consumed=date(2024, 6, 1),
+                                           rating=None, description=None)])
+        before = conn.execute(select(wines).where(wines.c.parent_wine_id == 1)
+                              .order_by(wines.c.id)).mappings().all()
+
+        for _, _, step in migrations.MIGRATIONS:
+            step(conn)
+
+        archived = conn.execute(select(archived_wines).order_by(archived_wines.c.id)).mappings().all()
+        assert [{k: v for k, v in row.items() if k != 'archived_at'} for row in archived] == before
+        assert conn.execute(select(wines.c.id)).scalars().all() == [1]
+        events = InventoryEvent.__table__
+        consumed = conn.execute(select(events.c.quantity, events.c.price).where(
+            events.c.kind == InventoryEvent.CONSUME).order_by(events.c.event_date)).all()
+        assert [tuple(row) for row in consumed] == [(-3, 40.0), (-1, 40.0)]
+
+
+def test_repair_foreign_keys(app):
+    with _scratch(app) as conn:
+        if conn.dialect.name != 'sqlite':
+            pytest.skip('PostgreSQL has always enforced foreign keys')
+        db.metadata.create_all(conn)
+        conn.execute(User.__table__.insert().values(id=1, username='old', email='old@example.com',
+                                                    password_hash='x'))
+        # Written while SQLite ignored the REFERENCES clauses
+        conn.execute(Wine.__table__.insert(), [
+            {'id': 1, 'user_id': 1, 'name': 'Kept', 'producer': 'P', 'parent_wine_id': 99},
+            {'id': 2, 'user_id': 42, 'name': 'Ownerless', 'producer': 'P', 'parent_wine_id': None},
+        ])
+        conn.execute(TastingNote.__table__.insert(), [
+            {'id': 1, 'wine_id': 1, 'user_id': 1}, {'id': 2, 'wine_id': 2, 'user_id': 1},
+            {'id': 3, 'wine_id': 77, 'user_id': 1},
+        ])
+        migrations._repair_foreign_keys(conn)
+
+        assert conn.exec_driver_sql('PRAGMA foreign_key_check').all() == []
+        assert conn.execute(text('SELECT id, parent_wine_id FROM wines')).all() == [(1, None)]
+        assert conn.execute(text('SELECT id FROM tasting_notes')).scalars().all() == [1]
+
+@pytest.fixture
+def wine_id(app, user):
+    with app.app_context():
+        wine = Wine(user_id=user[0], name='Route Cabernet', producer='Route Cellars', wine_type='Red',
+                    vintage=2016, quantity=4, price=35.0, status='cellar', drink_from=2020,
+                    drink_to=2032, varietal1='Cabernet Sauvignon', appellation='Napa Valley')
+        db.session.add(wine)
+        inventory.open_balance(wine)
+        db.session.flush()
+        db.session.add(TastingNote(wine_id=wine.id, user_id=user[0], tasting_date=date(2024, 1, 1),
+                                   score=92, overall='Firm'))
+        db.session.commit()
+        return wine.id
+
+
+@pytest.mark.parametrize('url', [
+    '/', '/faq', '/best-values', '/cellar', '/cellar?status=consumed', '/cellar?status=wishlist',
+    '/cellar?status=on_order', '/cellar?query=Cabernet&sort_by=vintage&sort_order=desc',
+    '/cellar?varietal=Cabernet&submitAction=All', '/cellar/ready', '/wine/{id}',
+    '/wine/{id}/edit', '/wine/{id}/consume', '/wine/{id}/add-to-cellar', '/wine/{id}/tasting/add',
+    '/tastings', '/stats', '/search?query=Route', '/quick-entry', '/import', '/export',
+    '/api/wines', '/api/v1/wines?fields=name,maturity,quantity', '/api/v1/forecast',
+])
+def test_page(client, wine_id, url):
+    response = client.get(url.format(id=wine_id))
+    assert response.status_code == 200, response.get_data(as_text=True)[:500]
+    response.close()
+
+
+def _export(client, status=''):
+    response = client.get(f'/export?status={status}')
+    rows = list(csv.DictReader(response.get_data(as_text=True).splitlines()))
+    return [(row['Name'], row['Status'], int(row['Quantity'])) for row in rows]
+
+
+def test_export_after_partial_consume(client, wine_id):
+    assert _export(client) == [('Route Cabernet', 'cellar', 4)]
+    assert _export(client, 'consumed') == []
+    assert client.post(f'/wine/{wine_id}/consume', data={'quantity': '1'}).status_code == 302
+    # The bottle drunk gets a consumed row, as a consumed copy used to
+    assert _export(client) == [('Route Cabernet', 'cellar', 3), ('Route Cabernet', 'consumed', 1)]
+    assert _export(client, 'consumed') == [('Route Cabernet', 'consumed', 1)]
+    assert _export(client, 'cellar') == [('Route Cabernet', 'cellar', 3)]
+
+def test_delete_parent_wine(app, client, user, wine_id):
+    with app.app_context():
+        child = Wine(user_id=user[0], name='Route Cabernet', producer='Route Cellars',
+                     status='wishlist', quantity=1, parent_wine_id=wine_id)
+        db.session.add(child)
+        db.session.commit()
+        child_id = child.id
+    response = client.post(f'/wine/{wine_id}/delete')
+    assert response.status_code == 302
+    with app.app_context():
+        assert db.session.get(Wine, wine_id) is None
+        assert db.session.get(Wine, child_id).parent_wine_id is None
+        assert TastingNote.query.filter_by(wine_id=wine_id).count() == 0
+        assert InventoryEvent.query.filter_by(wine_id=wine_id).count() == 0
+
+def test_consume_and_edit(app, client, wine_id):
+    assert client.post(f'/wine/{wine_id}/consume', data={'quantity': '1', 'pointRating': '90'}).status_code == 302
+    with app.app_context():
+        wine = db.session.get(Wine, wine_id)
+        version = wine.version_id
+        assert (wine.quantity, wine.rating) == (3, 90)
+    response = client.post(f'/wine/{wine_id}/edit', data={
+        'name': 'Route Cabernet', 'producer': 'Route Cellars', 'wine_type': 'Red', 'size_ml': '750',
+        'quantity': '6', 'status': 'cellar', 'version_id': version})
+    assert response.status_code == 302
+    with app.app_context():
+        assert db.session.get(Wine, wine_id).quantity == 6
+        assert db.session.get(Wine, wine_id).inventory_totals() == (4, 1, 6)
@@ -0,0 +1,59 @@
+"""Adding and editing wines through WineForm / EditWineForm."""
+import re
+
+from models import db, Wine
+
+WINE = {'name': 'Reserve Cabernet', 'producer': 'Test Winery', 'wine_type': 'Red',
+        'size_ml': '750', 'quantity': '3', 'status': 'cellar'}
+
+
+def _add(client, **fields):
+    return client.post('/wine/add', data=dict(WINE, **fields))
+
+
+def _wine(app, user_id):
+    with app.app_context():
+        wine = Wine.query.filter_by(user_id=user_id).one()
+        db.session.expunge(wine)
+        return wine
+
+
+def _version_field(html):
+    return int(re.search(r'name="version_id" value="(\d+)"', html).group(1))
+
+
+def test_add_needs_a_bottle(app, client, user):
+    response = _add(client, quantity='0')
+    assert response.status_code == 200
+    with app.app_context():
+        assert Wine.query.filter_by(user_id=user[0]).count() == 0
+
+
+def test_edit_can_set_zero(app, client, user):
+    _add(client)
+    wine = _wine(app, user[0])
+    response = client.post(f'/wine/{wine.id}/edit',
+                           data=dict(WINE, quantity='0', version_id=wine.version_id))
+    assert response.status_code == 302
+    assert _wine(app, user[0]).quantity == 0
+
+
+def test_invalid_edit_keeps_the_version_it_was_opened_at(app, client, user):
+    _add(client)
+    wine = _wine(app, user[0])
+    opened_at = _version_field(client.get(f'/wine/{wine.id}/edit').get_data(as_text=True))
+
+    # Another tab drinks a bottle, then this form is submitted with an error
+    client.post(f'/wine/{wine.id}/consume', data={'quantity': '1'})
+    response = client.post(f'/wine/{wine.id}/edit',
+                           data=dict(WINE, name='', quantity='5', version_id=opened_at))
+    assert _version_field(response.get_data(as_text=True)) == opened_at
+
+    # Saving the corrected form must not overwrite the consumption
+    response = client.post(f'/wine/{wine.id}/edit',
+                           data=dict(WINE, quantity='5', version_id=opened_at))
+    assert response.status_code == 200
+    html = response.get_data(as_text=True)
+    assert 'was changed while you were editing it' in html
+    assert _version_field(html) == _wine(app, user[0]).version_id
+    assert _wine(app, user[0]).quantity == 2
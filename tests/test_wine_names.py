@@ -0,0 +1,94 @@
+"""wine_names against the per-step parsers and _norm the seed used before it.
+
+Every name the seed compares (transactions, wine details, consumed wines
+and the cellar CSV) must parse and normalize exactly as before, so the
+seed's matches are unchanged.
+"""
+import csv
+import json
+import os
+import re
+
+import pytest
+
+import wine_names
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# The reference: the seed's copies from before wine_names (the same code
+# bench_wine_names.py times, kept here so the tests do not import the bench)
+def legacy_parse(full_name):
+    """The parser as it was duplicated before wine_names existed."""
+    full_name = re.sub(r'\s*RATED\s*$', '', full_name.strip())
+    m = re.match(r'^(\d{4})\s+(.+?)\s*\((\d+(?:\.\d+)?(?:ml|l))\)\s*$', full_name)
+    if m:
+        size_str = m.group(3)
+        if 'l' in size_str and 'ml' not in size_str:
+            size_ml = int(float(size_str.replace('l', '')) * 1000)
+        else:
+            size_ml = int(float(size_str.replace('ml', '')))
+        return int(m.group(1)), m.group(2).strip(), size_ml
+    m2 = re.match(r'^(.+?)\s*\((\d+(?:\.\d+)?(?:ml|l))\)\s*$', full_name)
+    if m2:
+        size_str = m2.group(2)
+        if 'l' in size_str and 'ml' not in size_str:
+            size_ml = int(float(size_str.replace('l', '')) * 1000)
+        else:
+            size_ml = int(float(size_str.replace('ml', '')))
+        return None, m2.group(1).strip(), size_ml
+    return None, full_name, 750
+
+
+def legacy_key(name):
+    """_norm, the name key the seed matched on."""
+    return re.sub(r'\s+', ' ', (name or '').lower().strip())
+
+
+def legacy_parse_sizeless(full_name):
+    """The case-insensitive variant the tasting-note step used."""
+    full_name = re.sub(r'\s*RATED\s*$', '', full_name.strip())
+    m = re.match(r'^(\d{4})\s+(.+?)\s*\(\d+(?:\.\d+)?(?:ml|l)\)\s*$', full_name, re.I)
+    if m:
+        return int(m.group(1)), m.group(2).strip()
+    m2 = re.match(r'^(.+?)\s*\(\d+(?:\.\d+)?(?:ml|l)\)\s*$', full_name, re.I)
+    if m2:
+        return None, m2.group(1).strip()
+    return None, full_name
+
+
+def _load(name):
+    with open(os.path.join(ROOT, name)) as f:
+        return json.load(f)
+
+
+def _scraped_names():
+    names = [tx['wine_name'] for tx in _load('wine_transactions.json') if 'error' not in tx]
+    names += [re.sub(r'\s*\[Printable View\]\s*$', '', d['title'])
+              for d in _load('wine_details_original.json') if d.get('title')]
+    names += [w['name'] for w in _load('consumed_data.json')]
+    return names
+
+
+def _cellar_names():
+    with open(os.path.join(ROOT, 'cellar_data.csv'), encoding='utf-8-sig') as f:
+        rows = list(csv.reader(f))
+    header = next(i for i, r in enumerate(rows) if 'Name' in r and 'Producer' in r)
+    return [r[1].strip() for r in rows[header + 1:] if len(r) > 1 and r[1].strip()]
+
+
+SCRAPED = _scraped_names()
+
+
+@pytest.mark.parametrize('full_name', SCRAPED)
+def test_parse_matches_legacy(full_name):
+    assert wine_names.parse(full_name) == legacy_parse(full_name)
+    assert wine_names.parse(full_name)[:2] == legacy_parse_sizeless(full_name)
+
+
+def test_name_key_matches_legacy():
+    names = set(_cellar_names())
+    names.update(legacy_parse(n)[1] for n in SCRAPED)
+    names.update(SCRAPED)
+    differ = sorted(n for n in names if wine_names.name_key(n) != legacy_key(n))
+    assert differ == []
@@ -0,0 +1,58 @@
+"""Parsing of ManageYourCellar wine names.
+
+The scraped transaction, detail and consumed-wine files name a wine as
+'2015 Almaviva (Proprietary Blend) (750ml) RATED': an optional vintage,
+the wine name, an optional bottle size and an optional RATED marker.
+parse() splits such a name into (vintage, name, size_ml) and name_key()
+gives the form wine names are compared in.  Both are memoized; the seed
+steps and the transaction replay look up the same few hundred names
+many times over.
+"""
+import re
+from functools import lru_cache
+
+DEFAULT_SIZE_ML = 750
+
+_CACHE_SIZE = 4096
+
+_RATED_RE = re.compile(r'\s*RATED\s*$')
+_SIZE_RE = re.compile(r'\s*\((\d+(?:\.\d+)?)(ml|l)\)\s*$', re.IGNORECASE)
+_VINTAGE_RE = re.compile(r'(\d{4})\s+(.+)$', re.DOTALL)
+_SPACE_RE = re.compile(r'\s+')
+
+
+def size_ml(amount, unit):
+    """Bottle size in ml for a '750ml' / '1.5l' style amount and unit."""
+    if unit.lower() == 'l':
+        return int(float(amount) * 1000)
+    return int(float(amount))
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def parse(full_name):
+    """Parse '2015 Almaviva (Proprietary Blend) (750ml) RATED' into
+    (2015, 'Almaviva (Proprietary Blend)', 750).
+
+    The vintage is None when the name does not start with one, and the
+    size is DEFAULT_SIZE_ML when it has no size suffix.
+    """
+    name = _RATED_RE.sub('', full_name.strip())
+    size = DEFAULT_SIZE_ML
+    m = _SIZE_RE.search(name)
+    if m:
+        size = size_ml(m.group(1), m.group(2))
+        name = name[:m.start()]
+    vintage = None
+    m = _VINTAGE_RE.match(name)
+    if m:
+        vintage, name = int(m.group(1)), m.group(2)
+    return vintage, name.strip(), size
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def name_key(name):
+    """Normalize a wine name for matching: lowercased, runs of whitespace
+    collapsed and double quotes dropped."""
+    if not name:
+        return ''
+    return _SPACE_RE.sub(' ', name.lower().strip()).replace('"', '')
@@ -0,0 +1,112 @@
+"""Maintenance and queries for the normalized wine_varietals table.
+
+Wine.varietal1-4 remain the fields forms, imports and exports read and
+write.  Every flush that adds, edits or deletes a Wine rewrites that wine's
+wine_varietals rows (one per filled column, keyed by position) and adds
+any new names to the varietals lookup table, so varietal filters and
+breakdowns can join on an indexed varietal_id instead of OR-ing four
+ILIKE scans, and blends count towards every grape they contain.
+"""
+from sqlalchemy import event, inspect, literal, select, union_all
+from sqlalchemy.orm import Session
+
+from models import Wine, Varietal, WineVarietal
+
+_COLUMNS = ('varietal1', 'varietal2', 'varietal3', 'varietal4')
+
+
+def _varietal_ids(conn, names):
+    """Map each name to its varietals.id, adding names not seen before."""
+    table = Varietal.__table__
+    ids = dict(conn.execute(select(table.c.name, table.c.id).where(table.c.name.in_(names))).all())
+    missing = sorted(set(names) - set(ids))
+    if missing:
+        conn.execute(table.insert(), [{'name': name} for name in missing])
+        ids.update(conn.execute(select(table.c.name, table.c.id).where(table.c.name.in_(missing))).all())
+    return ids
+
+
+def sync(conn, wines):
+    """Rewrite the wine_varietals rows for ``wines``."""
+    sync_slots(conn, {w.id: w.varietal_slots for w in wines})
+
+
+def sync_slots(conn, slots_by_wine):
+    """Rewrite wine_varietals from {wine_id: [(position, name), ...]}."""
+    table = WineVarietal.__table__
+    conn.execute(table.delete().where(table.c.wine_id.in_(list(slots_by_wine))))
+    slots = [(wine_id, position, name)
+             for wine_id, wine_slots in slots_by_wine.items() for position, name in wine_slots]
+    if not slots:
+        return
+    ids = _varietal_ids(conn, {name for _, _, name in slots})
+    conn.execute(table.insert(), [
+        {'wine_id': wine_id, 'position': position, 'varietal_id': ids[name]}
+        for wine_id, position, name in slots
+    ])
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_varietal_changes(session, flush_context):
+    changed = [obj for obj in session.new if isinstance(obj, Wine)]
+    for obj in session.dirty:
+        if isinstance(obj, Wine) and session.is_modified(obj):
+            state = inspect(obj)
+            if any(state.attrs[name].history.has_changes() for name in _COLUMNS):
+                changed.append(obj)
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Wine)]
+
+    if not changed and not deleted:
+        return
+    conn = session.connection()
+    if changed:
+        sync(conn, changed)
+    if deleted:
+        table = WineVarietal.__table__
+        conn.execute(table.delete().where(table.c.wine_id.in_(deleted)))
+
+
+def delete_for_user(conn, user_id):
+    """Remove a user's wine_varietals rows ahead of a bulk delete of their wines."""
+    table = WineVarietal.__table__
+    conn.execute(table.delete().where(
+        table.c.wine_id.in_(select(Wine.id).where(Wine.user_id == user_id))))
+
+
+def backfill(conn):
+    """Rebuild wine_varietals (and any missing lookup names) from varietal1-4."""
+    slots = union_all(*(
+        select(Wine.id.label('wine_id'), literal(position).label('position'),
+               getattr(Wine, name).label('name'))
+        .where(getattr(Wine, name).isnot(None), getattr(Wine, name) != '')
+        for position, name in enumerate(_COLUMNS, 1)
+    )).subquery('slots')
+
+    varietals = Varietal.__table__
+    conn.execute(varietals.insert().from_select(
+        ['name'],
+        select(slots.c.name).distinct()
+        .where(slots.c.name.notin_(select(varietals.c.name))),
+    ))
+    table = WineVarietal.__table__
+    conn.execute(table.delete())
+    conn.execute(table.insert().from_select(
+        ['wine_id', 'position', 'varietal_id'],
+        select(slots.c.wine_id, slots.c.position, varietals.c.id)
+        .join(varietals, varietals.c.name == slots.c.name),
+    ))
+
+
+def matching_wine_ids(term):
+    """SELECT of wine ids having a varietal whose name contains ``term``.
+
+    The name match runs against the small lookup table; wines are then
+    found through the (varietal_id, wine_id) index.
+    """
+    varietal_ids = select(Varietal.id).where(Varietal.name.ilike(f'%{term}%'))
+    return select(WineVarietal.wine_id).where(WineVarietal.varietal_id.in_(varietal_ids))
+
+
+def has_varietal(term):
+    """Condition for wines listing a varietal whose name contains ``term``."""
+    return Wine.id.in_(matching_wine_ids(term))
@@ -0,0 +1,41 @@
+"""Per-user change counter for wines.
+
+users.wine_version is incremented in the same transaction as every flush
+that adds, edits or deletes one of the user's wines.  Anything derived
+from a user's wines (API ETags, the facet cache) can compare the counter
+instead of re-reading the wines, and it also sees writes made by other
+processes such as the import scripts.
+"""
+from itertools import chain
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from models import db, User, Wine
+
+
+def bump(conn, user_ids):
+    """Increment the counter for ``user_ids``."""
+    table = User.__table__
+    conn.execute(table.update().where(table.c.id.in_(user_ids))
+                 .values(wine_version=table.c.wine_version + 1))
+
+
+def current(user_id):
+    """The user's current counter value."""
+    return db.session.execute(select(User.wine_version).where(User.id == user_id)).scalar() or 0
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_wine_changes(session, flush_context):
+    owners = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, Wine):
+            continue
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        owners.add(obj.user_id)
+        owners.update(inspect(obj).attrs.user_id.history.deleted)
+    owners.discard(None)
+    if owners:
+        bump(session.connection(), owners)